@@ -1,3 +1,155 @@
-from django.test import TestCase
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import Client, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from users.ingestion import save_notes
+
+UserStat = apps.get_model('users', 'UserStat')
+Team = apps.get_model('users', 'Team')
+Metric = apps.get_model('users', 'Metric')
+Profile = apps.get_model('users', 'Profile')
+FeedMessage = apps.get_model('users', 'FeedMessage')
+TeamEvent = apps.get_model('users', 'TeamEvent')
+
+
+class ProfileListViewTest(TestCase):
+    def test_users_ranked_by_lines_and_paginated(self):
+        now = timezone.now()
+        for i in range(25):
+            user = User.objects.create_user(username='testuser' + str(i), password='12345')
+            save_notes([UserStat(user=user, time_from=now, time_to=now, metrics={'lines': i, 'metric': 100 - i})])
+        User.objects.create_user(username='idle', password='12345')
+        c = Client()
+
+        with self.assertNumQueries(2):
+            response = c.get('/')
+        self.assertEqual(response.status_code, 200)
+        users = response.context['users']
+        self.assertEqual(20, len(users))
+        self.assertEqual(['testuser24', 'testuser23'], [u.username for u in users[:2]])
+        self.assertEqual([24, 23], [u.total for u in users[:2]])
+
+        users = c.get('/?page=2').context['users']
+        self.assertEqual(6, len(users))
+        self.assertEqual(('idle', 0), (users[5].username, users[5].total))
+
+
+class TeamDetailViewTest(TestCase):
+    def setUp(self):
+        now = timezone.now()
+        self.admin = User.objects.create_user(username='admin', password='12345')
+        self.team = Team.objects.create(name='team')
+        self.team.admins.add(self.admin)
+        for i in range(5):
+            user = User.objects.create_user(username='testuser' + str(i), password='12345')
+            self.team.users.add(user)
+            save_notes([UserStat(user=user, time_from=now, time_to=now, metrics={'lines': i})])
+
+    def test_plot_queries_do_not_depend_on_period(self):
+        c = Client()
+        c.login(username='admin', password='12345')
+        self.assertEqual(c.get(f'/team/{self.team.id}/').status_code, 200)
+
+        queries = []
+        for period in ['1', '7', 'all']:
+            with mock.patch('users.catalog.METRIC_CATALOG_CHECK_SECONDS', 0), \
+                    CaptureQueriesContext(connection) as context:
+                response = c.post(f'/team/{self.team.id}/', {'target_team_id': self.team.id, 'time': period})
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('plot_div', response.context)
+            self.assertEqual(4, response.context['dict']['testuser4'])
+            queries.append(len(context))
+        self.assertEqual(1, len(set(queries)))
+
+    def test_metric_fan_out_queries_do_not_depend_on_team_size(self):
+        for name in ['first', 'second']:
+            Metric.objects.create(name=name, string_representation=name)
+        c = Client()
+        c.login(username='admin', password='12345')
+        url = f'/team/{self.team.id}/administrate'
+        c.post(url, {'query': 'add_metric', 'metrics_add': 'first'})
+
+        # the metric catalog stamp is read on every use, so both requests read it
+        with mock.patch('users.catalog.METRIC_CATALOG_CHECK_SECONDS', 0):
+            with CaptureQueriesContext(connection) as small:
+                c.post(url, {'query': 'rm_metric', 'metrics_rm': 'first'})
+            for i in range(5, 20):
+                self.team.users.add(User.objects.create_user(username='testuser' + str(i), password='12345'))
+            with CaptureQueriesContext(connection) as large:
+                c.post(url, {'query': 'rm_metric', 'metrics_rm': 'first'})
+        self.assertEqual(len(small), len(large))
+
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(c.post(url, {'query': 'add_metric', 'metrics_add': 'second'}).status_code, 200)
+        self.assertEqual(21, Profile.objects.filter(tracked_metrics__name='second').count())
+        self.assertEqual(21, FeedMessage.objects.filter(msg_content='second is now tracked in "team" team').count())
+        self.assertEqual(2, Profile.objects.get(user=self.admin).config_version)
+        self.assertLess(len(context), 21)
+
+    def test_join_team_tracks_team_metrics(self):
+        metric = Metric.objects.create(name='first', string_representation='first')
+        self.team.tracked_metrics.add(metric)
+        User.objects.create_user(username='newcomer', password='12345')
+        c = Client()
+        c.login(username='newcomer', password='12345')
+
+        self.assertEqual(c.post('/join_team', {'invite_key': self.team.invite_key}).status_code, 302)
+        self.assertEqual(['first'], list(Profile.objects.get(user__username='newcomer').get_metrics())[1:])
+        self.assertTrue(FeedMessage.objects.filter(receiver=self.admin, msg_content='newcomer joined "team" team'))
+
+
+class UserDetailViewTest(TestCase):
+    def test_summary(self):
+        now = timezone.now()
+        user = User.objects.create_user(username='testuser', password='12345')
+        save_notes([UserStat(user=user, time_from=now - timedelta(days=days), time_to=now, metrics={'lines': 1})
+                    for days in [0, 10, 100]])
+        c = Client()
+        c.login(username='testuser', password='12345')
+
+        response = c.get(f'/profile/{user.id}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((3, 3, 2, 1, 1), tuple(response.context['summary']['Lines of code']))
+        self.assertEqual(2, response.context['metric_value'])
+
+        response = c.post(f'/profile/{user.id}/', {'user_id': user.id, 'metrics': 'lines', 'time': '365'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(3, response.context['metric_value'])
+        Metric.objects.create(name='untracked', string_representation='Untracked')
+        response = c.post(f'/profile/{user.id}/', {'user_id': user.id, 'metrics': 'untracked', 'time': 'all'})
+        self.assertEqual(0, response.context['metric_value'])
+
+
+class FeedMessageListViewTest(TestCase):
+    def test_team_events_are_paginated_with_messages(self):
+        user = User.objects.create_user(username='testuser', password='12345')
+        team = Team.objects.create(name='team')
+        team.users.add(user)
+        now = timezone.now()
+        for i in range(10):
+            FeedMessage.objects.create(sender='metric', receiver=user, msg_content=f'message {i}',
+                                       created_at=now - timedelta(minutes=2 * i))
+            TeamEvent.objects.create(team=team, sender='team', msg_content=f'event {i}',
+                                     created_at=now - timedelta(minutes=2 * i + 1))
+        c = Client()
+        c.login(username='testuser', password='12345')
+
+        response = c.get('/feed')
+        self.assertEqual(response.status_code, 200)
+        messages = response.context['feed_messages']
+        self.assertEqual(15, len(messages))
+        self.assertEqual(['message 0', 'event 0', 'message 1'], [m.msg_content for m in messages[:3]])
+        self.assertIsNone(response.context['previous_cursor'])
+
+        response = c.get('/feed', {'after': response.context['next_cursor']})
+        self.assertEqual(5, len(response.context['feed_messages']))
+        self.assertIsNone(response.context['next_cursor'])
+        response = c.get('/feed', {'before': response.context['previous_cursor']})
+        self.assertEqual(15, len(response.context['feed_messages']))
+        self.assertEqual(404, c.get('/feed', {'after': 'broken'}).status_code)
@@ -1,15 +1,12 @@
 import json
-from datetime import datetime, timedelta
+from datetime import timedelta
 
+import numpy as np
 import pandas as pd
 from django.apps import apps
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
-from django.contrib.postgres.fields.jsonb import KeyTextTransform
-from django.db import models
-from django.db.models import Sum
-from django.db.models.functions import Cast
 from django.forms import formset_factory
 from django.http import HttpResponseNotFound, Http404
 from django.shortcuts import redirect, render, HttpResponse
@@ -19,6 +16,10 @@ from django.views.generic import ListView, DetailView
 from plotly.graph_objs import Scatter
 from plotly.offline import plot
 
+from users.catalog import metric_catalog
+from users.models import aggregate_metric_all_time, aggregate_metric_within_delta, profile_summary
+from users.notifications import UserFeed, notify, notify_team, team_member_ids, track_metrics
+from users.statistics import leaderboard, team_statistics, time_series
 from .forms import *
 
 # Getting models
@@ -38,68 +39,14 @@ PERIODS_DICT = {
     "1": 'Day',
 }
 
-
-def extract_metric(filtered, metric):
-    """
-    Returns the sum of metric values.
-
-            Parameters:
-                    filtered: Filtered statistic notes
-                    metric: Target metric
-
-            Returns:
-                    Sum of metric values
-    """
-    return filtered.annotate(metric_value=Cast(KeyTextTransform(metric, 'metrics'), models.IntegerField())).aggregate(
-        Sum('metric_value'))['metric_value__sum']
-
-
-def aggregate_metric_all_time(user, metric):
-    """
-    Returns the sum of metric values collected over the all time for the given user.
-
-            Parameters:
-                    user: Target user
-                    metric: Target metric
-
-            Returns:
-                    Sum of metric values of the given user
-    """
-    s = extract_metric(UserStat.objects.filter(user=user), metric)
-    return s if s else 0
-
-
-def aggregate_metric_within_delta(user, metric, delta):
-    """
-    Returns the sum of metric values collected from given time point to the current time for the given user.
-
-            Parameters:
-                    user: Target user
-                    metric: Target metric
-                    delta: Time delta
-
-            Returns:
-                    Sum of metric values of the given user within required time interval
-    """
-    s = extract_metric(UserStat.objects.filter(user=user, time_from__gte=datetime.now() - delta), metric)
-    return s if s else 0
-
-
-def aggregate_metric_within_interval(user, metric, left, right):
-    """
-    Returns the sum of metric values collected within given time time for the given user.
-
-            Parameters:
-                    user: Target user
-                    metric: Target metric
-                    left: Left bound
-                    right: Right bound
-
-            Returns:
-                    Sum of metric values of the given user within required time interval
-    """
-    s = extract_metric(UserStat.objects.filter(user=user, time_from__gte=left, time_from__lte=right), metric)
-    return s if s else 0
+# Mapping time interval to the field of the profile summary
+PERIOD_SUMMARY_FIELDS = {
+    'all': 'all_time',
+    "365": 'year',
+    "30": 'month',
+    "7": 'week',
+    "1": 'day',
+}
 
 
 def get_team_metrics(team):
@@ -113,10 +60,8 @@ def get_team_metrics(team):
                 Dictionary of tracked metrics, key -- metric name, value -- metric string representation for the
             interface
     """
-    return dict({'lines': 'Lines of code'}, **{
-        name: str(team.tracked_metrics.get(name=name)) for name in
-        team.tracked_metrics.all().values_list('name', flat=True)
-    })
+    return dict({'lines': 'Lines of code'},
+                **metric_catalog.display_names(team.tracked_metrics.values_list('name', flat=True)))
 
 
 def get_user_metrics(user):
@@ -162,10 +107,13 @@ class ProfileListView(ListView):
         Name of user profile object used within template
     template_name :
         Path to the template
+    paginate_by :
+        Number of users on the page
     """
     model = User
     context_object_name = 'users'
     template_name = 'application/profile_list.html'
+    paginate_by = 20
 
     def get_queryset(self):
         """
@@ -174,7 +122,7 @@ class ProfileListView(ListView):
                 Returns:
                      Query set with users sorted by number of lines of code the have written
         """
-        return sorted(User.objects.all(), key=lambda x: -x.profile.stats_for_all_time)
+        return leaderboard('lines')
 
 
 def get_all_metrics_dict():
@@ -185,9 +133,7 @@ def get_all_metrics_dict():
                     Dictionary of all metrics, key -- metric name, value -- metric string representation for the
             interface
     """
-    return dict({'lines': 'Lines of code'}, **{
-        name: str(Metric.objects.get(name=name)) for name in Metric.objects.all().values_list('name', flat=True)
-    })
+    return dict({'lines': 'Lines of code'}, **metric_catalog.names())
 
 
 def update_achievements(user):
@@ -230,6 +176,45 @@ class UserDetailView(DetailView):
         context['finished_achievements'] = user.finished_achievements.all()
         return context
 
+    @staticmethod
+    def add_summary(user, context):
+        """
+        Modifies context with sums of tracked metrics within all time periods
+
+                Parameters:
+                        user: Target user
+                        context: Context to modify
+                Returns:
+                        Modified context
+        """
+        summary = profile_summary(user, list(context['metrics']))
+        context['metric_summary'] = summary
+        context['summary'] = {text: summary[name] for name, text in context['metrics'].items()}
+        return context
+
+    @staticmethod
+    def add_metric_value(user, metric, interval, context):
+        """
+        Modifies context with the sum of the metric within the time period, taken from the summary if the metric is
+        tracked
+
+                Parameters:
+                        user: Target user
+                        metric: Target metric
+                        interval: Time period from PERIODS_DICT
+                        context: Context with the summary to modify
+                Returns:
+                        Modified context
+        """
+        summary = context['metric_summary'].get(metric)
+        if summary is not None and interval in PERIOD_SUMMARY_FIELDS:
+            context['metric_value'] = getattr(summary, PERIOD_SUMMARY_FIELDS[interval])
+        elif interval == 'all':
+            context['metric_value'] = aggregate_metric_all_time(user, metric)
+        else:
+            context['metric_value'] = aggregate_metric_within_delta(user, metric, timedelta(days=int(interval)))
+        return context
+
     def get_context_data(self, **kwargs):
         """
         Fills request context
@@ -239,12 +224,12 @@ class UserDetailView(DetailView):
         """
         context = super().get_context_data(**kwargs)
         context = self.add_metrics_options(self.object, context)
+        context = self.add_summary(self.object, context)
         context['metric_text'] = 'Lines of code'
-        context['metric_value'] = aggregate_metric_within_delta(self.object, 'lines', timedelta(days=int(30)))
+        context = self.add_metric_value(self.object, 'lines', '30', context)
         context['default_period'] = '30'
         context['default_metric'] = 'lines'
-        context['default_metric_text'] = 'Lines of code' if context['default_metric'] == 'lines' else str(
-            Metric.objects.get(name=context['default_metric']))
+        context['default_metric_text'] = 'Lines of code'
         context['achievement_l'] = Achievement.objects.all().filter(
             id__in=self.request.user.unfinished_achievements.all())
         context = self.add_finished_achievements(self.request.user, context)
@@ -261,9 +246,9 @@ class UserDetailView(DetailView):
         context['metrics'] = user.profile.get_metrics()
         context['metrics_l'] = dict(context['metrics'])
         del context['metrics_l']['lines']
-        untracked_qs = Metric.objects.exclude(name__in=list(context['metrics_l'].keys()))
         context['untracked'] = {
-            name: str(untracked_qs.get(name=name)) for name in untracked_qs.values_list('name', flat=True)
+            name: display_name for name, display_name in metric_catalog.names().items()
+            if name not in context['metrics_l']
         }
         context['periods'] = PERIODS_DICT
         return context
@@ -286,11 +271,6 @@ class UserDetailView(DetailView):
         user = request.POST.get('user_id', None)
         context = {'object': User.objects.get(pk=user)}
 
-        if interval == 'all':
-            context['metric_value'] = aggregate_metric_all_time(user, metric)
-        else:
-            context['metric_value'] = aggregate_metric_within_delta(user, metric, timedelta(days=int(interval)))
-
         query = request.POST.get('query', None)
         if query == 'add_metric' and request.POST.get('metrics_add', None):
             context['object'].profile.add_metric(request.POST['metrics_add'])
@@ -301,13 +281,15 @@ class UserDetailView(DetailView):
             achievement.assigned_users.remove(user)
 
         context = self.add_metrics_options(context['object'], context)
-        context['metric_text'] = 'Lines of code' if metric == 'lines' else str(Metric.objects.get(name=metric))
+        context = self.add_summary(context['object'], context)
+        context = self.add_metric_value(context['object'], metric, interval, context)
+        context['metric_text'] = 'Lines of code' if metric == 'lines' else \
+            metric_catalog.display_names([metric]).get(metric, metric)
 
         context['default_period'] = request.POST.get('time', '30')
         context['default_metric'] = request.POST.get('metrics', 'lines')
         context['achievement_l'] = Achievement.objects.all().filter(id__in=request.user.unfinished_achievements.all())
-        context['default_metric_text'] = 'Lines of code' if context['default_metric'] == 'lines' else str(
-            Metric.objects.get(name=context['default_metric']))
+        context['default_metric_text'] = context['metric_text']
         context = self.add_finished_achievements(self.request.user, context)
         return render(request, 'application/profile_detail.html', context)
 
@@ -390,21 +372,19 @@ class TeamDetailView(DetailView):
         return context
 
     @staticmethod
-    def add_users_sats(team, metric_getter, context):
+    def add_users_sats(team, metric, delta, context):
         """
         Modifies context with data about team members metrics
 
                 Parameters:
                         team: Target team
-                        metric_getter: Method to gain metric
+                        metric: Target metric
+                        delta: Time delta of the period, all time if None
                         context: Context to modify
                 Returns:
                         Modified context
         """
-        users = team.admins.all() | team.users.all()
-        context['dict'] = {}
-        for user in users:
-            context['dict'][user.username] = metric_getter(user)
+        context['dict'] = team_statistics(team, metric, delta)
         return context
 
     @staticmethod
@@ -421,38 +401,23 @@ class TeamDetailView(DetailView):
         """
         plots = []
         team = context['object']
+        users = list((team.admins.all() | team.users.all()).distinct())
 
-        for user in team.admins.all() | team.users.all():
-            if interval != 1:
-                date_data = [(datetime.now() - timedelta(days=int(i))).date() for i in range(interval)]
-                date_y = [aggregate_metric_within_interval(user,
-                                                           metric,
-                                                           datetime.now() - timedelta(days=i),
-                                                           datetime.now() - timedelta(days=i - 1))
-                          for i in range(1, interval + 1)]
-            else:
-                date_data = [(datetime.now() - timedelta(hours=int(i))) for i in range(24)]
-                date_y = [aggregate_metric_within_interval(user,
-                                                           metric,
-                                                           datetime.now() - timedelta(hours=i),
-                                                           datetime.now() - timedelta(hours=i - 1))
-                          for i in range(1, 25)]
+        if interval != 1:
+            series = time_series(users, metric, interval)
+        else:
+            series = time_series(users, metric, 24, hourly=True)
+        date_data = series.index
 
+        for user in users:
             name = user.first_name + " " + user.last_name if user.first_name or user.last_name else user.username
-            fig = Scatter(x=date_data, y=date_y,
+            fig = Scatter(x=date_data, y=series[user.id].to_numpy(),
                           mode='lines', name=name,
                           opacity=0.5,
                           )
             plots.append(fig)
 
-        if interval != 1:
-            date_data = [(datetime.now() - timedelta(days=int(i))).date() for i in range(interval)]
-            date_y = [context['threshold'] for _ in range(1, interval + 1)]
-        else:
-            date_data = [(datetime.now() - timedelta(hours=int(i))) for i in range(24)]
-            date_y = [context['threshold'] for _ in range(1, 25)]
-
-        fig = Scatter(x=date_data, y=date_y,
+        fig = Scatter(x=date_data, y=np.full(len(date_data), context['threshold']),
                       mode='lines', name="THRESHOLD",
                       opacity=1, marker_color='red'
                       )
@@ -479,9 +444,7 @@ class TeamDetailView(DetailView):
         context = super().get_context_data(**kwargs)
         context = self.add_metrics_options(self.object, context)
         context = self.add_is_admin(self.object, context)
-        context = self.add_users_sats(self.object,
-                                      lambda u: aggregate_metric_within_delta(u, 'lines', timedelta(days=int(30))),
-                                      context)
+        context = self.add_users_sats(self.object, 'lines', timedelta(days=int(30)), context)
         context['object'] = self.object
         context['default_period'] = '30'
         context['default_metric'] = 'lines'
@@ -511,11 +474,8 @@ class TeamDetailView(DetailView):
         context = self.add_metrics_options(team, context)
         context = self.add_is_admin(team, context)
 
-        if interval == 'all':
-            extracter = lambda u: aggregate_metric_all_time(u, metric)
-        else:
-            extracter = lambda u: aggregate_metric_within_delta(u, metric, timedelta(days=int(interval)))
-        context = self.add_users_sats(team, extracter, context)
+        delta = None if interval == 'all' else timedelta(days=int(interval))
+        context = self.add_users_sats(team, metric, delta, context)
 
         context['object'] = team
         context['default_period'] = request.POST.get('time', 'all')
@@ -556,10 +516,8 @@ class TeamDetailView(DetailView):
                 user = User.objects.get(pk=request.POST['target_user_id'])
                 FeedMessage(sender=team.name, receiver=user,
                             msg_content=f"You are now admin of \"{team.name}\" team", created_at=timezone.now()).save()
-                for admin in team.admins.all():
-                    FeedMessage(sender=team.name, receiver=admin,
-                                msg_content=f"{user.username} is now an admin of \"{team.name}\" team",
-                                created_at=timezone.now()).save()
+                notify(team.name, team.admins.values_list('id', flat=True),
+                       f"{user.username} is now an admin of \"{team.name}\" team")
                 team.users.remove(user)
                 team.admins.add(user)
             elif query == 'remove':
@@ -568,34 +526,25 @@ class TeamDetailView(DetailView):
                 FeedMessage(sender=team.name, receiver=user,
                             msg_content=f"You have been removed from \"{team.name}\" team",
                             created_at=timezone.now()).save()
-                for admin in team.admins.all():
-                    FeedMessage(sender=team.name, receiver=admin,
-                                msg_content=f"{user.username} was removed from \"{team.name}\" team",
-                                created_at=timezone.now()).save()
+                notify(team.name, team.admins.values_list('id', flat=True),
+                       f"{user.username} was removed from \"{team.name}\" team")
             elif query == 'add_metric' and request.POST.get('metrics_add', None):
                 metric = Metric.objects.get(name=request.POST['metrics_add'])
                 team.tracked_metrics.add(metric)
                 team.save()
-                for u in team.users.all() | team.admins.all():
-                    FeedMessage(sender=team.name, receiver=u,
-                                msg_content=f"{str(metric)} is now tracked in \"{team.name}\" team",
-                                created_at=timezone.now()).save()
-                    u.profile.add_metric(request.POST['metrics_add'])
+                members = team_member_ids(team)
+                notify_team(team, f"{str(metric)} is now tracked in \"{team.name}\" team", members)
+                track_metrics(members, [metric.id])
             elif query == 'rm_metric' and request.POST.get('metrics_rm', None):
                 metric = Metric.objects.get(name=request.POST['metrics_rm'])
                 team.tracked_metrics.remove(metric)
                 team.save()
-                for u in team.users.all() | team.admins.all():
-                    FeedMessage(sender=team.name, receiver=u,
-                                msg_content=f"{str(metric)} is not tracked anymore in \"{team.name}\" team",
-                                created_at=timezone.now()).save()
+                notify_team(team, f"{str(metric)} is not tracked anymore in \"{team.name}\" team")
 
         context = TeamDetailView.add_metrics_options(team, context)
         del context['metrics']['lines']
-        untracked_qs = Metric.objects.exclude(name__in=list(context['metrics'].keys()))
-        context['untracked'] = {
-            name: str(untracked_qs.get(name=name)) for name in untracked_qs.values_list('name', flat=True)
-        }
+        context['untracked'] = {name: display_name for name, display_name in metric_catalog.names().items()
+                                if name not in context['metrics']}
 
         return render(request, 'application/team_administration.html', context)
 
@@ -663,16 +612,11 @@ def join_team(request):
             FeedMessage(sender=team.name, receiver=request.user, msg_content=f"You have joined \"{team.name}\" team",
                         created_at=timezone.now()) \
                 .save()
-            for admin in team.admins.all():
-                FeedMessage(sender=team.name, receiver=admin,
-                            msg_content=f"{request.user.username} joined \"{team.name}\" team",
-                            created_at=timezone.now()) \
-                    .save()
+            notify(team.name, team.admins.values_list('id', flat=True),
+                   f"{request.user.username} joined \"{team.name}\" team")
             messages.success(request, f'You joined to \"{team.name}\" team')
 
-            for tm in team.get_team_metrics():
-                if tm != 'lines':
-                    request.user.profile.add_metric(tm)
+            track_metrics([request.user.id], team.tracked_metrics.values_list('id', flat=True))
 
             return redirect('app-teams')
     else:
@@ -714,7 +658,7 @@ def team_to_csv(request, pk):
 
 class FeedMessageListView(ListView):
     """
-    User feed view
+    User feed view, paginated with cursors given in 'after' or 'before' parameters
 
     Attributes
     ----------
@@ -724,22 +668,30 @@ class FeedMessageListView(ListView):
         Name of user profile object used within template
     template_name :
         Path to the template
-    ordering :
-        Order to list objects
     """
     model = FeedMessage
     context_object_name = 'feed_messages'
     template_name = 'application/feed.html'
-    paginate_by = 15
 
     def get_queryset(self):
         """
         Form the query set for request
 
                 Returns:
-                     Query set with users sorted by number of lines of code the have written
+                     Messages of the requested page, newest first
         """
-        return FeedMessage.objects.filter(receiver=self.request.user).order_by('-created_at', '-created_at__second')
+        try:
+            feed_messages, self.previous_cursor, self.next_cursor = UserFeed(self.request.user).page(
+                after=self.request.GET.get('after'), before=self.request.GET.get('before'))
+        except ValueError:
+            raise Http404('Invalid cursor')
+        return feed_messages
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['previous_cursor'] = self.previous_cursor
+        context['next_cursor'] = self.next_cursor
+        return context
 
 
 @login_required
@@ -1036,8 +988,9 @@ class AchievementDetailView(DetailView):
 
     @staticmethod
     def add_achievement_goals_to_context(achievement, context):
+        display_names = metric_catalog.display_names(name for name in achievement.metric_to_goal if name != 'lines')
         context['metric_to_goal'] = {
-            'Lines of code written' if name == 'lines' else str(Metric.objects.get(name=name)):
+            'Lines of code written' if name == 'lines' else display_names.get(name, name):
                 achievement.metric_to_goal[name] for name in
             achievement.metric_to_goal
         }
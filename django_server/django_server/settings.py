@@ -88,6 +88,19 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/3.1/ref/settings/#caches
+# Metric catalog version and plugin configurations must be shared by all server processes, create the table with
+# 'manage.py createcachetable'
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'django_cache',
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
 
@@ -133,3 +146,20 @@ CRISPY_TEMPLATE_PACK = 'bootstrap4'
 
 LOGIN_REDIRECT_URL = 'app-home'
 LOGIN_URL = 'login'
+
+
+# Plugin statistics ingestion
+# 'sync' saves notes within the request, 'spool' appends them to the local spool drained by 'manage.py flush_spool'
+
+PLUGIN_INGESTION_MODE = 'sync'
+PLUGIN_SPOOL_PATH = os.path.join(BASE_DIR, 'ingestion_spool.sqlite3')
+PLUGIN_SPOOL_MAX_NOTES = 1000000
+
+
+# Plugin rate limiting
+# 'local' keeps token buckets in every worker process, 'cache' shares them between workers through CACHES
+
+PLUGIN_RATE_LIMIT_BACKEND = 'local'
+# request threads of every worker process, e.g. gunicorn --threads; ingestion may take at most
+# INGESTION_MAX_THREAD_SHARE of them, the rest stay free for the dashboard
+PLUGIN_WORKER_THREADS = 8
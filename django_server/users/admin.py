@@ -14,3 +14,7 @@ admin.site.register(SpecificLengthCopyCounterMetric)
 admin.site.register(SpecificLengthPasteCounterMetric)
 admin.site.register(Achievement)
 admin.site.register(FeedMessage)
+admin.site.register(TeamEvent)
+admin.site.register(MetricValue)
+admin.site.register(DailyMetricValue)
+admin.site.register(HourlyMetricValue)
@@ -0,0 +1,292 @@
+import asyncio
+import functools
+import weakref
+
+from asgiref.sync import sync_to_async
+from django.db import Error, close_old_connections
+from django.http import HttpResponse, HttpResponseNotFound, JsonResponse
+
+from .config import *
+from .ingestion import NoteValidationError, build_note, decode_body, decode_metric_ids, parse_batch, validate_batch
+from .flowcontrol import control_async, flush_controlled
+from .ratelimit import check_rate_limit_async, client_ip, shed_load
+from .spool import SpoolFullError, store_notes
+from .tokens import get_user_id
+from .plugin_config import config_version, config_versions, metrics_config
+from .views import (all_metrics_dict, batch_stored_response, bootstrap_response, notes_stored_response, plugin_token,
+                    spool_full_response)
+
+# Plugin API views for ASGI deployments. Requests are parsed and validated on the event loop, database and cache work
+# runs in worker threads, database work at most ASYNC_DB_CONCURRENCY calls at once per event loop.
+
+_db_semaphores = weakref.WeakKeyDictionary()
+_config_watchers = weakref.WeakKeyDictionary()
+_in_flight = 0
+
+
+def db_semaphore():
+    loop = asyncio.get_running_loop()
+    if loop not in _db_semaphores:
+        _db_semaphores[loop] = asyncio.Semaphore(ASYNC_DB_CONCURRENCY)
+    return _db_semaphores[loop]
+
+
+async def run_db(func, *args):
+    """
+    Runs blocking database work in a worker thread.
+
+            Parameters:
+                    func: Function to run
+                    args: Arguments of the function
+
+            Returns:
+                    Result of the function
+    """
+    def call():
+        try:
+            return func(*args)
+        finally:
+            # worker threads do not receive request_finished, so their connections are closed here
+            close_old_connections()
+
+    async with db_semaphore():
+        return await sync_to_async(call, thread_sensitive=False)()
+
+
+class ConfigWatcher:
+    """
+    Waits for changes of plugin configuration versions. Versions of all waiting users are read with one query every
+    CONFIG_POLL_INTERVAL_SECONDS, however many plugins are waiting.
+    """
+
+    def __init__(self):
+        self._waiters = {}
+        self._task = None
+
+    async def wait(self, user_id, version, timeout):
+        """
+        Waits until configuration version of the user becomes greater than the given one.
+
+                Parameters:
+                        user_id: Id of the user
+                        version: Configuration version known to the plugin
+                        timeout: Maximal number of seconds to wait
+
+                Returns:
+                        New configuration version, None if it did not change in time
+        """
+        waiter = (version, asyncio.get_running_loop().create_future())
+        self._waiters.setdefault(user_id, []).append(waiter)
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._poll())
+        try:
+            return await asyncio.wait_for(waiter[1], timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            waiters = self._waiters[user_id]
+            waiters.remove(waiter)
+            if not waiters:
+                del self._waiters[user_id]
+
+    async def _poll(self):
+        while self._waiters:
+            await asyncio.sleep(CONFIG_POLL_INTERVAL_SECONDS)
+            if not self._waiters:
+                break
+            try:
+                versions = await run_db(config_versions, list(self._waiters))
+            except Error:
+                # waiters are woken by one of the next polls or time out
+                continue
+            for user_id, current in versions.items():
+                for version, future in self._waiters.get(user_id, ()):
+                    if current > version and not future.done():
+                        future.set_result(current)
+
+
+def config_watcher():
+    loop = asyncio.get_running_loop()
+    if loop not in _config_watchers:
+        _config_watchers[loop] = ConfigWatcher()
+    return _config_watchers[loop]
+
+
+def plugin_view(view):
+    """
+    Makes async view exempt from CSRF checks and rejects requests above ASYNC_MAX_IN_FLIGHT_REQUESTS.
+    """
+    @functools.wraps(view)
+    async def wrapped(request, *args, **kwargs):
+        global _in_flight
+        if _in_flight >= ASYNC_MAX_IN_FLIGHT_REQUESTS:
+            response = HttpResponse('Too many requests are being processed', status=503)
+            response['Retry-After'] = ASYNC_RETRY_AFTER_SECONDS
+            return response
+        _in_flight += 1
+        try:
+            return await view(request, *args, **kwargs)
+        finally:
+            _in_flight -= 1
+
+    # django.views.decorators.csrf.csrf_exempt wraps views into sync functions
+    wrapped.csrf_exempt = True
+    return wrapped
+
+
+def parse_data(request, *fields):
+    data = decode_body(request)
+    if not isinstance(data, dict):
+        raise NoteValidationError('Received data must be an object')
+    missing = [field for field in fields if field not in data]
+    if missing:
+        raise NoteValidationError(f"{', '.join(repr(field) for field in missing)} are not in received data")
+    return data
+
+
+def resolve_notes(token, notes):
+    decode_metric_ids(notes)
+    return get_user_id(token)
+
+
+@plugin_view
+@flush_controlled
+@shed_load
+async def receive_data(request):
+    if request.method == 'GET':
+        return HttpResponseNotFound()
+
+    try:
+        data = parse_data(request, 'token', 'time_from', 'time_to')
+    except NoteValidationError as e:
+        return HttpResponseNotFound(str(e))
+    limited = await check_rate_limit_async('ingest', data['token'])
+    if limited:
+        return limited
+
+    user_id = await run_db(resolve_notes, data['token'], [data])
+    try:
+        stat = build_note(data, user_id)
+    except NoteValidationError as e:
+        return HttpResponseNotFound(str(e))
+    try:
+        spooled = await run_db(store_notes, [stat])
+    except SpoolFullError as e:
+        return spool_full_response(e)
+
+    return notes_stored_response(spooled)
+
+
+@plugin_view
+@flush_controlled
+@shed_load
+async def receive_batch(request):
+    if request.method == 'GET':
+        return HttpResponseNotFound()
+
+    try:
+        token, notes, batch_id = parse_batch(request)
+    except NoteValidationError as e:
+        return HttpResponseNotFound(str(e))
+    limited = await check_rate_limit_async('ingest', token)
+    if limited:
+        return limited
+
+    user_id = await run_db(resolve_notes, token, notes)
+    statuses, stats = validate_batch(notes, user_id, batch_id)
+    try:
+        spooled = await run_db(store_notes, stats)
+    except SpoolFullError as e:
+        return spool_full_response(e)
+
+    return batch_stored_response(statuses, spooled, await control_async())
+
+
+@plugin_view
+async def plugin_login(request):
+    if request.method == 'GET':
+        return HttpResponseNotFound()
+
+    try:
+        data = parse_data(request, 'username', 'password')
+    except NoteValidationError as e:
+        return HttpResponseNotFound(str(e))
+    limited = await check_rate_limit_async('login', client_ip(request))
+    if limited:
+        return limited
+
+    token = await run_db(plugin_token, data['username'], data['password'])
+    if token is None:
+        return HttpResponse('Invalid password', status=401)
+
+    return JsonResponse({"token": token})
+
+
+@plugin_view
+async def all_metrics(request):
+    limited = await check_rate_limit_async('metrics', client_ip(request))
+    if limited:
+        return limited
+    return JsonResponse(await run_db(all_metrics_dict))
+
+
+@plugin_view
+async def user_metrics(request):
+    if request.method == 'GET':
+        return HttpResponseNotFound()
+
+    try:
+        data = parse_data(request, 'token')
+    except NoteValidationError as e:
+        return HttpResponseNotFound(str(e))
+    limited = await check_rate_limit_async('metrics', data['token'])
+    if limited:
+        return limited
+
+    user_id = await run_db(get_user_id, data['token'])
+    _, config, version = await run_db(metrics_config, user_id)
+    return JsonResponse(dict(config, **{FLUSH_CONTROL: await control_async(), CONFIG_VERSION: version}))
+
+
+@plugin_view
+async def plugin_bootstrap(request):
+    if request.method == 'GET':
+        return HttpResponseNotFound()
+
+    try:
+        data = parse_data(request)
+    except NoteValidationError as e:
+        return HttpResponseNotFound(str(e))
+
+    return await run_db(bootstrap_response, request, data)
+
+
+@plugin_view
+async def config_changes(request):
+    """
+    Waits until version of the plugin configuration becomes greater than 'version' sent by the plugin, at most
+    CONFIG_POLL_TIMEOUT_SECONDS. Responds with the new version and configuration, or with 'changed' set to false if the
+    version did not change in time. Versions of all plugins waiting on the event loop are read from the database
+    together by ConfigWatcher, so changes made by other processes are seen as well.
+    """
+    if request.method == 'GET':
+        return HttpResponseNotFound()
+
+    try:
+        data = parse_data(request, 'token', 'version')
+    except NoteValidationError as e:
+        return HttpResponseNotFound(str(e))
+    if isinstance(data['version'], bool) or not isinstance(data['version'], int):
+        return HttpResponseNotFound("'version' is not an integer")
+    limited = await check_rate_limit_async('metrics', data['token'])
+    if limited:
+        return limited
+
+    user_id = await run_db(get_user_id, data['token'])
+    version = await run_db(config_version, user_id)
+    if version <= data['version']:
+        changed = await config_watcher().wait(user_id, data['version'], CONFIG_POLL_TIMEOUT_SECONDS)
+        if changed is None:
+            return JsonResponse({'changed': False, 'config_version': version})
+    _, config, version = await run_db(metrics_config, user_id)
+    return JsonResponse({'changed': True, 'config_version': version, 'metrics': config})
@@ -0,0 +1,98 @@
+import threading
+import time
+import uuid
+
+from django.apps import apps
+from django.core.cache import cache
+
+from .config import *
+
+
+class MetricCatalog:
+    """
+    Names and display names of all metrics, loaded once per process
+
+    Every process keeps its own copy together with the version stamp it was loaded at. The current stamp is kept in
+    Django cache and replaced whenever any metric changes, so copies of all processes sharing the cache are reloaded.
+    The stamp is read from the cache at most once per METRIC_CATALOG_CHECK_SECONDS and expires after
+    METRIC_CATALOG_VERSION_TIMEOUT. Names missing in the copy are reloaded at once, but only once per stamp.
+
+    Attributes:
+    ----------
+    loads :
+        Number of catalog loads from the database
+    """
+
+    def __init__(self):
+        self.loads = 0
+        self._version = None
+        self._names = {}
+        self._missing = set()
+        self._current = None
+        self._checked = None
+        self._lock = threading.Lock()
+
+    def current_version(self):
+        now = time.monotonic()
+        if self._checked is not None and now - self._checked < METRIC_CATALOG_CHECK_SECONDS:
+            return self._current
+        version = cache.get(METRIC_CATALOG_VERSION_KEY)
+        if version is None:
+            cache.add(METRIC_CATALOG_VERSION_KEY, uuid.uuid4().hex, METRIC_CATALOG_VERSION_TIMEOUT)
+            version = cache.get(METRIC_CATALOG_VERSION_KEY)
+        self._current, self._checked = version, now
+        return version
+
+    def names(self, reload=False):
+        """
+        Returns display names of all metrics.
+
+                Parameters:
+                        reload: Whether the catalog is loaded from the database even if its version did not change
+
+                Returns:
+                        Dictionary of metrics ordered by creation, key -- metric name, value -- metric string
+                        representation for the interface
+        """
+        version = self.current_version()
+        with self._lock:
+            if reload or version != self._version:
+                if version != self._version:
+                    self._missing = set()
+                Metric = apps.get_model('users', 'Metric')
+                self._names = dict(Metric.objects.order_by('id').values_list('name', 'display_name'))
+                self._version = version
+                self.loads += 1
+            return self._names
+
+    def display_names(self, names):
+        """
+        Returns display names of the given metrics. The catalog is reloaded if some of them are missing, names still
+        missing after that are not reloaded again until the version changes.
+
+                Parameters:
+                        names: Metric names
+
+                Returns:
+                        Dictionary of the metrics, key -- metric name, value -- metric string representation for the
+                        interface
+        """
+        names = set(names)
+        catalog = self.names()
+        missing = names - catalog.keys() - self._missing
+        if missing:
+            catalog = self.names(reload=True)
+            with self._lock:
+                self._missing |= missing - catalog.keys()
+        return {name: display_name for name, display_name in catalog.items() if name in names}
+
+    def invalidate(self):
+        """
+        Makes all processes reload the catalog on the next use.
+        """
+        cache.set(METRIC_CATALOG_VERSION_KEY, uuid.uuid4().hex, METRIC_CATALOG_VERSION_TIMEOUT)
+        # this process sees the new stamp at once
+        self._checked = None
+
+
+metric_catalog = MetricCatalog()
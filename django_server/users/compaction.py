@@ -0,0 +1,157 @@
+from datetime import datetime
+
+import pytz
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .config import *
+from .ingestion import prune_ingestion_keys
+from .models import MetricValue, UserStat
+from .rollups import prune_hourly_rollups
+
+utc = pytz.UTC
+
+# Monday, so that weekly buckets start on Mondays
+BUCKETS_EPOCH = datetime(1970, 1, 5, tzinfo=utc)
+
+
+def bucket_start(moment, size):
+    """
+    Returns the beginning of the bucket the moment belongs to.
+
+            Parameters:
+                    moment: Time point
+                    size: Bucket size
+
+            Returns:
+                    Beginning of the bucket
+    """
+    return BUCKETS_EPOCH + ((moment - BUCKETS_EPOCH) // size) * size
+
+
+def tier_filter(now, age, size):
+    """
+    Returns filter of notes which should be rolled up within the tier.
+
+            Parameters:
+                    now: Current time
+                    age: Age of notes to roll up
+                    size: Bucket size of the tier
+
+            Returns:
+                    Q object selecting notes older than the last complete bucket and finer than the tier
+    """
+    return Q(time_from__lt=bucket_start(now - age, size), resolution__lt=size.total_seconds())
+
+
+def downsample_tier(user, now, age, size):
+    """
+    Rolls user notes older than the given age up into buckets of the given size.
+
+    Notes of the same bucket are replaced with a single note holding metrics sums, so totals per bucket are kept.
+
+            Parameters:
+                    user: Target user
+                    now: Current time
+                    age: Age of notes to roll up
+                    size: Bucket size
+
+            Returns:
+                    Number of removed notes
+    """
+    resolution = int(size.total_seconds())
+    with transaction.atomic():
+        notes = UserStat.objects.filter(tier_filter(now, age, size), user=user)
+        buckets = {}
+        ids = []
+        for note_id, time_from, metrics in notes.values_list('id', 'time_from', 'metrics').iterator():
+            bucket = buckets.setdefault(bucket_start(time_from, size), {})
+            for name, value in metrics.items():
+                bucket[name] = bucket.get(name, 0) + int(value)
+            ids.append(note_id)
+        if not ids:
+            return 0
+
+        # notes which came late to the buckets rolled up before are merged into them
+        for note_id, time_from, metrics in UserStat.objects.filter(
+                user=user, resolution=resolution, time_from__in=list(buckets)
+        ).values_list('id', 'time_from', 'metrics'):
+            bucket = buckets[time_from]
+            for name, value in metrics.items():
+                bucket[name] = bucket.get(name, 0) + int(value)
+            ids.append(note_id)
+
+        stats = [
+            UserStat(user=user, metrics=metrics, time_from=start, time_to=start + size, resolution=resolution)
+            for start, metrics in buckets.items()
+        ]
+        UserStat.objects.bulk_create(stats, batch_size=BULK_CREATE_BATCH_SIZE)
+        for i in range(0, len(ids), DELETE_CHUNK_SIZE):
+            UserStat.objects.filter(pk__in=ids[i:i + DELETE_CHUNK_SIZE]).delete()
+
+        # metric values are replaced the same way as the notes they were written with
+        values = MetricValue.objects.filter(
+            Q(tier_filter(now, age, size)) | Q(resolution=resolution, time_from__in=list(buckets)), user=user
+        )
+        value_ids = list(values.values_list('id', flat=True))
+        for i in range(0, len(value_ids), DELETE_CHUNK_SIZE):
+            MetricValue.objects.filter(pk__in=value_ids[i:i + DELETE_CHUNK_SIZE]).delete()
+        MetricValue.objects.bulk_create(MetricValue.for_stats(stats), batch_size=BULK_CREATE_BATCH_SIZE)
+    return len(ids) - len(buckets)
+
+
+def downsample_notes(user, now=None, tiers=DOWNSAMPLING_TIERS):
+    """
+    Rolls user notes up according to the downsampling tiers, from the finest tier to the coarsest one.
+
+            Parameters:
+                    user: Target user
+                    now: Current time
+                    tiers: List of pairs (age of notes, bucket size)
+
+            Returns:
+                    Number of removed notes
+    """
+    now = now or timezone.now()
+    return sum(downsample_tier(user, now, age, size) for age, size in tiers)
+
+
+def users_to_compact(now=None, tiers=DOWNSAMPLING_TIERS):
+    """
+    Returns users who have notes to roll up.
+
+            Parameters:
+                    now: Current time
+                    tiers: List of pairs (age of notes, bucket size)
+
+            Returns:
+                    Query set of users to compact
+    """
+    now = now or timezone.now()
+    condition = Q()
+    for age, size in tiers:
+        condition |= Q(id__in=UserStat.objects.filter(tier_filter(now, age, size)).values('user'))
+    return User.objects.filter(condition)
+
+
+def compact_notes(now=None, tiers=DOWNSAMPLING_TIERS):
+    """
+    Rolls notes of all users up according to the downsampling tiers and removes outdated hourly rollups and
+    idempotency keys.
+
+            Parameters:
+                    now: Current time
+                    tiers: List of pairs (age of notes, bucket size)
+
+            Returns:
+                    Number of compacted users
+    """
+    now = now or timezone.now()
+    users = list(users_to_compact(now, tiers))
+    for user in users:
+        downsample_notes(user, now, tiers)
+    prune_hourly_rollups(now)
+    prune_ingestion_keys(now)
+    return len(users)
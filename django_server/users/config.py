@@ -1,3 +1,5 @@
+from datetime import timedelta
+
 # param metrics
 WORD_COUNTER = "WordCounter"
 SUBSTRING_COUNTER = "SubstringCounter"
@@ -6,6 +8,13 @@ SPECIFIC_BRANCH_COMMIT_COUNTER = "SpecificBranchCommitCounter"
 SPECIFIC_LENGTH_PASTE_COUNTER = "SpecificLengthPasteCounter"
 SPECIFIC_LENGTH_COPY_COUNTER = "SpecificLengthCopyCounter"
 
+# key of the metric ids in the tracked metrics response
+METRIC_IDS = "MetricIds"
+# key of the recommended flush interval and batch size in the tracked metrics response
+FLUSH_CONTROL = "FlushControl"
+# key of the plugin configuration version in the tracked metrics response
+CONFIG_VERSION = "ConfigVersion"
+
 # non param metrics
 MAX_OPENED_PROJECTS = "MaxOpenedProjects"
 PROJECT_OPENS_NUMBER = "ProjectOpensNumber"
@@ -21,3 +30,90 @@ MAX_COPY_LENGTH = "MaxCopyLength"
 TOTAL_TYPED_COUNTER = "TotalTypedCounter"
 DELETED_COUNTER = "DeletedCounter"
 DELETED_LENGTH_COUNTER = "DeletedLengthCounter"
+
+# ingestion
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+MSGPACK_CONTENT_TYPE = "application/msgpack"
+CBOR_CONTENT_TYPE = "application/cbor"
+MAX_DECOMPRESSED_BODY_SIZE = 64 * 1024 * 1024
+IDEMPOTENCY_KEY_MAX_LENGTH = 100
+IDEMPOTENCY_KEY_RETENTION = timedelta(days=7)
+BATCH_MAX_NOTES = 10000
+# room for ':<note index>' appended to the batch id in keys of its notes
+BATCH_ID_MAX_LENGTH = IDEMPOTENCY_KEY_MAX_LENGTH - len(str(BATCH_MAX_NOTES)) - 1
+# bounds of the stored metric values and names
+METRIC_NAME_MAX_LENGTH = 100
+METRIC_VALUE_MIN = -2 ** 63
+METRIC_VALUE_MAX = 2 ** 63 - 1
+BULK_CREATE_BATCH_SIZE = 1000
+
+# compaction
+# (age of notes, bucket size) -- notes older than the age are rolled up into buckets of the size
+DOWNSAMPLING_TIERS = [
+    (timedelta(days=2), timedelta(hours=1)),
+    (timedelta(days=30), timedelta(days=1)),
+    (timedelta(days=365), timedelta(weeks=1)),
+]
+DELETE_CHUNK_SIZE = 1000
+COMPACTION_INTERVAL_SECONDS = 3600
+
+# rollups
+HOURLY_ROLLUP_RETENTION = timedelta(hours=48)
+
+# cached configuration of the metrics tracked by the user, also the longest time a configuration built concurrently
+# with a change of the tracked metrics may be served
+PLUGIN_CONFIG_CACHE_TIMEOUT = 10 * 60
+CONFIG_POLL_TIMEOUT_SECONDS = 25
+CONFIG_POLL_INTERVAL_SECONDS = 1
+
+# cache key of the metric catalog version
+METRIC_CATALOG_VERSION_KEY = 'metric_catalog_version'
+# the catalog is reloaded at least that often even if the version change was missed
+METRIC_CATALOG_VERSION_TIMEOUT = 60
+# the stamp is read from the cache at most that often per process
+METRIC_CATALOG_CHECK_SECONDS = 1
+
+# rows written by a single statement of team events fan-out
+FANOUT_BATCH_SIZE = 1000
+# events of larger teams are stored once and merged into member feeds on read
+FANOUT_ON_WRITE_MAX_MEMBERS = 50
+FEED_PAGE_SIZE = 15
+
+# plugin token cache
+TOKEN_CACHE_SIZE = 10000
+TOKEN_CACHE_TTL = timedelta(minutes=5)
+
+# ingestion spool
+SPOOL_PATH = "ingestion_spool.sqlite3"
+SPOOL_MAX_NOTES = 1000000
+SPOOL_FLUSH_BATCH_SIZE = 5000
+SPOOL_FLUSH_INTERVAL_SECONDS = 1
+SPOOL_RETRY_AFTER_SECONDS = 30
+
+# async plugin API
+ASYNC_DB_CONCURRENCY = 16
+ASYNC_MAX_IN_FLIGHT_REQUESTS = 5000
+ASYNC_RETRY_AFTER_SECONDS = 1
+
+# plugin rate limits, pairs (requests per second, burst) per endpoints group
+RATE_LIMITS = {
+    'ingest': (10, 100),
+    'login': (0.5, 30),
+    'metrics': (1, 30),
+}
+RATE_LIMIT_LOCAL_BUCKETS = 100000
+# concurrently processed ingestion requests, as a share of request threads of a sync worker and per event loop of an
+# async one
+INGESTION_MAX_THREAD_SHARE = 0.5
+INGESTION_MAX_CONCURRENCY = 32
+WORKER_THREADS = 8
+INGESTION_RETRY_AFTER_SECONDS = 1
+
+# flush interval recommended to plugins
+FLUSH_INTERVAL_SECONDS = 60
+FLUSH_INTERVAL_MAX_SECONDS = 900
+FLUSH_CONTROL_MIN_BATCH_SIZE = 100
+FLUSH_CONTROL_TARGET_LATENCY = 0.25
+FLUSH_CONTROL_TARGET_SPOOL_DEPTH = 100000
+FLUSH_CONTROL_REFRESH_SECONDS = 1
+INGEST_LATENCY_EWMA_ALPHA = 0.1
@@ -0,0 +1,125 @@
+import asyncio
+import functools
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+
+from .config import *
+from .spool import get_spool, spool_enabled
+
+
+class FlowControl:
+    """
+    Recommendation for plugins how often and how much statistics to send, computed from the ingestion spool depth and
+    exponentially weighted moving average of ingestion requests latency
+
+    Attributes:
+    ----------
+    latency :
+        Average latency of ingestion requests in seconds, None before the first request
+    """
+
+    def __init__(self):
+        self.latency = None
+        self._lock = threading.Lock()
+        self._control = None
+        self._computed_at = None
+
+    def record(self, seconds):
+        """
+        Adds latency of the ingestion request to the average.
+
+                Parameters:
+                        seconds: Request latency
+        """
+        with self._lock:
+            if self.latency is None:
+                self.latency = seconds
+            else:
+                self.latency += INGEST_LATENCY_EWMA_ALPHA * (seconds - self.latency)
+
+    def load(self):
+        """
+        Returns ingestion load, values above 1 mean the server receives more than it handles comfortably.
+
+                Returns:
+                        Ratio of the average latency or the spool depth to its target, whichever is higher
+        """
+        latency = (self.latency or 0) / FLUSH_CONTROL_TARGET_LATENCY
+        depth = get_spool().depth() / FLUSH_CONTROL_TARGET_SPOOL_DEPTH if spool_enabled() else 0
+        return max(latency, depth)
+
+    def stale(self):
+        return self._computed_at is None or time.monotonic() - self._computed_at >= FLUSH_CONTROL_REFRESH_SECONDS
+
+    def control(self, refresh=True):
+        """
+        Returns recommended flush interval and maximal batch size, recomputed at most every
+        FLUSH_CONTROL_REFRESH_SECONDS.
+
+                Parameters:
+                        refresh: Whether the stale recommendation is recomputed, otherwise it is computed only once
+
+                Returns:
+                        Dictionary with 'flush_interval' in seconds and 'max_batch_size'
+        """
+        now = time.monotonic()
+        if self._control is None or (refresh and self.stale()):
+            load = max(1.0, self.load())
+            self._control = {
+                'flush_interval': min(FLUSH_INTERVAL_MAX_SECONDS, round(FLUSH_INTERVAL_SECONDS * load)),
+                # slow requests are shortened to stay within plugin timeouts
+                'max_batch_size': max(FLUSH_CONTROL_MIN_BATCH_SIZE, int(BATCH_MAX_NOTES / load)),
+            }
+            self._computed_at = now
+        return self._control
+
+    def reset(self):
+        with self._lock:
+            self.latency = None
+            self._computed_at = None
+
+
+flow_control = FlowControl()
+
+
+async def control_async():
+    """
+    Returns flow_control.control() without blocking the event loop. Load of the spool mode is computed with a spool
+    query, so the stale recommendation is recomputed in a worker thread.
+    """
+    if flow_control.stale():
+        return await sync_to_async(flow_control.control, thread_sensitive=False)()
+    return flow_control.control(refresh=False)
+
+
+def add_control_headers(response, control=None):
+    control = control or flow_control.control()
+    response['X-Flush-Interval'] = control['flush_interval']
+    response['X-Max-Batch-Size'] = control['max_batch_size']
+    return response
+
+
+def flush_controlled(view):
+    """
+    Measures latency of the successful ingestion requests and adds the recommended flush interval and batch size to
+    the response headers. Works with both sync and async views.
+    """
+    if asyncio.iscoroutinefunction(view):
+        @functools.wraps(view)
+        async def wrapped(request, *args, **kwargs):
+            start = time.monotonic()
+            response = await view(request, *args, **kwargs)
+            if response.status_code < 300:
+                flow_control.record(time.monotonic() - start)
+            return add_control_headers(response, await control_async())
+    else:
+        @functools.wraps(view)
+        def wrapped(request, *args, **kwargs):
+            start = time.monotonic()
+            response = view(request, *args, **kwargs)
+            if response.status_code < 300:
+                flow_control.record(time.monotonic() - start)
+            return add_control_headers(response)
+    return wrapped
@@ -0,0 +1,329 @@
+import json
+import uuid
+import zlib
+from datetime import datetime
+
+import dateutil.parser
+from django.db import transaction
+from django.utils import timezone
+
+from .config import *
+from .models import IngestionKey, Metric, MetricValue, UserStat
+from .rollups import add_to_rollups
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+# Fields of a received note which are not metrics
+NOTE_SERVICE_FIELDS = ('token', 'time_from', 'time_to', 'idempotency_key')
+
+
+class NoteValidationError(ValueError):
+    """
+    Error raised when received data can not be turned into statistics note
+    """
+
+
+# Number of timestamps parsed by the ISO-8601 fast path and by the dateutil fallback
+time_parsing_counts = {'fast': 0, 'fallback': 0}
+
+
+def parse_time(value):
+    """
+    Parses received timestamp. ISO-8601 timestamps sent by the plugin are parsed with datetime.fromisoformat,
+    other formats are passed to dateutil.
+
+            Parameters:
+                    value: Received timestamp
+
+            Returns:
+                    Datetime object
+    """
+    if isinstance(value, str):
+        try:
+            parsed = datetime.fromisoformat(value[:-1] + '+00:00' if value.endswith(('Z', 'z')) else value)
+            time_parsing_counts['fast'] += 1
+            return parsed
+        except ValueError:
+            pass
+    time_parsing_counts['fallback'] += 1
+    return dateutil.parser.parse(value)
+
+
+def build_note(data, user_id, idempotency_key=None):
+    """
+    Validates received note and builds unsaved statistics note from it.
+
+            Parameters:
+                    data: Dictionary with 'time_from', 'time_to', optional 'idempotency_key' and metrics values
+                    user_id: Id of the note owner
+                    idempotency_key: Idempotency key used if the note has no own one
+
+            Returns:
+                    Unsaved UserStat object, its idempotency key is kept in 'idempotency_key' attribute
+    """
+    if not isinstance(data, dict):
+        raise NoteValidationError('Note must be an object')
+    if 'time_from' not in data or 'time_to' not in data:
+        raise NoteValidationError("'time_from' or 'time_to' are not in received data")
+
+    try:
+        time_from = parse_time(data['time_from'])
+        time_to = parse_time(data['time_to'])
+    except (TypeError, ValueError, OverflowError):
+        raise NoteValidationError("'time_from' or 'time_to' is not a valid date")
+
+    metrics = {name: value for name, value in data.items() if name not in NOTE_SERVICE_FIELDS}
+    for name, value in metrics.items():
+        if not isinstance(name, str):
+            raise NoteValidationError(f'Metric id {name} is unknown')
+        if len(name) > METRIC_NAME_MAX_LENGTH:
+            raise NoteValidationError(f'Metric name must have at most {METRIC_NAME_MAX_LENGTH} characters')
+        if isinstance(value, bool) or not isinstance(value, int):
+            raise NoteValidationError(f"Value of '{name}' is not an integer")
+        if not METRIC_VALUE_MIN <= value <= METRIC_VALUE_MAX:
+            raise NoteValidationError(f"Value of '{name}' is out of range")
+
+    stat = UserStat(user_id=user_id, time_from=time_from, time_to=time_to, metrics=metrics)
+    stat.idempotency_key = check_idempotency_key(data.get('idempotency_key', idempotency_key))
+    return stat
+
+
+def check_idempotency_key(key, max_length=IDEMPOTENCY_KEY_MAX_LENGTH):
+    """
+    Validates idempotency key sent by the plugin.
+
+            Parameters:
+                    key: Received key, string or integer
+                    max_length: Maximal length of the key
+
+            Returns:
+                    Key as string or None if it is not given
+    """
+    if key is None:
+        return None
+    if isinstance(key, bool) or not isinstance(key, (str, int)):
+        raise NoteValidationError('Idempotency key must be a string or an integer')
+    key = str(key)
+    if not key or len(key) > max_length:
+        raise NoteValidationError(f'Idempotency key must have from 1 to {max_length} characters')
+    return key
+
+
+def decompress(data, encoding):
+    """
+    Decompresses request body, refusing bodies larger than MAX_DECOMPRESSED_BODY_SIZE.
+
+            Parameters:
+                    data: Received body
+                    encoding: Value of 'Content-Encoding' header
+
+            Returns:
+                    Decompressed body
+    """
+    encoding = encoding.strip().lower()
+    if encoding in ('', 'identity'):
+        return data
+    if encoding in ('gzip', 'x-gzip'):
+        try:
+            body = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS).decompress(data, MAX_DECOMPRESSED_BODY_SIZE + 1)
+        except zlib.error:
+            raise NoteValidationError('Received data is not valid gzip data')
+    elif encoding == 'zstd' and zstandard is not None:
+        try:
+            body = zstandard.ZstdDecompressor().decompress(data, max_output_size=MAX_DECOMPRESSED_BODY_SIZE + 1)
+        except zstandard.ZstdError:
+            raise NoteValidationError('Received data is not valid zstd data')
+    else:
+        raise NoteValidationError(f"Content encoding '{encoding}' is not supported")
+    if len(body) > MAX_DECOMPRESSED_BODY_SIZE:
+        raise NoteValidationError('Decompressed data is too large')
+    return body
+
+
+def decode_body(request):
+    """
+    Decompresses and decodes request body according to its 'Content-Encoding' and content type.
+
+    Body is JSON by default, NDJSON for 'application/x-ndjson' (decoded into list of lines), and msgpack or CBOR for
+    'application/msgpack' and 'application/cbor' if the corresponding package is installed.
+
+            Parameters:
+                    request: Received request
+
+            Returns:
+                    Decoded body
+    """
+    body = decompress(request.body, request.headers.get('Content-Encoding', ''))
+    content_type = request.content_type
+    if (content_type == MSGPACK_CONTENT_TYPE and msgpack is None) or \
+            (content_type == CBOR_CONTENT_TYPE and cbor2 is None):
+        raise NoteValidationError(f"Content type '{content_type}' is not supported")
+    try:
+        if content_type == MSGPACK_CONTENT_TYPE:
+            return msgpack.unpackb(body, strict_map_key=False)
+        if content_type == CBOR_CONTENT_TYPE:
+            return cbor2.loads(body)
+        if content_type == NDJSON_CONTENT_TYPE:
+            return [json.loads(line) for line in body.decode().splitlines() if line.strip()]
+        return json.loads(body.decode())
+    except Exception:
+        # json, msgpack and cbor2 raise different errors on malformed data
+        raise NoteValidationError('Received data can not be decoded')
+
+
+def decode_metric_ids(notes):
+    """
+    Replaces metric ids in the notes with metric names. Binary bodies may use ids served by
+    'plugin_get_user_metrics' instead of metric names as keys.
+
+            Parameters:
+                    notes: List of received notes, changed in place
+    """
+    ids = {key for note in notes if isinstance(note, dict) for key in note if isinstance(key, int)}
+    if not ids:
+        return
+    names = dict(Metric.objects.filter(id__in=ids).values_list('id', 'name'))
+    for note in notes:
+        if isinstance(note, dict):
+            for key in [key for key in note if key in names]:
+                note[names[key]] = note.pop(key)
+
+
+def parse_batch(request):
+    """
+    Extracts token and notes from the batch request body.
+
+    Body is either object {"token": ..., "notes": [...]} (JSON, msgpack or CBOR) or NDJSON stream (content type
+    'application/x-ndjson') whose first line is {"token": ...} and every next line is a note. The header may also
+    contain 'batch_id', which gives notes without own idempotency key the keys '<batch_id>:<note index>'.
+
+            Parameters:
+                    request: Received request
+
+            Returns:
+                    Triple of token, list of received notes and batch id
+    """
+    data = decode_body(request)
+    if request.content_type == NDJSON_CONTENT_TYPE:
+        header, notes = (data[0], data[1:]) if data else ({}, [])
+    else:
+        header = data
+        notes = header.get('notes') if isinstance(header, dict) else None
+
+    if not isinstance(header, dict) or 'token' not in header:
+        raise NoteValidationError("'token' is absent in received data")
+    if not isinstance(header['token'], str):
+        raise NoteValidationError("'token' must be a string")
+    if not isinstance(notes, list):
+        raise NoteValidationError("'notes' is not a list")
+    if len(notes) > BATCH_MAX_NOTES:
+        raise NoteValidationError(f'Batch must contain at most {BATCH_MAX_NOTES} notes')
+    return header['token'], notes, check_idempotency_key(header.get('batch_id'), BATCH_ID_MAX_LENGTH)
+
+
+def drop_duplicates(stats):
+    """
+    Removes notes whose idempotency keys were already received and remembers keys of the rest.
+
+    Keys are inserted first, skipping existing ones, and only notes whose keys were inserted by this call are kept. The
+    database makes an insert of the key wait for the concurrent transaction inserting the same key, so a note sent
+    again by a plugin retrying a running request is saved once.
+
+            Parameters:
+                    stats: Unsaved statistics notes
+
+            Returns:
+                    List of notes received for the first time
+    """
+    keyed = [stat for stat in stats if getattr(stat, 'idempotency_key', None)]
+    if not keyed:
+        return stats
+
+    receipt = uuid.uuid4()
+    IngestionKey.objects.bulk_create([IngestionKey(user_id=stat.user_id, key=stat.idempotency_key, receipt=receipt)
+                                      for stat in keyed], batch_size=BULK_CREATE_BATCH_SIZE, ignore_conflicts=True)
+    inserted = set()
+    for i in range(0, len(keyed), BULK_CREATE_BATCH_SIZE):
+        chunk = keyed[i:i + BULK_CREATE_BATCH_SIZE]
+        inserted.update(IngestionKey.objects.filter(
+            user_id__in={stat.user_id for stat in chunk}, key__in={stat.idempotency_key for stat in chunk},
+            receipt=receipt
+        ).values_list('user_id', 'key'))
+
+    result = []
+    for stat in stats:
+        key = getattr(stat, 'idempotency_key', None)
+        if key:
+            if (stat.user_id, key) not in inserted:
+                continue
+            # the same key may be sent twice within the batch
+            inserted.remove((stat.user_id, key))
+        result.append(stat)
+    return result
+
+
+def prune_ingestion_keys(now=None):
+    """
+    Removes idempotency keys older than their retention.
+
+            Parameters:
+                    now: Current time
+
+            Returns:
+                    Number of removed keys
+    """
+    now = now or timezone.now()
+    return IngestionKey.objects.filter(created_at__lt=now - IDEMPOTENCY_KEY_RETENTION).delete()[0]
+
+
+def save_notes(stats):
+    """
+    Saves statistics notes together with their metric values and adds the values to the rollups. Notes with already
+    received idempotency keys are skipped.
+
+            Parameters:
+                    stats: Unsaved statistics notes
+    """
+    with transaction.atomic():
+        stats = drop_duplicates(stats)
+        UserStat.objects.bulk_create(stats, batch_size=BULK_CREATE_BATCH_SIZE)
+        MetricValue.objects.bulk_create(MetricValue.for_stats(stats), batch_size=BULK_CREATE_BATCH_SIZE)
+        add_to_rollups(stats)
+
+
+def validate_batch(notes, user_id, batch_id=None):
+    """
+    Validates all received notes.
+
+            Parameters:
+                    notes: List of received notes
+                    user_id: Id of the notes owner
+                    batch_id: Id of the batch the notes were sent in
+
+            Returns:
+                    Pair of list of statuses, one per received note, and list of unsaved statistics notes built
+                    from the correct ones
+    """
+    statuses = []
+    stats = []
+    for i, data in enumerate(notes):
+        try:
+            stats.append(build_note(data, user_id, None if batch_id is None else f'{batch_id}:{i}'))
+            statuses.append({'status': 'ok'})
+        except NoteValidationError as e:
+            statuses.append({'status': 'error', 'error': str(e)})
+    return statuses, stats
+
@@ -0,0 +1,79 @@
+import random
+import time
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from users.config import *
+from users.models import FeedMessage, Team, UserStat, UserUniqueToken
+
+
+class Command(BaseCommand):
+    help = 'Seeds a large dataset and prints query plans and latencies of the hot lookups of every endpoint. ' \
+           'Run it before and after "migrate users" to compare index changes. The dataset is rolled back unless ' \
+           '--keep is given.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000, help='Number of seeded users')
+        parser.add_argument('--notes', type=int, default=200, help='Number of seeded notes per user')
+        parser.add_argument('--messages', type=int, default=100, help='Number of seeded feed messages per user')
+        parser.add_argument('--teams', type=int, default=1000, help='Number of seeded teams')
+        parser.add_argument('--runs', type=int, default=100, help='Number of runs of every query')
+        parser.add_argument('--keep', action='store_true', help='Keep the seeded dataset')
+
+    def seed(self, users_number, notes_number, messages_number, teams_number):
+        prefix = f'benchmark{random.randint(0, 10 ** 9)}_'
+        User.objects.bulk_create([User(username=f'{prefix}{i}') for i in range(users_number)],
+                                 batch_size=BULK_CREATE_BATCH_SIZE)
+        users = list(User.objects.filter(username__startswith=prefix))
+        UserUniqueToken.objects.bulk_create([UserUniqueToken(user=user) for user in users],
+                                            batch_size=BULK_CREATE_BATCH_SIZE)
+        Team.objects.bulk_create([Team(name=f'{prefix}{i}') for i in range(teams_number)],
+                                 batch_size=BULK_CREATE_BATCH_SIZE)
+
+        now = timezone.now()
+        for user in users:
+            UserStat.objects.bulk_create([
+                UserStat(user=user, time_from=now - timedelta(hours=i), time_to=now - timedelta(hours=i),
+                         metrics={'lines': i})
+                for i in range(notes_number)
+            ], batch_size=BULK_CREATE_BATCH_SIZE)
+            FeedMessage.objects.bulk_create([
+                FeedMessage(sender='benchmark', receiver=user, msg_content=str(i),
+                            created_at=now - timedelta(minutes=i))
+                for i in range(messages_number)
+            ], batch_size=BULK_CREATE_BATCH_SIZE)
+        return users
+
+    def measure(self, name, make_queryset, runs):
+        self.stdout.write(self.style.MIGRATE_HEADING(name))
+        self.stdout.write(make_queryset().explain())
+        start = time.perf_counter()
+        for _ in range(runs):
+            list(make_queryset())
+        self.stdout.write(f'{(time.perf_counter() - start) / runs * 1000:.3f} ms per query\n')
+
+    def handle(self, *args, **options):
+        runs = options['runs']
+        with transaction.atomic():
+            users = self.seed(options['users'], options['notes'], options['messages'], options['teams'])
+            tokens = list(UserUniqueToken.objects.filter(user__in=users).values_list('token', flat=True))
+            keys = list(Team.objects.values_list('invite_key', flat=True)[:options['teams']])
+            week_ago = timezone.now() - timedelta(days=7)
+
+            self.measure('post/, plugin_get_user_metrics/: token lookup',
+                         lambda: UserUniqueToken.objects.filter(token=random.choice(tokens)).select_related('user'),
+                         runs)
+            self.measure('join_team: invite key lookup',
+                         lambda: Team.objects.filter(invite_key=random.choice(keys)), runs)
+            self.measure('compaction, team_to_csv: notes of the user within a week',
+                         lambda: UserStat.objects.filter(user=random.choice(users), time_from__gte=week_ago), runs)
+            self.measure('feed: first page of the user feed',
+                         lambda: FeedMessage.objects.filter(receiver=random.choice(users))
+                         .order_by('-created_at')[:15], runs)
+
+            if not options['keep']:
+                transaction.set_rollback(True)
@@ -0,0 +1,42 @@
+import time
+from datetime import datetime, timedelta
+
+import dateutil.parser
+from django.core.management.base import BaseCommand
+
+from users.ingestion import parse_time, time_parsing_counts
+
+# Timestamp formats which may be received from the plugin
+TIMESTAMP_FORMATS = {
+    'iso with offset': lambda moment: moment.isoformat(sep=' ', timespec='seconds') + '+00:00',
+    'iso with Z': lambda moment: moment.isoformat(timespec='milliseconds') + 'Z',
+    'non-iso': lambda moment: moment.strftime('%d %b %Y %H:%M:%S UTC'),
+}
+
+
+class Command(BaseCommand):
+    help = 'Compares per note cost of timestamp parsing by dateutil and by the ingestion fast path'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--notes', type=int, default=100000, help='Number of parsed notes per format')
+
+    def measure(self, parse, values):
+        start = time.perf_counter()
+        for value in values:
+            # every note has 'time_from' and 'time_to'
+            parse(value)
+            parse(value)
+        return (time.perf_counter() - start) / len(values) * 10 ** 6
+
+    def handle(self, *args, **options):
+        start = datetime(2021, 5, 23)
+        moments = [start + timedelta(seconds=i) for i in range(options['notes'])]
+        for name, formatter in TIMESTAMP_FORMATS.items():
+            values = [formatter(moment) for moment in moments]
+            fallbacks = time_parsing_counts['fallback']
+            dateutil_cost = self.measure(dateutil.parser.parse, values)
+            fast_cost = self.measure(parse_time, values)
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            self.stdout.write(f'dateutil: {dateutil_cost:.2f} us per note')
+            self.stdout.write(f'fast path: {fast_cost:.2f} us per note, '
+                              f'{time_parsing_counts["fallback"] - fallbacks} fallbacks\n')
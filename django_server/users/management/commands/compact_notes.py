@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from users.compaction import compact_notes
+from users.config import *
+
+
+class Command(BaseCommand):
+    help = 'Rolls old statistics notes up into hourly, daily and weekly notes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep running and compact periodically')
+        parser.add_argument('--interval', type=int, default=COMPACTION_INTERVAL_SECONDS,
+                            help='Seconds between compaction runs in loop mode')
+
+    def handle(self, *args, **options):
+        while True:
+            compacted = compact_notes()
+            self.stdout.write(f'Compacted notes of {compacted} users')
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
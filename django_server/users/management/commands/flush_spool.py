@@ -0,0 +1,43 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import Error, close_old_connections
+
+from users.config import *
+from users.spool import get_spool
+
+
+class Command(BaseCommand):
+    help = 'Moves statistics notes from the ingestion spool to the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=SPOOL_FLUSH_BATCH_SIZE,
+                            help='Maximal number of notes saved with one bulk insert')
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep running and wait for new notes when the spool is empty')
+        parser.add_argument('--interval', type=float, default=SPOOL_FLUSH_INTERVAL_SECONDS,
+                            help='Seconds to wait when the spool is empty or the database fails in loop mode')
+
+    def handle(self, *args, **options):
+        spool = get_spool()
+        flushed = 0
+        while True:
+            try:
+                moved = spool.flush(options['batch_size'])
+            except Error as e:
+                # notes stay in the spool until the database is back
+                if not options['loop']:
+                    raise
+                self.stderr.write(f'Could not flush the spool: {e!r}')
+                close_old_connections()
+                time.sleep(options['interval'])
+                continue
+            flushed += moved
+            if not moved:
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
+        self.stdout.write(f'Flushed {flushed} notes')
+        dead = len(spool.dead_letters())
+        if dead:
+            self.stderr.write(f'{dead} notes could not be saved, they are kept in dead_notes table of {spool.path}')
@@ -0,0 +1,19 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from users.rollups import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = 'Recomputes daily and hourly metric rollups from the stored metric values'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', action='append', dest='usernames', metavar='USERNAME',
+                            help='Rebuild rollups only of the given user, may be repeated')
+
+    def handle(self, *args, **options):
+        users = None
+        if options['usernames']:
+            users = User.objects.filter(username__in=options['usernames'])
+        rebuild_rollups(users)
+        self.stdout.write('Rollups were rebuilt')
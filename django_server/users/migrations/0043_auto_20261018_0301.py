@@ -0,0 +1,28 @@
+# Generated by Django 3.1.7 on 2026-10-18 00:01
+
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0042_auto_20210617_1809'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WordCountingMetric',
+            fields=[
+                ('metric_ptr', models.OneToOneField(auto_created=True, on_delete=django.db.models.deletion.CASCADE, parent_link=True, primary_key=True, serialize=False, to='users.metric')),
+                ('word', models.CharField(max_length=80, unique=True, validators=[django.core.validators.MinLengthValidator(2)])),
+            ],
+            bases=('users.metric',),
+        ),
+        migrations.AddField(
+            model_name='userstat',
+            name='resolution',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 3.1.7 on 2026-10-18 00:02
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+BACKFILL_BATCH_SIZE = 1000
+
+
+def backfill_metric_values(apps, schema_editor):
+    UserStat = apps.get_model('users', 'UserStat')
+    MetricValue = apps.get_model('users', 'MetricValue')
+    values = []
+    for stat in UserStat.objects.all().iterator(chunk_size=BACKFILL_BATCH_SIZE):
+        for name, value in stat.metrics.items():
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                continue
+            values.append(MetricValue(user_id=stat.user_id, metric=name, value=value, time_from=stat.time_from,
+                                      resolution=stat.resolution))
+        if len(values) >= BACKFILL_BATCH_SIZE:
+            MetricValue.objects.bulk_create(values)
+            values = []
+    MetricValue.objects.bulk_create(values)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('users', '0043_auto_20261018_0301'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MetricValue',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('metric', models.CharField(max_length=100)),
+                ('value', models.BigIntegerField(default=0)),
+                ('time_from', models.DateTimeField(default=django.utils.timezone.now)),
+                ('resolution', models.PositiveIntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='metricvalue',
+            index=models.Index(fields=['user', 'metric', 'time_from'], name='users_metri_user_id_6fdc73_idx'),
+        ),
+        migrations.RunPython(backfill_metric_values, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 3.1.7 on 2026-10-18 00:09
+
+import django.core.management.utils
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0045_dailymetricvalue_hourlymetricvalue'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='team',
+            name='invite_key',
+            field=models.CharField(db_index=True, default=django.core.management.utils.get_random_secret_key, max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='useruniquetoken',
+            name='token',
+            field=models.CharField(default=django.core.management.utils.get_random_secret_key, max_length=100, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='feedmessage',
+            index=models.Index(fields=['receiver', '-created_at'], name='users_feedm_receive_ca0b7d_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userstat',
+            index=models.Index(fields=['user', 'time_from'], name='users_users_user_id_40e8a6_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.7 on 2026-10-18 00:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0047_ingestionkey'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='config_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
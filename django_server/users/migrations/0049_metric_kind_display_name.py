@@ -0,0 +1,43 @@
+# Generated by Django 3.1.7 on 2026-10-18 00:29
+
+from django.db import migrations, models
+from django.db.models import F
+
+# Display names of the metric types as of this migration, historical models have no 'describe' method
+METRIC_TYPE_NAMES = {
+    'CharCountingMetric': lambda metric: f'Number of "{metric.char}" characters',
+    'SubstringCountingMetric': lambda metric: f'Number of "{metric.substring}" substrings',
+    'WordCountingMetric': lambda metric: f'Number of "{metric.word}" word',
+    'SpecificBranchCommitCounterMetric': lambda metric: f'Number of commit to "{metric.branch_name}" branch',
+    'SpecificLengthCopyCounterMetric': lambda metric: f'Number of copied words with length {metric.substring_length}',
+    'SpecificLengthPasteCounterMetric': lambda metric: f'Number of pasted words with length {metric.substring_length}',
+}
+
+
+def backfill_metric_kinds(apps, schema_editor):
+    Metric = apps.get_model('users', 'Metric')
+    Metric.objects.update(kind='', display_name=F('string_representation'))
+    for model_name, describe in METRIC_TYPE_NAMES.items():
+        for metric in apps.get_model('users', model_name).objects.all():
+            Metric.objects.filter(pk=metric.pk).update(kind=model_name.lower(), display_name=describe(metric))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0048_profile_config_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='metric',
+            name='display_name',
+            field=models.CharField(blank=True, default='', max_length=200),
+        ),
+        migrations.AddField(
+            model_name='metric',
+            name='kind',
+            field=models.CharField(blank=True, default='', max_length=50),
+        ),
+        migrations.RunPython(backfill_metric_kinds, migrations.RunPython.noop),
+    ]
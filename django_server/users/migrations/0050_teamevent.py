@@ -0,0 +1,29 @@
+# Generated by Django 3.1.7 on 2026-10-18 00:34
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0049_metric_kind_display_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TeamEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sender', models.CharField(max_length=100)),
+                ('msg_content', models.CharField(max_length=1000)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('team', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='events', to='users.team')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='teamevent',
+            index=models.Index(fields=['team', '-created_at'], name='users_teame_team_id_d38d32_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.1.7 on 2026-10-18 00:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0050_teamevent'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='feedmessage',
+            name='users_feedm_receive_ca0b7d_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='teamevent',
+            name='users_teame_team_id_d38d32_idx',
+        ),
+        migrations.AddIndex(
+            model_name='feedmessage',
+            index=models.Index(fields=['receiver', 'created_at', 'id'], name='users_feedm_receive_a84b44_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='teamevent',
+            index=models.Index(fields=['team', 'created_at', 'id'], name='users_teame_team_id_cdcf80_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.7 on 2026-10-18 00:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0051_feed_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ingestionkey',
+            name='receipt',
+            field=models.UUIDField(null=True),
+        ),
+    ]
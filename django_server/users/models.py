@@ -1,15 +1,16 @@
 from abc import abstractmethod
-from datetime import datetime, timedelta
+from collections import namedtuple
+from datetime import timedelta
 
 from django.contrib.auth.models import User
-from django.contrib.postgres.fields.jsonb import KeyTextTransform
 from django.core.management.utils import get_random_secret_key
 from django.core.validators import MinLengthValidator
 from django.db import models
-from django.db.models import Sum
-from django.db.models.functions import Cast
+from django.db.models import Case, Q, Sum, When
 from django.utils import timezone
+from django.utils.functional import cached_property
 
+from .catalog import metric_catalog
 from .config import *
 
 
@@ -27,11 +28,19 @@ class UserStat(models.Model):
         Date tracked to
     user :
         User about whom records
+    resolution :
+        Length in seconds of the bucket the note was rolled up into, 0 for raw notes
     """
     metrics = models.JSONField(default=dict)
     time_from = models.DateTimeField(default=timezone.now)
     time_to = models.DateTimeField(default=timezone.now)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
+    resolution = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'time_from']),
+        ]
 
 
 class UserUniqueToken(models.Model):
@@ -46,7 +55,125 @@ class UserUniqueToken(models.Model):
         Random token string
     """
     user = models.OneToOneField(User, on_delete=models.CASCADE)
-    token = models.CharField(max_length=100, default=get_random_secret_key)
+    token = models.CharField(max_length=100, unique=True, default=get_random_secret_key)
+
+
+class MetricValue(models.Model):
+    """
+    Single metric value of the statistics note, written together with the note
+
+    Attributes:
+    ----------
+    user :
+        User about whom records
+    metric :
+        Metric name
+    value :
+        Metric value
+    time_from :
+        Date the note is tracked from
+    resolution :
+        Resolution of the note the value belongs to
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    metric = models.CharField(max_length=100)
+    value = models.BigIntegerField(default=0)
+    time_from = models.DateTimeField(default=timezone.now)
+    resolution = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'metric', 'time_from']),
+        ]
+
+    @staticmethod
+    def for_stats(stats):
+        """
+        Returns metric values of the statistics notes.
+
+                Parameters:
+                        stats: Statistics notes
+
+                Returns:
+                        List of unsaved metric values
+        """
+        return [
+            MetricValue(user_id=stat.user_id, metric=name, value=int(value), time_from=stat.time_from,
+                        resolution=stat.resolution)
+            for stat in stats for name, value in stat.metrics.items()
+        ]
+
+
+class DailyMetricValue(models.Model):
+    """
+    Sum of user metric values within a day
+
+    Attributes:
+    ----------
+    user :
+        User about whom records
+    metric :
+        Metric name
+    day :
+        Day (UTC) the values were collected within
+    value :
+        Sum of metric values
+    """
+    user = models.ForeignKey(User, related_name='daily_metric_values', on_delete=models.CASCADE)
+    metric = models.CharField(max_length=100)
+    day = models.DateField()
+    value = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('user', 'metric', 'day')
+
+
+class HourlyMetricValue(models.Model):
+    """
+    Sum of user metric values within an hour, kept only for the last hours
+
+    Attributes:
+    ----------
+    user :
+        User about whom records
+    metric :
+        Metric name
+    hour :
+        Beginning of the hour the values were collected within
+    value :
+        Sum of metric values
+    """
+    user = models.ForeignKey(User, related_name='hourly_metric_values', on_delete=models.CASCADE)
+    metric = models.CharField(max_length=100)
+    hour = models.DateTimeField()
+    value = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('user', 'metric', 'hour')
+
+
+class IngestionKey(models.Model):
+    """
+    Idempotency key of a recently received statistics note, used to drop notes sent again by retrying plugins
+
+    Attributes:
+    ----------
+    user :
+        Owner of the note
+    key :
+        Idempotency key sent by the plugin
+    created_at :
+        Date the note was received
+    receipt :
+        Random id of the saving which inserted the key
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    key = models.CharField(max_length=100)
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+    receipt = models.UUIDField(null=True)
+
+    class Meta:
+        unique_together = ('user', 'key')
 
 
 def extract_metric(filtered, metric):
@@ -54,14 +181,50 @@ def extract_metric(filtered, metric):
     Returns the sum of metric values.
 
             Parameters:
-                    filtered: Filtered statistic notes
+                    filtered: Filtered metric values or rollups
                     metric: Target metric
 
             Returns:
                     Sum of metric values
     """
-    return filtered.annotate(metric_value=Cast(KeyTextTransform(metric, 'metrics'), models.IntegerField())).aggregate(
-        Sum('metric_value'))['metric_value__sum']
+    return filtered.filter(metric=metric).aggregate(Sum('value'))['value__sum']
+
+
+def rollup_window(delta, now=None):
+    """
+    Returns rollups and the condition selecting ones which cover the time from the given time point to the current
+    time.
+
+    Windows covered by hourly rollups are taken by hours, longer ones by days, so the bound is rounded down to the
+    beginning of the hour or the day.
+
+            Parameters:
+                    delta: Time delta
+                    now: Current time
+
+            Returns:
+                    Pair of hourly or daily rollup model and Q object with the condition
+    """
+    start = (now or timezone.now()) - delta
+    if delta <= HOURLY_ROLLUP_RETENTION:
+        return HourlyMetricValue, Q(hour__gte=start.replace(minute=0, second=0, microsecond=0))
+    return DailyMetricValue, Q(day__gte=start.date())
+
+
+def metric_rollups(delta=None):
+    """
+    Returns rollups covering the time from the given time point to the current time, see rollup_window.
+
+            Parameters:
+                    delta: Time delta, all time if not given
+
+            Returns:
+                    Query set of hourly or daily rollups
+    """
+    if delta is None:
+        return DailyMetricValue.objects.all()
+    model, window = rollup_window(delta)
+    return model.objects.filter(window)
 
 
 def aggregate_metric_all_time(user, metric):
@@ -75,10 +238,84 @@ def aggregate_metric_all_time(user, metric):
             Returns:
                     Sum of metric values of the given user
     """
-    s = extract_metric(UserStat.objects.filter(user=user), metric)
+    s = extract_metric(metric_rollups().filter(user=user), metric)
+    return s if s else 0
+
+
+def aggregate_metric_within_delta(user, metric, delta):
+    """
+    Returns the sum of metric values collected from given time point to the current time for the given user.
+
+            Parameters:
+                    user: Target user
+                    metric: Target metric
+                    delta: Time delta
+
+            Returns:
+                    Sum of metric values of the given user within required time interval
+    """
+    s = extract_metric(metric_rollups(delta).filter(user=user), metric)
     return s if s else 0
 
 
+# Sums of metric values within the time windows shown on the profile
+ProfileSummary = namedtuple('ProfileSummary', ['all_time', 'year', 'month', 'week', 'day'])
+
+SUMMARY_WINDOWS = {
+    'year': timedelta(days=365),
+    'month': timedelta(days=30),
+    'week': timedelta(days=7),
+    'day': timedelta(days=1),
+}
+
+
+def profile_summary(user, metrics=('lines',)):
+    """
+    Returns sums of metric values over all time and within the last year, month, week and day, computed by
+    conditional aggregation over the same rollups as aggregate_metric_within_delta, one query per rollup table.
+
+            Parameters:
+                    user: Target user
+                    metrics: Target metrics
+
+            Returns:
+                    Dictionary, key -- metric name, value -- ProfileSummary of the metric
+    """
+    now = timezone.now()
+    aggregates = {DailyMetricValue: {'all_time': Sum('value')}, HourlyMetricValue: {}}
+    for name, delta in SUMMARY_WINDOWS.items():
+        model, window = rollup_window(delta, now)
+        aggregates[model][name] = Sum(Case(When(window, then='value'), default=0,
+                                           output_field=models.BigIntegerField()))
+
+    sums = {metric: dict.fromkeys(ProfileSummary._fields, 0) for metric in metrics}
+    for model, windows in aggregates.items():
+        if not windows:
+            continue
+        for row in model.objects.filter(user=user, metric__in=metrics).values('metric').annotate(**windows):
+            metric = row.pop('metric')
+            sums[metric].update({name: value or 0 for name, value in row.items()})
+    return {metric: ProfileSummary(**values) for metric, values in sums.items()}
+
+
+# Metric types by their 'kind', filled by register_metric_type
+METRIC_TYPES = {}
+
+
+def register_metric_type(model):
+    """
+    Registers parameterized metric type.
+
+            Parameters:
+                    model: Metric subclass with 'config_key' and 'parameter' attributes
+
+            Returns:
+                    The same model
+    """
+    METRIC_TYPES[model._meta.model_name] = model
+    return model
+
+
 class Metric(models.Model):
     """
     Metric representation
@@ -87,23 +324,39 @@ class Metric(models.Model):
     ----------
     name :
         Metric name
+    kind :
+        Name of the metric type model, empty for metrics without parameters
+    display_name :
+        Metric string representation for the interface, updated when the metric is saved
     """
     name = models.CharField(max_length=100, unique=True)
     string_representation = models.CharField(max_length=100, blank=True)
+    kind = models.CharField(max_length=50, blank=True, default='')
+    display_name = models.CharField(max_length=200, blank=True, default='')
 
-    def __str__(self):
-        if hasattr(self, 'charcountingmetric'):
-            return str(self.charcountingmetric)
-        elif hasattr(self, 'substringcountingmetric'):
-            return str(self.substringcountingmetric)
-        elif hasattr(self, 'specificlengthcopypastecounter'):
-            return str(self.specificlengthcopypastecounter)
-        elif hasattr(self, 'specificbranchcommitcountermetric'):
-            return str(self.specificbranchcommitcountermetric)
-        elif hasattr(self, 'wordcountingmetric'):
-            return str(self.wordcountingmetric)
+    def describe(self):
         return self.string_representation
 
+    def concrete(self):
+        """
+        Returns the metric as an instance of its type model.
+
+                Returns:
+                        Metric object of the type model
+        """
+        return getattr(self, self.kind) if self.kind else self
+
+    def save(self, *args, **kwargs):
+        if self._meta.model_name in METRIC_TYPES:
+            self.kind = self._meta.model_name
+            self.display_name = self.describe()
+        elif not self.kind:
+            self.display_name = self.describe()
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return self.display_name or self.describe()
+
 
 class Profile(models.Model):
     """
@@ -116,51 +369,48 @@ class Profile(models.Model):
         Profile owner
     tracked_metrics :
         Metrics tracked by the user
+    config_version :
+        Version of the plugin configuration, increased on every change of the tracked metrics
     """
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     tracked_metrics = models.ManyToManyField(Metric, related_name='metrics', blank=True)
+    config_version = models.PositiveIntegerField(default=0)
 
     # image = models.ImageField(default='default.jpg', upload_to='profile_pics')
 
     def __str__(self):
         return f'{self.user.username} Profile'
 
-    @staticmethod
-    def aggregate_lines(filtered):
-        return \
-            filtered.annotate(lines_value=Cast(KeyTextTransform('lines', 'metrics'), models.IntegerField())).aggregate(
-                Sum('lines_value'))['lines_value__sum']
+    @cached_property
+    def lines_summary(self):
+        return profile_summary(self.user)['lines']
 
     @property
     def stats_for_all_time(self):
-        s = self.aggregate_lines(UserStat.objects.filter(user=self.user))
-        return s if s else 0
+        return self.lines_summary.all_time
 
     def lines_written_within_delta(self, delta):
-        s = self.aggregate_lines(UserStat.objects.filter(user=self.user, time_from__gte=datetime.now() - delta))
-        return s if s else 0
+        return aggregate_metric_within_delta(self.user, 'lines', delta)
 
     @property
     def stats_for_last_year(self):
-        return self.lines_written_within_delta(timedelta(days=365))
+        return self.lines_summary.year
 
     @property
     def stats_for_last_month(self):
-        return self.lines_written_within_delta(timedelta(days=30))
+        return self.lines_summary.month
 
     @property
     def stats_for_last_week(self):
-        return self.lines_written_within_delta(timedelta(days=7))
+        return self.lines_summary.week
 
     @property
     def stats_for_last_day(self):
-        return self.lines_written_within_delta(timedelta(days=1))
+        return self.lines_summary.day
 
     def get_metrics(self):
-        return dict({'lines': 'Lines of code'}, **{
-            name: str(self.tracked_metrics.get(name=name)) for name in
-            self.tracked_metrics.all().values_list('name', flat=True)
-        })
+        return dict({'lines': 'Lines of code'},
+                    **metric_catalog.display_names(self.tracked_metrics.values_list('name', flat=True)))
 
     def add_metric(self, metric):
         self.tracked_metrics.add(Metric.objects.get(name=metric))
@@ -171,6 +421,7 @@ class Profile(models.Model):
         self.save()
 
 
+@register_metric_type
 class CharCountingMetric(Metric):
     """
     Metric for counting characters
@@ -180,12 +431,16 @@ class CharCountingMetric(Metric):
     char :
         Character to count
     """
+    config_key = CHAR_COUNTER
+    parameter = 'char'
+
     char = models.CharField(max_length=1, unique=True, blank=False)
 
-    def __str__(self):
+    def describe(self):
         return 'Number of \"' + str(self.char) + '\" characters'
 
 
+@register_metric_type
 class SubstringCountingMetric(Metric):
     """
     Metric for counting substrings
@@ -195,12 +450,16 @@ class SubstringCountingMetric(Metric):
     substring :
         Substring to count
     """
+    config_key = SUBSTRING_COUNTER
+    parameter = 'substring'
+
     substring = models.CharField(max_length=80, unique=True, blank=False, validators=[MinLengthValidator(2)])
 
-    def __str__(self):
+    def describe(self):
         return 'Number of \"' + str(self.substring) + '\" substrings'
 
 
+@register_metric_type
 class WordCountingMetric(Metric):
     """
     Metric for counting words
@@ -210,12 +469,16 @@ class WordCountingMetric(Metric):
     substring :
         Substring to count
     """
+    config_key = WORD_COUNTER
+    parameter = 'word'
+
     word = models.CharField(max_length=80, unique=True, blank=False, validators=[MinLengthValidator(2)])
 
-    def __str__(self):
+    def describe(self):
         return 'Number of \"' + str(self.word) + '\" word'
 
 
+@register_metric_type
 class SpecificBranchCommitCounterMetric(Metric):
     """
     Metric for counting commit on specific branch
@@ -225,12 +488,16 @@ class SpecificBranchCommitCounterMetric(Metric):
     branch_name :
         Name of tracked branch
     """
+    config_key = SPECIFIC_BRANCH_COMMIT_COUNTER
+    parameter = 'branch_name'
+
     branch_name = models.CharField(max_length=80, unique=True, blank=False)
 
-    def __str__(self):
+    def describe(self):
         return 'Number of commit to \"' + str(self.branch_name) + '\" branch'
 
 
+@register_metric_type
 class SpecificLengthCopyCounterMetric(Metric):
     """
         Metric for counting copying of substring with specific length
@@ -240,12 +507,16 @@ class SpecificLengthCopyCounterMetric(Metric):
         substring_length :
             Specific length of substring
         """
+    config_key = SPECIFIC_LENGTH_COPY_COUNTER
+    parameter = 'substring_length'
+
     substring_length = models.IntegerField(unique=True, blank=False)
 
-    def __str__(self):
+    def describe(self):
         return 'Number of copied words with length ' + str(self.substring_length)
 
 
+@register_metric_type
 class SpecificLengthPasteCounterMetric(Metric):
     """
         Metric for counting copying/pasting of substring with specific length
@@ -255,9 +526,12 @@ class SpecificLengthPasteCounterMetric(Metric):
         substring_length :
             Specific length of substring
         """
+    config_key = SPECIFIC_LENGTH_PASTE_COUNTER
+    parameter = 'substring_length'
+
     substring_length = models.IntegerField(unique=True, blank=False)
 
-    def __str__(self):
+    def describe(self):
         return 'Number of pasted words with length ' + str(self.substring_length)
 
 
@@ -281,7 +555,7 @@ class Team(models.Model):
     name = models.CharField(max_length=100, unique=True)
     users = models.ManyToManyField(User, related_name='team_user', blank=True)
     admins = models.ManyToManyField(User, related_name='team_admin')
-    invite_key = models.CharField(max_length=100, default=get_random_secret_key)
+    invite_key = models.CharField(max_length=100, db_index=True, default=get_random_secret_key)
     tracked_metrics = models.ManyToManyField(Metric, related_name='u_metrics', blank=True)
 
     def __str__(self):
@@ -295,10 +569,8 @@ class Team(models.Model):
                     Dictionary of tracked metrics, key -- metric name, value -- metric string representation for the
                 interface
         """
-        return dict({'lines': 'Lines of code'}, **{
-            name: str(self.tracked_metrics.get(name=name)) for name in
-            self.tracked_metrics.all().values_list('name', flat=True)
-        })
+        return dict({'lines': 'Lines of code'},
+                    **metric_catalog.display_names(self.tracked_metrics.values_list('name', flat=True)))
 
 
 class FeedMessage(models.Model):
@@ -321,6 +593,37 @@ class FeedMessage(models.Model):
     msg_content = models.CharField(max_length=1000, blank=False)
     created_at = models.DateTimeField(default=timezone.now)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['receiver', 'created_at', 'id']),
+        ]
+
+
+class TeamEvent(models.Model):
+    """
+    Message for feeds of all members of the team, stored once instead of a FeedMessage per member
+
+    Attributes:
+    ----------
+    team :
+        Team whose members get the message
+    sender :
+        Sender
+    msg_content :
+        Message content
+    created_at :
+        Time when message was sent
+    """
+    team = models.ForeignKey(Team, related_name='events', on_delete=models.CASCADE)
+    sender = models.CharField(max_length=100, blank=False)
+    msg_content = models.CharField(max_length=1000, blank=False)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['team', 'created_at', 'id']),
+        ]
+
 
 class Achievement(models.Model):
     name = models.CharField(max_length=100, unique=True)
@@ -0,0 +1,172 @@
+import base64
+import heapq
+from datetime import datetime
+from itertools import islice
+
+from django.db.models import Q
+from django.utils import timezone
+
+from .config import *
+from .models import FeedMessage, Profile, Team, TeamEvent
+from .plugin_config import config_changed
+
+
+def team_member_ids(team):
+    """
+    Returns ids of all users and admins of the team.
+
+            Parameters:
+                    team: Team
+
+            Returns:
+                    Set of user ids
+    """
+    return set(team.users.values_list('id', flat=True)) | set(team.admins.values_list('id', flat=True))
+
+
+def notify(sender, user_ids, msg_content):
+    """
+    Puts the message to feeds of all the users with a single insert.
+
+            Parameters:
+                    sender: Message sender
+                    user_ids: Ids of the receivers
+                    msg_content: Message content
+    """
+    now = timezone.now()
+    FeedMessage.objects.bulk_create(
+        [FeedMessage(sender=sender, receiver_id=user_id, msg_content=msg_content, created_at=now)
+         for user_id in user_ids],
+        batch_size=FANOUT_BATCH_SIZE)
+
+
+def notify_team(team, msg_content, member_ids=None):
+    """
+    Puts the message to feeds of all members of the team. Messages of teams up to FANOUT_ON_WRITE_MAX_MEMBERS members
+    are copied to every member feed, larger teams store a single TeamEvent merged into the feeds on read.
+
+            Parameters:
+                    team: Team
+                    msg_content: Message content
+                    member_ids: Ids of the team members if they are already known
+    """
+    member_ids = team_member_ids(team) if member_ids is None else member_ids
+    if len(member_ids) > FANOUT_ON_WRITE_MAX_MEMBERS:
+        TeamEvent.objects.create(team=team, sender=team.name, msg_content=msg_content)
+    else:
+        notify(team.name, member_ids, msg_content)
+
+
+def track_metrics(user_ids, metric_ids):
+    """
+    Adds the metrics to tracked metrics of all the users with a single insert. Metrics which are already tracked are
+    skipped. Bulk insert does not send m2m_changed, so plugin configurations of the users are changed here.
+
+            Parameters:
+                    user_ids: Ids of the users
+                    metric_ids: Ids of the metrics
+    """
+    user_ids, metric_ids = list(user_ids), list(metric_ids)
+    if not user_ids or not metric_ids:
+        return
+    through = Profile.tracked_metrics.through
+    profile_ids = Profile.objects.filter(user_id__in=user_ids).values_list('id', flat=True)
+    through.objects.bulk_create(
+        [through(profile_id=profile_id, metric_id=metric_id) for profile_id in profile_ids for metric_id in metric_ids],
+        batch_size=FANOUT_BATCH_SIZE, ignore_conflicts=True)
+    config_changed(user_ids)
+
+
+def encode_cursor(key):
+    created_at, source, pk = key
+    return base64.urlsafe_b64encode(f'{created_at.isoformat()}|{source}|{pk}'.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    Decodes feed position from the cursor.
+
+            Parameters:
+                    cursor: Cursor from encode_cursor
+
+            Returns:
+                    Triple of creation time, source index and id of the message
+
+            Raises:
+                    ValueError: If the cursor is malformed
+    """
+    created_at, source, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+    return datetime.fromisoformat(created_at), int(source), int(pk)
+
+
+class UserFeed:
+    """
+    Messages of the user merged with events of the user teams, newest first
+
+    Messages are ordered by keys (created_at, source, id), where source is 0 for personal messages and 1 for team
+    events, so keys are unique across both tables. Every source is read as a stream through its (owner, created_at, id)
+    index starting from the cursor and the page is a k-way merge of the stream heads, so cost of a page does not depend
+    on its depth.
+
+    Attributes:
+    ----------
+    streams :
+        Pairs of source index and query set of the merged sources
+    """
+
+    def __init__(self, user):
+        team_ids = Team.objects.filter(Q(users=user) | Q(admins=user)).values_list('id', flat=True).distinct()
+        self.streams = [(0, FeedMessage.objects.filter(receiver=user))] + \
+                       [(1, TeamEvent.objects.filter(team_id=team_id)) for team_id in team_ids]
+
+    @staticmethod
+    def _beyond(stream, source, cursor, newer):
+        created_at, cursor_source, pk = cursor
+        direction = 'gt' if newer else 'lt'
+        if source == cursor_source:
+            return stream.filter(Q(**{f'created_at__{direction}': created_at}) |
+                                 Q(created_at=created_at, **{f'id__{direction}': pk}))
+        # messages of the other source created at the same time are beyond the cursor if the source order says so
+        inclusive = (source > cursor_source) == newer
+        return stream.filter(**{f'created_at__{direction}e' if inclusive else f'created_at__{direction}': created_at})
+
+    def _merge(self, cursor, newer, size):
+        order = ('created_at', 'id') if newer else ('-created_at', '-id')
+        heads = []
+        for source, stream in self.streams:
+            if cursor is not None:
+                stream = self._beyond(stream, source, cursor, newer)
+            heads.append([((message.created_at, source, message.id), message)
+                          for message in stream.order_by(*order)[:size]])
+        return list(islice(heapq.merge(*heads, key=lambda item: item[0], reverse=not newer), size))
+
+    def page(self, after=None, before=None, size=FEED_PAGE_SIZE):
+        """
+        Returns a page of the feed.
+
+                Parameters:
+                        after: Cursor of the page followed by the requested one, None for the first page
+                        before: Cursor of the page preceded by the requested one, takes precedence over after
+                        size: Number of messages on the page
+
+                Returns:
+                        Triple of messages of the page newest first, cursor of the previous page and cursor of the next
+                        page, cursors are None if there is no such page
+
+                Raises:
+                        ValueError: If a cursor is malformed
+        """
+        if before is not None:
+            # one more message shows whether there is a page before the requested one
+            items = self._merge(decode_cursor(before), True, size + 1)
+            has_previous, has_next = len(items) > size, True
+            items = items[:size][::-1]
+        else:
+            items = self._merge(decode_cursor(after) if after is not None else None, False, size + 1)
+            has_previous, has_next = after is not None, len(items) > size
+            items = items[:size]
+        if not items:
+            return [], None, None
+        return ([message for _, message in items],
+                encode_cursor(items[0][0]) if has_previous else None,
+                encode_cursor(items[-1][0]) if has_next else None)
@@ -0,0 +1,113 @@
+import hashlib
+import json
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+
+from .config import *
+from .models import METRIC_TYPES, Metric, Profile
+
+
+def build_metrics_config(user_id):
+    """
+    Builds configuration of metrics tracked by the user with a single query joining metric type tables.
+
+            Parameters:
+                    user_id: Id of the user
+
+            Returns:
+                    Dictionary with names of tracked metrics without parameters, lists of parameters of tracked
+                    parameterized metrics by their type and ids of tracked metrics by their names
+    """
+    metrics = Metric.objects.filter(metrics__user_id=user_id).select_related(*METRIC_TYPES).order_by('id')
+    config = {model.config_key: [] for model in METRIC_TYPES.values()}
+    ids = {}
+    for metric in metrics:
+        ids[metric.name] = metric.id
+        if metric.kind:
+            model = METRIC_TYPES[metric.kind]
+            config[model.config_key].append(getattr(metric.concrete(), model.parameter))
+        else:
+            config[metric.name] = metric.name
+    config[METRIC_IDS] = ids
+    return config
+
+
+def config_cache_key(user_id):
+    return f'plugin_config:{user_id}'
+
+
+def metrics_config(user_id):
+    """
+    Returns configuration of metrics tracked by the user. It is kept in the shared cache together with its ETag and
+    version until the tracked metrics change, so answering a repeated request reads only the cache.
+
+            Parameters:
+                    user_id: Id of the user
+
+            Returns:
+                    Triple of ETag of the configuration, the configuration and its version
+    """
+    key = config_cache_key(user_id)
+    cached = cache.get(key)
+    if cached is None:
+        version = config_version(user_id)
+        config = build_metrics_config(user_id)
+        digest = hashlib.md5(json.dumps(config, sort_keys=True).encode()).hexdigest()
+        cached = (f'"{digest}"', config, version)
+        # configuration built before a concurrent change is kept at most PLUGIN_CONFIG_CACHE_TIMEOUT
+        cache.add(key, cached, PLUGIN_CONFIG_CACHE_TIMEOUT)
+    return cached
+
+
+def config_version(user_id):
+    """
+    Returns version of the plugin configuration of the user.
+
+            Parameters:
+                    user_id: Id of the user
+
+            Returns:
+                    Configuration version
+    """
+    return Profile.objects.filter(user_id=user_id).values_list('config_version', flat=True).first() or 0
+
+
+def config_versions(user_ids):
+    """
+    Returns versions of plugin configurations of the users with one query.
+
+            Parameters:
+                    user_ids: Ids of the users
+
+            Returns:
+                    Dictionary of configuration versions by user ids
+    """
+    return dict(Profile.objects.filter(user_id__in=user_ids).values_list('user_id', 'config_version'))
+
+
+def forget_metrics_config(user_ids):
+    """
+    Removes cached configurations of the users from the shared cache.
+
+            Parameters:
+                    user_ids: Ids of the users
+    """
+    cache.delete_many([config_cache_key(user_id) for user_id in user_ids])
+
+
+def config_changed(user_ids):
+    """
+    Increases plugin configuration versions of the users and removes their cached configurations. They are removed
+    once more after the commit, so configurations built from the old state meanwhile are not kept.
+
+            Parameters:
+                    user_ids: Ids of the users
+    """
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+    Profile.objects.filter(user_id__in=user_ids).update(config_version=F('config_version') + 1)
+    forget_metrics_config(user_ids)
+    transaction.on_commit(lambda: forget_metrics_config(user_ids))
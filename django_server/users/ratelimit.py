@@ -0,0 +1,206 @@
+import asyncio
+import functools
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+
+from .config import *
+
+
+def refill(state, now, rate, burst):
+    """
+    Takes a token from the token bucket.
+
+            Parameters:
+                    state: Pair of number of tokens and time of the last update, None for a new bucket
+                    now: Current time in seconds
+                    rate: Number of tokens added per second
+                    burst: Bucket capacity
+
+            Returns:
+                    Pair of the new bucket state and number of seconds to wait, 0 if the token was taken
+    """
+    tokens, updated = state if state is not None else (burst, now)
+    tokens = min(burst, tokens + (now - updated) * rate)
+    if tokens >= 1:
+        return (tokens - 1, now), 0
+    return (tokens, now), (1 - tokens) / rate
+
+
+class LocalBuckets:
+    """
+    Token buckets kept in the memory of the worker process, timed by the monotonic clock
+
+    Attributes:
+    ----------
+    max_size :
+        Maximal number of kept buckets, the least recently used ones are dropped
+    """
+
+    def __init__(self, max_size=RATE_LIMIT_LOCAL_BUCKETS):
+        self.max_size = max_size
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def clock(self):
+        return time.monotonic()
+
+    def take(self, key, now, rate, burst):
+        with self._lock:
+            self._buckets[key], wait = refill(self._buckets.get(key), now, rate, burst)
+            self._buckets.move_to_end(key)
+            if len(self._buckets) > self.max_size:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class CacheBuckets:
+    """
+    Token buckets kept in Django cache and shared by all workers using the cache
+
+    Updates are not atomic, so concurrent requests with the same key may take a few extra tokens. Buckets are timed by
+    the wall clock, as origins of monotonic clocks differ between hosts.
+    """
+
+    def clock(self):
+        return time.time()
+
+    def take(self, key, now, rate, burst):
+        key = f'ratelimit:{key}'
+        state, wait = refill(cache.get(key), now, rate, burst)
+        # the bucket is full again after burst / rate seconds, so it may expire then
+        cache.set(key, state, timeout=int(burst / rate) + 1)
+        return wait
+
+    def clear(self):
+        pass
+
+
+local_buckets = LocalBuckets()
+cache_buckets = CacheBuckets()
+
+
+def get_buckets():
+    return cache_buckets if getattr(settings, 'PLUGIN_RATE_LIMIT_BACKEND', 'local') == 'cache' else local_buckets
+
+
+def check_rate_limit(scope, key):
+    """
+    Takes a token from the bucket of the key within the scope from RATE_LIMITS.
+
+            Parameters:
+                    scope: Name of the limited endpoints group
+                    key: Plugin token or client IP
+
+            Returns:
+                    Response with status 429 if the limit is exceeded, None otherwise
+    """
+    rate, burst = RATE_LIMITS[scope]
+    buckets = get_buckets()
+    wait = buckets.take(f'{scope}:{key}', buckets.clock(), rate, burst)
+    if not wait:
+        return None
+    response = HttpResponse('Too many requests', status=429)
+    response['Retry-After'] = max(1, round(wait))
+    return response
+
+
+async def check_rate_limit_async(scope, key):
+    """
+    Runs check_rate_limit without blocking the event loop, shared buckets are taken in a worker thread as Django
+    cache backends are blocking.
+    """
+    if get_buckets() is cache_buckets:
+        return await sync_to_async(check_rate_limit, thread_sensitive=False)(scope, key)
+    return check_rate_limit(scope, key)
+
+
+def client_ip(request):
+    return request.META.get('REMOTE_ADDR', '')
+
+
+class ConcurrencyLimiter:
+    """
+    Limit of concurrently processed requests within the worker process
+
+    Attributes:
+    ----------
+    active :
+        Number of requests being processed
+    """
+
+    def __init__(self, limit):
+        self.active = 0
+        self._limit = limit
+        self._lock = threading.Lock()
+
+    @property
+    def limit(self):
+        """
+        Maximal number of concurrently processed requests
+        """
+        return self._limit()
+
+    def acquire(self):
+        with self._lock:
+            if self.active >= self.limit:
+                return False
+            self.active += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.active -= 1
+
+
+def thread_ingestion_limit():
+    # a single thread can not be shared, so it is never shed
+    threads = getattr(settings, 'PLUGIN_WORKER_THREADS', WORKER_THREADS)
+    return max(1, int(threads * INGESTION_MAX_THREAD_SHARE))
+
+
+# sync views take request threads, async views share the event loop
+ingestion_limiter = ConcurrencyLimiter(thread_ingestion_limit)
+async_ingestion_limiter = ConcurrencyLimiter(lambda: INGESTION_MAX_CONCURRENCY)
+
+
+def overloaded_response():
+    response = HttpResponse('Server is overloaded', status=503)
+    response['Retry-After'] = INGESTION_RETRY_AFTER_SECONDS
+    return response
+
+
+def shed_load(view):
+    """
+    Rejects ingestion requests above the concurrency limit instead of queueing them, so that ingestion can not take
+    all threads and database connections from the dashboard. Sync views may take INGESTION_MAX_THREAD_SHARE of
+    PLUGIN_WORKER_THREADS, async views INGESTION_MAX_CONCURRENCY requests per process.
+    """
+    if asyncio.iscoroutinefunction(view):
+        @functools.wraps(view)
+        async def wrapped(request, *args, **kwargs):
+            if not async_ingestion_limiter.acquire():
+                return overloaded_response()
+            try:
+                return await view(request, *args, **kwargs)
+            finally:
+                async_ingestion_limiter.release()
+    else:
+        @functools.wraps(view)
+        def wrapped(request, *args, **kwargs):
+            if not ingestion_limiter.acquire():
+                return overloaded_response()
+            try:
+                return view(request, *args, **kwargs)
+            finally:
+                ingestion_limiter.release()
+    return wrapped
@@ -0,0 +1,126 @@
+from collections import defaultdict
+
+import pytz
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+from django.db.models.functions import TruncDay, TruncHour
+from django.utils import timezone
+
+from .config import *
+from .models import DailyMetricValue, HourlyMetricValue, MetricValue
+
+utc = pytz.UTC
+
+
+def upsert_rollups(model, bucket_field, values):
+    """
+    Adds values to the rollup rows, creating rows which do not exist, with a fixed number of statements: one select
+    of the existing rows, one update adding to them and one insert of the new ones.
+
+            Parameters:
+                    model: Rollup model
+                    bucket_field: Name of the field with the row time bucket
+                    values: Dictionary of values to add, key -- triple of user id, metric name and time bucket
+    """
+    while values:
+        existing = {
+            (row.user_id, row.metric, getattr(row, bucket_field)): row
+            for row in model.objects.filter(user_id__in={user_id for user_id, _, _ in values},
+                                            metric__in={metric for _, metric, _ in values},
+                                            **{f'{bucket_field}__in': {bucket for _, _, bucket in values}})
+        }
+        updated = []
+        for key, row in existing.items():
+            if key in values:
+                row.value = F('value') + values[key]
+                updated.append(row)
+        model.objects.bulk_update(updated, ['value'], batch_size=BULK_CREATE_BATCH_SIZE)
+
+        values = {key: value for key, value in values.items() if key not in existing}
+        if not values:
+            return
+        try:
+            with transaction.atomic():
+                model.objects.bulk_create([
+                    model(user_id=user_id, metric=metric, value=value, **{bucket_field: bucket})
+                    for (user_id, metric, bucket), value in values.items()
+                ], batch_size=BULK_CREATE_BATCH_SIZE)
+            return
+        except IntegrityError:
+            # some of the rows were created concurrently, they are updated on the next pass
+            pass
+
+
+def add_to_rollups(stats, now=None):
+    """
+    Adds metric values of the statistics notes to the daily and hourly rollups.
+
+            Parameters:
+                    stats: Statistics notes
+                    now: Current time
+    """
+    now = now or timezone.now()
+    hours_border = (now - HOURLY_ROLLUP_RETENTION).replace(minute=0, second=0, microsecond=0)
+    daily = defaultdict(int)
+    hourly = defaultdict(int)
+    for stat in stats:
+        time_from = stat.time_from
+        if timezone.is_naive(time_from):
+            time_from = timezone.make_aware(time_from)
+        time_from = time_from.astimezone(utc)
+        hour = time_from.replace(minute=0, second=0, microsecond=0)
+        for name, value in stat.metrics.items():
+            daily[(stat.user_id, name, time_from.date())] += int(value)
+            if hour >= hours_border:
+                hourly[(stat.user_id, name, hour)] += int(value)
+
+    upsert_rollups(DailyMetricValue, 'day', daily)
+    upsert_rollups(HourlyMetricValue, 'hour', hourly)
+
+
+def prune_hourly_rollups(now=None):
+    """
+    Removes hourly rollups older than their retention.
+
+            Parameters:
+                    now: Current time
+
+            Returns:
+                    Number of removed rows
+    """
+    now = now or timezone.now()
+    hours_border = (now - HOURLY_ROLLUP_RETENTION).replace(minute=0, second=0, microsecond=0)
+    return HourlyMetricValue.objects.filter(hour__lt=hours_border).delete()[0]
+
+
+def rebuild_rollups(users=None, now=None):
+    """
+    Recomputes daily and hourly rollups from the metric values.
+
+            Parameters:
+                    users: Users to rebuild rollups of, all users if not given
+                    now: Current time
+    """
+    now = now or timezone.now()
+    hours_border = (now - HOURLY_ROLLUP_RETENTION).replace(minute=0, second=0, microsecond=0)
+    values = MetricValue.objects.all()
+    daily = DailyMetricValue.objects.all()
+    hourly = HourlyMetricValue.objects.all()
+    if users is not None:
+        values = values.filter(user__in=users)
+        daily = daily.filter(user__in=users)
+        hourly = hourly.filter(user__in=users)
+
+    with transaction.atomic():
+        daily.delete()
+        hourly.delete()
+        DailyMetricValue.objects.bulk_create((
+            DailyMetricValue(user_id=row['user'], metric=row['metric'], day=row['bucket'].date(), value=row['total'])
+            for row in values.annotate(bucket=TruncDay('time_from', tzinfo=utc))
+                .values('user', 'metric', 'bucket').annotate(total=Sum('value')).iterator()
+        ), batch_size=BULK_CREATE_BATCH_SIZE)
+        HourlyMetricValue.objects.bulk_create((
+            HourlyMetricValue(user_id=row['user'], metric=row['metric'], hour=row['bucket'], value=row['total'])
+            for row in values.filter(time_from__gte=hours_border).annotate(bucket=TruncHour('time_from', tzinfo=utc))
+                .values('user', 'metric', 'bucket').annotate(total=Sum('value')).iterator()
+        ), batch_size=BULK_CREATE_BATCH_SIZE)
@@ -1,7 +1,11 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
 from django.contrib.auth.models import User
+from django.db import transaction
 from django.dispatch import receiver
-from .models import Profile, UserUniqueToken
+from .catalog import metric_catalog
+from .models import Metric, Profile, UserUniqueToken
+from .plugin_config import config_changed, forget_metrics_config
+from .tokens import token_cache
 
 
 @receiver(post_save, sender=User)
@@ -23,4 +27,50 @@ def create_token(sender, instance, created, raw=False, **kwargs):
 
 @receiver(post_save, sender=User)
 def save_profile(sender, instance, **kwargs):
-    instance.useruniquetoken.save()
\ No newline at end of file
+    instance.useruniquetoken.save()
+
+
+@receiver(post_save, sender=UserUniqueToken)
+@receiver(post_delete, sender=UserUniqueToken)
+def invalidate_token_cache(sender, instance, **kwargs):
+    token_cache.invalidate_user(instance.user_id)
+
+
+@receiver(post_save, sender=Profile)
+@receiver(post_delete, sender=Profile)
+def invalidate_profile_config(sender, instance, created=True, raw=False, **kwargs):
+    # ids of deleted users may be reused by new users
+    if created and not raw:
+        forget_metrics_config([instance.user_id])
+
+
+@receiver(m2m_changed, sender=Profile.tracked_metrics.through)
+def invalidate_tracked_metrics_config(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            config_changed([instance.user_id])
+            # the profile may be saved later, so it must not keep the old version
+            instance.refresh_from_db(fields=['config_version'])
+    elif action in ('post_add', 'post_remove'):
+        config_changed(Profile.objects.filter(pk__in=pk_set).values_list('user_id', flat=True))
+    elif action == 'pre_clear':
+        config_changed(instance.metrics.values_list('user_id', flat=True))
+
+
+def invalidate_metric_config(sender, instance, created=False, **kwargs):
+    if not created:
+        config_changed(Profile.objects.filter(tracked_metrics=instance).values_list('user_id', flat=True))
+
+
+def invalidate_metric_catalog(sender, instance, **kwargs):
+    metric_catalog.invalidate()
+    # processes which reloaded the catalog before the change was committed load it once more
+    transaction.on_commit(metric_catalog.invalidate)
+
+
+# parameterized metrics are saved and deleted with their own senders
+for metric_model in [Metric] + Metric.__subclasses__():
+    post_save.connect(invalidate_metric_config, sender=metric_model)
+    pre_delete.connect(invalidate_metric_config, sender=metric_model)
+    post_save.connect(invalidate_metric_catalog, sender=metric_model)
+    post_delete.connect(invalidate_metric_catalog, sender=metric_model)
@@ -0,0 +1,260 @@
+import json
+import sqlite3
+import threading
+import uuid
+from datetime import datetime
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import DataError, IntegrityError
+
+from .config import *
+from .ingestion import save_notes
+from .models import IngestionKey, UserStat
+
+
+class SpoolFullError(Exception):
+    """
+    Error raised when the spool has no room for received notes
+    """
+
+
+# Errors of saving notes which are caused by the notes themselves, other errors leave the notes in the spool
+NOTE_ERRORS = (DataError, IntegrityError, ValueError, TypeError, OverflowError)
+
+
+class IngestionSpool:
+    """
+    Durable local queue of validated statistics notes backed by SQLite database in WAL mode
+
+    Notes are appended by the ingestion endpoints and drained into the main database by the flusher. Notes stay in the
+    spool until the flusher saved them, so they survive crashes of both the server and the flusher. Notes which can
+    not be saved are moved to the dead letters table of the spool database.
+
+    Attributes:
+    ----------
+    path :
+        Path to the spool database
+    max_notes :
+        Maximal number of notes in the spool
+    """
+
+    def __init__(self, path, max_notes):
+        self.path = path
+        self.max_notes = max_notes
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        if getattr(self._local, 'connection', None) is None:
+            connection = sqlite3.connect(str(self.path), timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=FULL')
+            connection.execute('CREATE TABLE IF NOT EXISTS notes '
+                               '(id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, note TEXT NOT NULL)')
+            connection.execute('CREATE TABLE IF NOT EXISTS dead_notes '
+                               '(id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, note TEXT NOT NULL, '
+                               'error TEXT NOT NULL)')
+            connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            connection.execute("INSERT OR IGNORE INTO meta VALUES ('spool_id', ?)", (uuid.uuid4().hex,))
+            self._local.connection = connection
+        return self._local.connection
+
+    @property
+    def spool_id(self):
+        """
+        Random id of the spool database, so that keys of its notes differ from keys of a recreated spool
+        """
+        return self.connection.execute("SELECT value FROM meta WHERE key = 'spool_id'").fetchone()[0]
+
+    def _depth(self):
+        first, last = self.connection.execute('SELECT MIN(id), MAX(id) FROM notes').fetchone()
+        return 0 if first is None else last - first + 1
+
+    def depth(self):
+        """
+        Returns number of notes waiting in the spool.
+
+                Returns:
+                        Number of notes
+        """
+        return self._depth()
+
+    def append(self, stats):
+        """
+        Appends statistics notes to the spool, either all of them or none.
+
+                Parameters:
+                        stats: Unsaved statistics notes
+        """
+        rows = [
+            (stat.user_id, json.dumps({'time_from': stat.time_from.isoformat(), 'time_to': stat.time_to.isoformat(),
+                                       'metrics': stat.metrics,
+                                       'idempotency_key': getattr(stat, 'idempotency_key', None)}))
+            for stat in stats
+        ]
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            if self._depth() + len(rows) > self.max_notes:
+                raise SpoolFullError(f'Spool can not take {len(rows)} more notes')
+            connection.executemany('INSERT INTO notes (user_id, note) VALUES (?, ?)', rows)
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def read(self, limit):
+        """
+        Returns the oldest notes of the spool. Notes without idempotency key get key 'spool:<spool id>:<note id>', so
+        a batch saved again after a crash of the flusher is not counted twice. Such notes have 'spool_keyed' attribute
+        set.
+
+                Parameters:
+                        limit: Maximal number of notes
+
+                Returns:
+                        Pair of the last read note id and list of unsaved statistics notes, their spool rows are kept in
+                        'spool_row' attribute
+        """
+        rows = self.connection.execute('SELECT id, user_id, note FROM notes ORDER BY id LIMIT ?', (limit,)).fetchall()
+        spool_id = self.spool_id
+        stats = []
+        for row in rows:
+            note_id, user_id, note = row
+            note = json.loads(note)
+            stat = UserStat(user_id=user_id, metrics=note['metrics'],
+                            time_from=datetime.fromisoformat(note['time_from']),
+                            time_to=datetime.fromisoformat(note['time_to']))
+            stat.idempotency_key = note.get('idempotency_key') or f'spool:{spool_id}:{note_id}'
+            stat.spool_keyed = not note.get('idempotency_key')
+            stat.spool_row = row
+            stats.append(stat)
+        return (rows[-1][0] if rows else None), stats
+
+    def remove(self, last_id):
+        """
+        Removes notes up to the given one from the spool.
+
+                Parameters:
+                        last_id: Id of the last note to remove
+        """
+        self.connection.execute('DELETE FROM notes WHERE id <= ?', (last_id,))
+
+    def forget_keys(self, stats):
+        """
+        Removes idempotency keys given to the notes by the spool. They are needed only until the notes are removed
+        from the spool, keys left by a crash in between are removed with the other expired keys.
+
+                Parameters:
+                        stats: Notes read from the spool
+        """
+        keyed = [stat for stat in stats if stat.spool_keyed]
+        for i in range(0, len(keyed), BULK_CREATE_BATCH_SIZE):
+            chunk = keyed[i:i + BULK_CREATE_BATCH_SIZE]
+            IngestionKey.objects.filter(user_id__in={stat.user_id for stat in chunk},
+                                        key__in={stat.idempotency_key for stat in chunk}).delete()
+
+    def bury(self, stat, error):
+        """
+        Moves the note which can not be saved to the dead letters.
+
+                Parameters:
+                        stat: Note read from the spool
+                        error: Error raised when the note was saved
+        """
+        self.connection.execute('INSERT OR REPLACE INTO dead_notes (id, user_id, note, error) VALUES (?, ?, ?, ?)',
+                                stat.spool_row + (repr(error),))
+
+    def dead_letters(self):
+        """
+        Returns notes which could not be saved.
+
+                Returns:
+                        List of triples of user id, note and error text
+        """
+        return self.connection.execute('SELECT user_id, note, error FROM dead_notes ORDER BY id').fetchall()
+
+    def save(self, stats):
+        """
+        Saves the notes, bisecting the batch on errors caused by the notes to move only the bad notes to the dead
+        letters.
+
+                Parameters:
+                        stats: Notes read from the spool
+
+                Returns:
+                        Number of notes moved to the dead letters
+        """
+        try:
+            save_notes(stats)
+            return 0
+        except NOTE_ERRORS as e:
+            if len(stats) == 1:
+                self.bury(stats[0], e)
+                return 1
+        middle = len(stats) // 2
+        return self.save(stats[:middle]) + self.save(stats[middle:])
+
+    def flush(self, batch_size=SPOOL_FLUSH_BATCH_SIZE):
+        """
+        Moves the oldest batch of notes from the spool to the database.
+
+        Notes are removed from the spool only after they were saved, so a crash in between makes the batch be saved
+        again on the next flush, where idempotency keys of the notes skip the already saved ones. Keys given by the
+        spool are removed together with the batch.
+
+                Parameters:
+                        batch_size: Maximal number of moved notes
+
+                Returns:
+                        Number of notes taken from the spool
+        """
+        last_id, stats = self.read(batch_size)
+        if last_id is None:
+            return 0
+        # notes of users deleted while their notes were waiting are dropped
+        existing = set(User.objects.filter(id__in={stat.user_id for stat in stats}).values_list('id', flat=True))
+        saved = [stat for stat in stats if stat.user_id in existing]
+        self.save(saved)
+        self.remove(last_id)
+        self.forget_keys(saved)
+        return len(stats)
+
+
+_spools = {}
+
+
+def get_spool():
+    """
+    Returns the spool configured in the settings.
+
+            Returns:
+                    IngestionSpool object
+    """
+    key = (str(getattr(settings, 'PLUGIN_SPOOL_PATH', SPOOL_PATH)),
+           getattr(settings, 'PLUGIN_SPOOL_MAX_NOTES', SPOOL_MAX_NOTES))
+    if key not in _spools:
+        _spools[key] = IngestionSpool(*key)
+    return _spools[key]
+
+
+def spool_enabled():
+    return getattr(settings, 'PLUGIN_INGESTION_MODE', 'sync') == 'spool'
+
+
+def store_notes(stats):
+    """
+    Saves statistics notes or appends them to the spool depending on the ingestion mode.
+
+            Parameters:
+                    stats: Unsaved statistics notes
+
+            Returns:
+                    True if the notes were appended to the spool, False if they were saved
+    """
+    if spool_enabled():
+        get_spool().append(stats)
+        return True
+    save_notes(stats)
+    return False
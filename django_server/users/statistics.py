@@ -0,0 +1,76 @@
+import pandas as pd
+from django.contrib.auth.models import User
+from django.db.models import Q, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import DailyMetricValue, HourlyMetricValue, metric_rollups
+
+
+def leaderboard(metric='lines'):
+    """
+    Returns users ranked by the all time sum of the metric.
+
+            Parameters:
+                    metric: Target metric
+
+            Returns:
+                    Query set of users annotated with 'total' and ordered by it
+    """
+    return User.objects.annotate(
+        total=Coalesce(Sum('daily_metric_values__value', filter=Q(daily_metric_values__metric=metric)), 0)
+    ).order_by('-total', 'id')
+
+
+def team_statistics(team, metric, delta=None):
+    """
+    Returns sums of the metric for every team member, computed by one grouped query.
+
+            Parameters:
+                    team: Target team
+                    metric: Target metric
+                    delta: Time delta of the period, all time if not given
+
+            Returns:
+                    Dictionary, key -- member username, value -- sum of the metric values within the period
+    """
+    members = User.objects.filter(Q(team_user=team) | Q(team_admin=team))
+    stats = dict.fromkeys(members.values_list('username', flat=True).distinct(), 0)
+    stats.update(
+        metric_rollups(delta).filter(user__in=members, metric=metric)
+            .values_list('user__username').annotate(total=Sum('value'))
+    )
+    return stats
+
+
+def time_series(users, metric, periods, hourly=False, now=None):
+    """
+    Returns sums of the metric per user and per bucket, the last bucket is the current one.
+
+    Sums are computed by one grouped query over the rollups, missing buckets are filled with zeros.
+
+            Parameters:
+                    users: Target users
+                    metric: Target metric
+                    periods: Number of buckets
+                    hourly: Whether buckets are hours, days otherwise
+                    now: Current time
+
+            Returns:
+                    Data frame indexed by buckets with column of sums for every user id
+    """
+    now = now or timezone.now()
+    user_ids = [user.id for user in users]
+    if hourly:
+        end = now.replace(minute=0, second=0, microsecond=0)
+        buckets = pd.date_range(end=end, periods=periods, freq=pd.Timedelta(hours=1))
+        rows = HourlyMetricValue.objects.filter(user__in=user_ids, metric=metric, hour__gte=buckets[0]) \
+            .values_list('user', 'hour').annotate(total=Sum('value'))
+    else:
+        buckets = pd.date_range(end=now.date(), periods=periods, freq=pd.Timedelta(days=1)).date
+        rows = DailyMetricValue.objects.filter(user__in=user_ids, metric=metric, day__gte=buckets[0]) \
+            .values_list('user', 'day').annotate(total=Sum('value'))
+
+    frame = pd.DataFrame(list(rows), columns=['user', 'bucket', 'total'])
+    table = frame.pivot_table(index='bucket', columns='user', values='total', aggfunc='sum')
+    return table.reindex(index=buckets, columns=user_ids).fillna(0).astype('int64')
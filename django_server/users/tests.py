@@ -1,11 +1,41 @@
+import asyncio
+import gzip
 import json
+import os
+import unittest
 import random
+import tempfile
+import time
+from datetime import datetime
+from io import StringIO
+from unittest import mock
 
-from django.test import TestCase
-from django.test import Client
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.db import OperationalError, connection
+from django.db.models import F
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test import AsyncClient, Client
+from django.test.utils import CaptureQueriesContext
 
+from . import async_views
+from .catalog import MetricCatalog, metric_catalog
 from .models import *
-from .views import aggregate_notes
+from .compaction import bucket_start, downsample_notes, utc
+from .flowcontrol import flow_control
+from .ingestion import (build_note, decode_metric_ids, msgpack, parse_time, save_notes, time_parsing_counts,
+                        validate_batch)
+from .ratelimit import LocalBuckets, check_rate_limit, ingestion_limiter, local_buckets, refill
+from .rollups import add_to_rollups, prune_hourly_rollups
+from .notifications import UserFeed, notify_team
+from .spool import IngestionSpool, get_spool
+from .statistics import team_statistics, time_series
+from .plugin_config import config_changed, config_version, config_versions, forget_metrics_config
+from .tokens import TokenCache, get_user_id, token_cache
+
+# Query counting tests count database work of the features, not of the database cache backend
+LOCAL_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
 
 
 class DataSendingTest(TestCase):
@@ -100,61 +130,1126 @@ class DataSendingTest(TestCase):
 
     def test_aggregating(self):
         user = User.objects.create_user(username='testuser1', password='12345')
+        other = User.objects.create_user(username='testuser2', password='12345')
+        now = timezone.now()
+
+        def make_note(u, delta):
+            save_notes([UserStat(user=u, time_from=now - delta, time_to=now - delta, metrics={'metric': 1})])
+
+        # weekly buckets
+        for days in [3000, 1000, 700, 400]:
+            make_note(user, timedelta(days=days))
+        # daily buckets
+        for days in [70, 40, 31]:
+            make_note(user, timedelta(days=days))
+        # hourly buckets, two notes of the same hour are merged
+        for delta in [timedelta(days=29), timedelta(days=8), timedelta(days=6),
+                      timedelta(days=3), timedelta(days=3, minutes=1)]:
+            make_note(user, delta)
+        # raw notes
+        for _ in range(5):
+            make_note(user, timedelta(minutes=1))
+        make_note(other, timedelta(days=400))
+
+        self.assertEqual(downsample_notes(user, now), 1)
+        self.assertEqual(len(UserStat.objects.filter(user=user)), 16)
+        self.assertEqual(len(UserStat.objects.filter(user=user, resolution=0)), 5)
+        self.assertEqual(len(UserStat.objects.filter(user=user, resolution=7 * 24 * 3600)), 4)
+        self.assertEqual(len(UserStat.objects.filter(user=user, resolution=24 * 3600)), 3)
+        self.assertEqual(len(UserStat.objects.filter(user=user, resolution=3600)), 4)
+        self.assertEqual(aggregate_metric_all_time(user, 'metric'), 17)
+        self.assertEqual(len(MetricValue.objects.filter(user=user)), 16)
+        self.assertEqual(len(UserStat.objects.filter(user=other)), 1)
+        self.assertEqual(aggregate_metric_all_time(other, 'metric'), 1)
+
+        # rolled up notes are not rolled up again
+        self.assertEqual(downsample_notes(user, now), 0)
+        self.assertEqual(len(UserStat.objects.filter(user=user)), 16)
+
+        # a month later hourly notes become daily, raw notes become hourly and late notes join existing buckets
+        later = now + timedelta(days=30)
+        make_note(user, timedelta(days=1000))
+        downsample_notes(user, later)
+        self.assertEqual(len(UserStat.objects.filter(user=user, resolution=7 * 24 * 3600)), 4)
+        self.assertEqual(len(UserStat.objects.filter(user=user, resolution=3600)), 1)
+        self.assertEqual(len(UserStat.objects.filter(user=user, resolution=0)), 0)
+        self.assertEqual(aggregate_metric_all_time(user, 'metric'), 18)
+
+    def test_bucket_start(self):
+        moment = datetime(2021, 5, 23, 14, 24, 20, tzinfo=utc)
+        self.assertEqual(bucket_start(moment, timedelta(hours=1)), datetime(2021, 5, 23, 14, tzinfo=utc))
+        self.assertEqual(bucket_start(moment, timedelta(days=1)), datetime(2021, 5, 23, tzinfo=utc))
+        self.assertEqual(bucket_start(moment, timedelta(weeks=1)), datetime(2021, 5, 17, tzinfo=utc))
+
+
+class MetricValueTest(TestCase):
+    def test_values_written_on_ingestion(self):
+        u = User.objects.create_user(username='testuser', password='12345')
         c = Client()
+        self.assertEqual(c.post('/post/', json.dumps({'token': u.useruniquetoken.token,
+                                                      'time_from': '2021-05-23 14:24:20+00:00',
+                                                      'time_to': '2021-05-23 14:24:20+00:00',
+                                                      'lines': 10, 'metric': 3}),
+                                content_type="application/json").status_code, 200)
+        self.assertEqual({('lines', 10), ('metric', 3)},
+                         set(MetricValue.objects.filter(user=u).values_list('metric', 'value')))
+
+    def test_window_aggregates(self):
+        u = User.objects.create_user(username='testuser', password='12345')
+        now = timezone.now()
+        save_notes([UserStat(user=u, time_from=now - timedelta(days=days), time_to=now - timedelta(days=days),
+                             metrics={'lines': days}) for days in [0, 3, 10, 100]])
+        self.assertEqual(113, aggregate_metric_all_time(u, 'lines'))
+        self.assertEqual(3, aggregate_metric_within_delta(u, 'lines', timedelta(days=7)))
+        self.assertEqual(113, u.profile.stats_for_all_time)
+        self.assertEqual(13, u.profile.stats_for_last_month)
+
+
+class RollupTest(TestCase):
+    def test_rollups_updated_on_ingestion(self):
+        u = User.objects.create_user(username='testuser', password='12345')
+        now = timezone.now()
+        save_notes([UserStat(user=u, time_from=now, time_to=now, metrics={'lines': 2, 'metric': 1})])
+        save_notes([UserStat(user=u, time_from=now, time_to=now, metrics={'lines': 3}),
+                    UserStat(user=u, time_from=now - timedelta(days=10), time_to=now, metrics={'lines': 4})])
+
+        self.assertEqual(5, DailyMetricValue.objects.get(user=u, metric='lines', day=now.date()).value)
+        self.assertEqual(3, len(DailyMetricValue.objects.filter(user=u)))
+        self.assertEqual(2, len(HourlyMetricValue.objects.filter(user=u)))
+        self.assertEqual(5, aggregate_metric_within_delta(u, 'lines', timedelta(days=1)))
+        self.assertEqual(9, aggregate_metric_within_delta(u, 'lines', timedelta(days=30)))
+        self.assertEqual(9, u.profile.stats_for_all_time)
+
+    def test_fixed_number_of_statements(self):
+        u = User.objects.create_user(username='testuser', password='12345')
+        now = timezone.now()
+        stats = [UserStat(user=u, time_from=now - timedelta(days=days), time_to=now, metrics={'lines': 1, 'metric': 2})
+                 for days in range(200)]
+        with CaptureQueriesContext(connection) as new_rows:
+            add_to_rollups(stats, now)
+        with CaptureQueriesContext(connection) as existing_rows:
+            add_to_rollups(stats + stats[:1], now)
+        self.assertLessEqual(len(new_rows), 10)
+        self.assertLessEqual(len(existing_rows), 10)
+        self.assertEqual(400, len(DailyMetricValue.objects.filter(user=u)))
+        self.assertEqual(3, DailyMetricValue.objects.get(user=u, metric='lines', day=now.date()).value)
+        self.assertEqual(4, DailyMetricValue.objects.get(user=u, metric='metric', day=now.date() - timedelta(1)).value)
+        hour = now.replace(minute=0, second=0, microsecond=0)
+        self.assertEqual(3, HourlyMetricValue.objects.get(user=u, metric='lines', hour=hour).value)
+
+    def test_rebuild_matches_incremental_rollups(self):
+        u = User.objects.create_user(username='testuser', password='12345')
+        now = timezone.now()
+        save_notes([UserStat(user=u, time_from=now - timedelta(hours=hours), time_to=now, metrics={'lines': hours})
+                    for hours in [0, 1, 5, 30, 100, 1000]])
+        daily = set(DailyMetricValue.objects.values_list('metric', 'day', 'value'))
+        hourly = set(HourlyMetricValue.objects.values_list('metric', 'hour', 'value'))
+
+        out = StringIO()
+        call_command('rebuild_rollups', stdout=out)
+        self.assertEqual(daily, set(DailyMetricValue.objects.values_list('metric', 'day', 'value')))
+        self.assertEqual(hourly, set(HourlyMetricValue.objects.values_list('metric', 'hour', 'value')))
+
+    def test_prune_hourly_rollups(self):
+        u = User.objects.create_user(username='testuser', password='12345')
+        now = timezone.now()
+        save_notes([UserStat(user=u, time_from=now - timedelta(hours=hours), time_to=now, metrics={'lines': 1})
+                    for hours in [0, 40]])
+        self.assertEqual(2, len(HourlyMetricValue.objects.filter(user=u)))
+        self.assertEqual(1, prune_hourly_rollups(now + timedelta(hours=10)))
+        self.assertEqual(2, u.profile.stats_for_all_time)
+
+
+class StatisticsTest(TestCase):
+    def test_time_series(self):
+        u1 = User.objects.create_user(username='testuser1', password='12345')
+        u2 = User.objects.create_user(username='testuser2', password='12345')
+        now = timezone.now()
+        save_notes([UserStat(user=u1, time_from=now - timedelta(days=days), time_to=now, metrics={'lines': days + 1})
+                     for days in [0, 0, 2, 40]])
+        save_notes([UserStat(user=u2, time_from=now - timedelta(hours=3), time_to=now, metrics={'lines': 5})])
+
+        with self.assertNumQueries(1):
+            series = time_series([u1, u2], 'lines', 7, now=now)
+        self.assertEqual(7, len(series))
+        self.assertEqual(now.date(), series.index[-1])
+        self.assertEqual([0, 0, 0, 0, 3, 0, 2], list(series[u1.id]))
+        self.assertEqual(5, series[u2.id].sum())
 
-        def make_query_with_date(f, t):
+        series = time_series([u1, u2], 'lines', 24, hourly=True, now=now)
+        self.assertEqual(24, len(series))
+        self.assertEqual(2, series[u1.id].iloc[-1])
+        self.assertEqual(5, series[u2.id].iloc[-4])
+
+        series = time_series([u1, u2], 'other', 3, now=now)
+        self.assertEqual([0, 0, 0], list(series[u2.id]))
+
+    def test_team_statistics(self):
+        admin = User.objects.create_user(username='admin', password='12345')
+        u1 = User.objects.create_user(username='testuser1', password='12345')
+        u2 = User.objects.create_user(username='testuser2', password='12345')
+        outsider = User.objects.create_user(username='outsider', password='12345')
+        team = Team.objects.create(name='team')
+        team.admins.add(admin)
+        team.users.add(admin, u1, u2)
+        now = timezone.now()
+        save_notes([UserStat(user=u, time_from=now - timedelta(days=days), time_to=now, metrics={'lines': lines})
+                    for u, days, lines in [(admin, 0, 1), (u1, 0, 2), (u1, 10, 3), (u1, 400, 4), (outsider, 0, 5)]])
+
+        with self.assertNumQueries(2):
+            stats = team_statistics(team, 'lines')
+        self.assertEqual({'admin': 1, 'testuser1': 9, 'testuser2': 0}, stats)
+        self.assertEqual({'admin': 1, 'testuser1': 5, 'testuser2': 0},
+                         team_statistics(team, 'lines', timedelta(days=30)))
+        self.assertEqual({'admin': 1, 'testuser1': 2, 'testuser2': 0},
+                         team_statistics(team, 'lines', timedelta(days=1)))
+
+    def test_profile_summary(self):
+        u = User.objects.create_user(username='testuser', password='12345')
+        now = timezone.now()
+        save_notes([UserStat(user=u, time_from=now - timedelta(days=days), time_to=now,
+                             metrics={'lines': days + 1, 'metric': 1})
+                    for days in [0, 3, 10, 100, 1000]])
+
+        with self.assertNumQueries(2):
+            summary = profile_summary(u, ['lines', 'metric', 'untracked'])
+        self.assertEqual(ProfileSummary(1118, 117, 16, 5, 1), summary['lines'])
+        self.assertEqual(ProfileSummary(5, 4, 3, 2, 1), summary['metric'])
+        self.assertEqual(ProfileSummary(0, 0, 0, 0, 0), summary['untracked'])
+
+        profile = Profile.objects.get(user=u)
+        with self.assertNumQueries(3):
+            self.assertEqual((1118, 117, 16, 5, 1), (profile.stats_for_all_time, profile.stats_for_last_year,
+                                                      profile.stats_for_last_month, profile.stats_for_last_week,
+                                                      profile.stats_for_last_day))
+
+
+class CompactionSchedulingTest(TestCase):
+    def test_ingestion_does_not_compact(self):
+        user = User.objects.create_user(username='testuser1', password='12345')
+        c = Client()
+        old = (datetime.today() - timedelta(days=400)).isoformat()
+        for _ in range(12):
             self.assertEqual(c.post('/post/', json.dumps({'token': user.useruniquetoken.token,
-                                                          'time_from': f,
-                                                          'time_to': t,
-                                                          'metric': 1
-                                                          }),
+                                                          'time_from': old, 'time_to': old, 'metric': 1}),
                                     content_type="application/json").status_code, 200)
+        self.assertEqual(12, len(UserStat.objects.filter(user=user)))
+
+    def test_command_compacts_only_users_with_old_notes(self):
+        user_1 = User.objects.create_user(username='testuser1', password='12345')
+        user_2 = User.objects.create_user(username='testuser2', password='12345')
+        old = timezone.now() - timedelta(days=400)
+        new = timezone.now()
+        save_notes([UserStat(user=user_1, time_from=old, time_to=old, metrics={'metric': 1}) for _ in range(12)])
+        save_notes([UserStat(user=user_2, time_from=new, time_to=new, metrics={'metric': 1}) for _ in range(5)])
+
+        out = StringIO()
+        call_command('compact_notes', stdout=out)
+        self.assertIn('Compacted notes of 1 users', out.getvalue())
+        self.assertEqual(1, len(UserStat.objects.filter(user=user_1)))
+        self.assertEqual(12, aggregate_metric_all_time(user_1, 'metric'))
+        self.assertEqual(5, len(UserStat.objects.filter(user=user_2)))
+
+
+class IdempotencyTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.note = {'time_from': '2021-05-23 14:24:20+00:00', 'time_to': '2021-05-23 14:25:20+00:00', 'lines': 4}
+
+    def test_retried_note(self):
+        c = Client()
+        note = dict(self.note, token=self.user.useruniquetoken.token, idempotency_key='client:1')
+        for _ in range(2):
+            self.assertEqual(c.post('/post/', json.dumps(note), content_type="application/json").status_code, 200)
+        self.assertEqual(c.post('/post/', json.dumps(dict(note, idempotency_key='x' * 101)),
+                                content_type="application/json").status_code, 404)
+        self.assertEqual(1, len(UserStat.objects.filter(user=self.user)))
+        self.assertEqual(4, aggregate_metric_all_time(self.user, 'lines'))
+
+    def test_retried_batch(self):
+        c = Client()
+        body = json.dumps({'token': self.user.useruniquetoken.token, 'batch_id': 'client:7', 'notes': [self.note] * 3})
+        for _ in range(2):
+            response = c.post('/post_batch/', body, content_type="application/json")
+            self.assertEqual(['ok'] * 3, [r['status'] for r in response.json()['results']])
+        self.assertEqual(3, len(UserStat.objects.filter(user=self.user)))
+        self.assertEqual(12, aggregate_metric_all_time(self.user, 'lines'))
+
+        body = json.dumps({'token': self.user.useruniquetoken.token, 'batch_id': 'client:8',
+                           'notes': [self.note, dict(self.note, idempotency_key='client:7:0')]})
+        c.post('/post_batch/', body, content_type="application/json")
+        self.assertEqual(4, len(UserStat.objects.filter(user=self.user)))
+
+    def test_long_batch_id(self):
+        c = Client()
+        body = {'token': self.user.useruniquetoken.token, 'batch_id': 'b' * BATCH_ID_MAX_LENGTH,
+                'notes': [self.note] * 2}
+        response = c.post('/post_batch/', json.dumps(body), content_type="application/json")
+        self.assertEqual(['ok'] * 2, [r['status'] for r in response.json()['results']])
+        body['batch_id'] += 'b'
+        response = c.post('/post_batch/', json.dumps(body), content_type="application/json")
+        self.assertEqual(404, response.status_code)
+        self.assertIn(str(BATCH_ID_MAX_LENGTH), response.content.decode())
+
+    def test_key_inserted_concurrently(self):
+        stats = []
+        for key in ['key', 'other', 'other']:
+            stat = UserStat(user=self.user, time_from=timezone.now(), time_to=timezone.now(), metrics={'lines': 1})
+            stat.idempotency_key = key
+            stats.append(stat)
+        bulk_create = IngestionKey.objects.bulk_create
+
+        def concurrent_bulk_create(keys, **kwargs):
+            # the retried request committed its key after this one started
+            IngestionKey.objects.create(user=self.user, key='key')
+            return bulk_create(keys, **kwargs)
+
+        with mock.patch.object(IngestionKey.objects, 'bulk_create', side_effect=concurrent_bulk_create):
+            save_notes(stats)
+        self.assertEqual(1, len(UserStat.objects.filter(user=self.user)))
+
+    def test_keys_are_per_user(self):
+        user = User.objects.create_user(username='testuser2', password='12345')
+        for owner in [self.user, user, user]:
+            stat = UserStat(user=owner, time_from=timezone.now(), time_to=timezone.now(), metrics={'lines': 1})
+            stat.idempotency_key = 'key'
+            save_notes([stat])
+        self.assertEqual(1, len(UserStat.objects.filter(user=self.user)))
+        self.assertEqual(1, len(UserStat.objects.filter(user=user)))
+
+    def test_keys_pruned(self):
+        stat = UserStat(user=self.user, time_from=timezone.now(), time_to=timezone.now(), metrics={'lines': 1})
+        stat.idempotency_key = 'key'
+        save_notes([stat])
+        call_command('compact_notes', stdout=StringIO())
+        self.assertEqual(1, len(IngestionKey.objects.all()))
+        IngestionKey.objects.update(created_at=timezone.now() - IDEMPOTENCY_KEY_RETENTION - timedelta(minutes=1))
+        call_command('compact_notes', stdout=StringIO())
+        self.assertEqual(0, len(IngestionKey.objects.all()))
+
+
+class BenchmarkQueriesTest(TestCase):
+    def test_dataset_rolled_back(self):
+        out = StringIO()
+        call_command('benchmark_queries', users=3, notes=2, messages=2, teams=2, runs=1, stdout=out)
+        self.assertIn('token lookup', out.getvalue())
+        self.assertEqual(0, len(User.objects.all()))
+        self.assertEqual(0, len(UserStat.objects.all()))
+
+
+class TimeParsingTest(TestCase):
+    def test_fast_path(self):
+        fallbacks = time_parsing_counts['fallback']
+        self.assertEqual(datetime(2021, 5, 23, 14, 24, 20, tzinfo=utc), parse_time('2021-05-23 14:24:20+00:00'))
+        self.assertEqual(datetime(2021, 5, 23, 14, 24, 20, 123000, tzinfo=utc), parse_time('2021-05-23T14:24:20.123Z'))
+        self.assertEqual(fallbacks, time_parsing_counts['fallback'])
+
+    def test_fallback(self):
+        fallbacks = time_parsing_counts['fallback']
+        self.assertEqual(datetime(2021, 5, 23, 14, 24, 20, tzinfo=utc), parse_time('23 May 2021 14:24:20 UTC'))
+        self.assertEqual(fallbacks + 1, time_parsing_counts['fallback'])
+        with self.assertRaises(ValueError):
+            parse_time('yesterday')
+
+    def test_benchmark(self):
+        out = StringIO()
+        call_command('benchmark_time_parsing', notes=10, stdout=out)
+        self.assertIn('0 fallbacks', out.getvalue())
+        self.assertIn('20 fallbacks', out.getvalue())
+
+
+class BatchDataSendingTest(TestCase):
+    def test_get(self):
+        c = Client()
+        self.assertEqual(c.get('/post_batch/').status_code, 404)
+
+    def test_incorrect_batch(self):
+        c = Client()
+        u = User.objects.create_user(username='testuser', password='12345')
+
+        self.assertEqual(c.post('/post_batch/', 'not json', content_type="application/json").status_code, 404)
+        self.assertEqual(c.post('/post_batch/', json.dumps({'notes': []}),
+                                content_type="application/json").status_code, 404)
+        self.assertEqual(c.post('/post_batch/', json.dumps({'token': u.useruniquetoken.token}),
+                                content_type="application/json").status_code, 404)
+        self.assertEqual(c.post('/post_batch/', json.dumps({'token': 'random', 'notes': []}),
+                                content_type="application/json").status_code, 404)
+        self.assertEqual(c.post('/post_batch/', json.dumps({'token': [u.useruniquetoken.token], 'notes': []}),
+                                content_type="application/json").status_code, 404)
+        self.assertEqual(c.post('/post/', json.dumps({'token': {}, 'time_from': '2021-05-23 14:24:20+00:00',
+                                                      'time_to': '2021-05-23 14:25:20+00:00'}),
+                                content_type="application/json").status_code, 404)
+        self.assertEqual(0, len(UserStat.objects.all()))
+
+    def test_out_of_range_values(self):
+        c = Client()
+        u = User.objects.create_user(username='testuser', password='12345')
+        times = {'time_from': '2021-05-23 14:24:20+00:00', 'time_to': '2021-05-23 14:25:20+00:00'}
+        notes = [dict(times, metric=3), dict(times, metric=10 ** 30), dict(times, metric=-10 ** 30),
+                 dict(times, **{'m' * 101: 1})]
+        response = c.post('/post_batch/', json.dumps({'token': u.useruniquetoken.token, 'notes': notes}),
+                          content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(['ok', 'error', 'error', 'error'], [r['status'] for r in response.json()['results']])
+        self.assertEqual(3, aggregate_metric_all_time(u, 'metric'))
+
+    def test_json_batch(self):
+        c = Client()
+        u = User.objects.create_user(username='testuser', password='12345')
+        notes = [
+            {'time_from': '2021-05-23 14:24:20+00:00', 'time_to': '2021-05-23 14:25:20+00:00', 'metric': 3},
+            {'time_from': '2021-05-23 14:25:20+00:00', 'metric': 5},
+            {'time_from': '2021-05-23 14:26:20+00:00', 'time_to': '2021-05-23 14:27:20+00:00', 'metric': 'x'},
+            {'time_from': 'yesterday', 'time_to': '2021-05-23 14:27:20+00:00', 'metric': 1},
+            {'time_from': '2021-05-23 14:28:20+00:00', 'time_to': '2021-05-23 14:29:20+00:00', 'metric': 7},
+        ]
+        response = c.post('/post_batch/', json.dumps({'token': u.useruniquetoken.token, 'notes': notes}),
+                          content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(['ok', 'error', 'error', 'error', 'ok'],
+                         [r['status'] for r in response.json()['results']])
+        self.assertEqual(2, len(UserStat.objects.filter(user=u)))
+        self.assertEqual(10, aggregate_metric_all_time(u, 'metric'))
+
+    def test_ndjson_batch(self):
+        c = Client()
+        u = User.objects.create_user(username='testuser', password='12345')
+        lines = [{'token': u.useruniquetoken.token}] + [
+            {'time_from': '2021-05-23 14:24:20+00:00', 'time_to': '2021-05-23 14:24:20+00:00', 'metric': i}
+            for i in range(1, 11)
+        ]
+        response = c.post('/post_batch/', '\n'.join(json.dumps(line) for line in lines),
+                          content_type="application/x-ndjson")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(10, len(response.json()['results']))
+        self.assertEqual(10, len(UserStat.objects.filter(user=u)))
+        self.assertEqual(55, aggregate_metric_all_time(u, 'metric'))
+
+
+class SpoolTest(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.override = self.settings(PLUGIN_INGESTION_MODE='spool',
+                                      PLUGIN_SPOOL_PATH=os.path.join(directory, 'spool.sqlite3'),
+                                      PLUGIN_SPOOL_MAX_NOTES=3)
+        self.override.enable()
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.note = {'token': self.user.useruniquetoken.token, 'time_from': '2021-05-23 14:24:20+00:00',
+                     'time_to': '2021-05-23 14:25:20+00:00', 'lines': 4}
+
+    def tearDown(self):
+        self.override.disable()
+
+    def test_accepted(self):
+        c = Client()
+        response = c.post('/post/', json.dumps(self.note), content_type="application/json")
+        self.assertEqual(response.status_code, 202)
+        response = c.post('/post_batch/', json.dumps({'token': self.user.useruniquetoken.token,
+                                                      'notes': [self.note, {'lines': 1}]}),
+                          content_type="application/json")
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(['ok', 'error'], [r['status'] for r in response.json()['results']])
+        self.assertEqual(0, len(UserStat.objects.all()))
+        self.assertEqual(2, get_spool().depth())
+
+    def test_full(self):
+        c = Client()
+        response = c.post('/post_batch/', json.dumps({'token': self.user.useruniquetoken.token,
+                                                      'notes': [self.note] * 4}),
+                          content_type="application/json")
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+        self.assertEqual(0, get_spool().depth())
+
+    def test_flush(self):
+        c = Client()
+        for _ in range(3):
+            c.post('/post/', json.dumps(self.note), content_type="application/json")
+        out = StringIO()
+        call_command('flush_spool', batch_size=2, stdout=out)
+        self.assertIn('Flushed 3 notes', out.getvalue())
+        self.assertEqual(0, get_spool().depth())
+        self.assertEqual(3, len(UserStat.objects.filter(user=self.user)))
+        self.assertEqual(12, aggregate_metric_all_time(self.user, 'lines'))
+        self.assertEqual(0, len(IngestionKey.objects.all()))
+
+    def test_failed_flush_keeps_notes(self):
+        Client().post('/post/', json.dumps(self.note), content_type="application/json")
+        with mock.patch('users.spool.save_notes', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                get_spool().flush()
+        self.assertEqual(1, get_spool().depth())
+        self.assertEqual(1, get_spool().flush())
+        self.assertEqual(1, len(UserStat.objects.filter(user=self.user)))
+
+    def test_loop_survives_database_errors(self):
+        Client().post('/post/', json.dumps(self.note), content_type="application/json")
+        failing = mock.Mock(side_effect=[OperationalError('server has gone away'), None])
+        out, err = StringIO(), StringIO()
+        with mock.patch('users.spool.save_notes', side_effect=lambda stats: failing() or save_notes(stats)), \
+                mock.patch('users.management.commands.flush_spool.close_old_connections') as close, \
+                mock.patch('users.management.commands.flush_spool.time.sleep', side_effect=[None, KeyboardInterrupt]):
+            with self.assertRaises(KeyboardInterrupt):
+                call_command('flush_spool', loop=True, interval=0, stdout=out, stderr=err)
+        self.assertIn('OperationalError', err.getvalue())
+        close.assert_called_once()
+        self.assertEqual(0, get_spool().depth())
+        self.assertEqual(1, len(UserStat.objects.filter(user=self.user)))
+
+    def test_bad_notes_moved_to_dead_letters(self):
+        get_spool().append([build_note(dict(self.note, lines=i), self.user.id) for i in range(3)])
+        bad = mock.Mock(side_effect=lambda stats: save_notes(stats) if all(
+            stat.metrics['lines'] != 1 for stat in stats) else int('bad'))
+        with mock.patch('users.spool.save_notes', bad):
+            self.assertEqual(3, get_spool().flush())
+        self.assertEqual(0, get_spool().depth())
+        self.assertEqual(2, aggregate_metric_all_time(self.user, 'lines'))
+        (user_id, note, error), = get_spool().dead_letters()
+        self.assertEqual((self.user.id, 1), (user_id, json.loads(note)['metrics']['lines']))
+        self.assertIn('ValueError', error)
+
+    def test_flush_repeated_after_crash(self):
+        for _ in range(2):
+            Client().post('/post/', json.dumps(self.note), content_type="application/json")
+        with mock.patch.object(IngestionSpool, 'remove', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                get_spool().flush()
+        self.assertEqual(2, get_spool().flush())
+        self.assertEqual(0, get_spool().depth())
+        self.assertEqual(8, aggregate_metric_all_time(self.user, 'lines'))
+        self.assertEqual(0, len(IngestionKey.objects.all()))
+
+    def test_client_keys_kept(self):
+        note = dict(self.note, idempotency_key='client')
+        get_spool().append([build_note(note, self.user.id), build_note(self.note, self.user.id)])
+        self.assertEqual(2, get_spool().flush())
+        self.assertEqual(['client'], list(IngestionKey.objects.values_list('key', flat=True)))
+
+    def test_deleted_user(self):
+        Client().post('/post/', json.dumps(self.note), content_type="application/json")
+        self.user.delete()
+        self.assertEqual(1, get_spool().flush())
+        self.assertEqual(0, get_spool().depth())
+        self.assertEqual(0, len(UserStat.objects.all()))
+
 
-        # > year
-        make_query_with_date((datetime.today() - timedelta(days=3000)).isoformat(),
-                             (datetime.today() - timedelta(days=3000)).isoformat())
-        make_query_with_date((datetime.today() - timedelta(days=1000)).isoformat(),
-                             (datetime.today() - timedelta(days=1000)).isoformat())
-        make_query_with_date((datetime.today() - timedelta(days=700)).isoformat(),
-                             (datetime.today() - timedelta(days=700)).isoformat())
-        make_query_with_date((datetime.today() - timedelta(days=400)).isoformat(),
-                             (datetime.today() - timedelta(days=400)).isoformat())
-        # > month
-        make_query_with_date((datetime.today() - timedelta(days=40)).isoformat(),
-                             (datetime.today() - timedelta(days=40)).isoformat())
-        make_query_with_date((datetime.today() - timedelta(days=31)).isoformat(),
-                             (datetime.today() - timedelta(days=31)).isoformat())
-        make_query_with_date((datetime.today() - timedelta(days=70)).isoformat(),
-                             (datetime.today() - timedelta(days=70)).isoformat())
-        # > week
-        make_query_with_date((datetime.today() - timedelta(days=29)).isoformat(),
-                             (datetime.today() - timedelta(days=29)).isoformat())
-        make_query_with_date((datetime.today() - timedelta(days=8)).isoformat(),
-                             (datetime.today() - timedelta(days=8)).isoformat())
-        # > day
-        make_query_with_date((datetime.today() - timedelta(days=6)).isoformat(),
-                             (datetime.today() - timedelta(days=6)).isoformat())
-        make_query_with_date((datetime.today() - timedelta(days=2)).isoformat(),
-                             (datetime.today() - timedelta(days=2)).isoformat())
-        # < day
-        make_query_with_date(datetime.today().isoformat(), datetime.today().isoformat())
-        make_query_with_date(datetime.today().isoformat(), datetime.today().isoformat())
-        make_query_with_date(datetime.today().isoformat(), datetime.today().isoformat())
-        make_query_with_date(datetime.today().isoformat(), datetime.today().isoformat())
-        make_query_with_date(datetime.today().isoformat(), datetime.today().isoformat())
-
-        aggregate_notes(user, 10)
-        self.assertEqual(len(UserStat.objects.all()), 9)
-        self.assertEqual(aggregate_metric_all_time(user, 'metric'), 16)
-
-        def aggregate_dt(delta):
-            s = extract_metric(UserStat.objects.filter(user=user, time_from__gte=datetime.now() - delta), 'metric')
-            return s if s else 0
-
-        self.assertEqual(aggregate_dt(timedelta(days=1)), 5)
-        self.assertEqual(aggregate_dt(timedelta(days=7)), 7)
-        self.assertEqual(aggregate_dt(timedelta(days=30)), 9)
-        self.assertEqual(aggregate_dt(timedelta(days=365)), 12)
+class AsyncPluginApiTest(TransactionTestCase):
+    def setUp(self):
+        token_cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.token = self.user.useruniquetoken.token
+
+    def test_get(self):
+        c = Client()
+        for url in ['/async/post/', '/async/post_batch/', '/async/plugin_login/', '/async/plugin_get_user_metrics/']:
+            self.assertEqual(c.get(url).status_code, 404)
+
+    def test_receive_data(self):
+        c = Client()
+        note = {'token': self.token, 'time_from': '2021-05-23 14:24:20+00:00',
+                'time_to': '2021-05-23 14:25:20+00:00', 'lines': 4}
+        self.assertEqual(c.post('/async/post/', 'not json', content_type="application/json").status_code, 404)
+        self.assertEqual(c.post('/async/post/', json.dumps(dict(note, token='random')),
+                                content_type="application/json").status_code, 404)
+        self.assertEqual(c.post('/async/post/', json.dumps(dict(note, lines='x')),
+                                content_type="application/json").status_code, 404)
+        response = c.post('/async/post/', json.dumps(note), content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b'Ok', response.content)
+        self.assertEqual(4, aggregate_metric_all_time(self.user, 'lines'))
+
+    def test_receive_batch(self):
+        c = Client()
+        notes = [
+            {'time_from': '2021-05-23 14:24:20+00:00', 'time_to': '2021-05-23 14:25:20+00:00', 'lines': 3},
+            {'time_from': '2021-05-23 14:25:20+00:00', 'lines': 5},
+        ]
+        response = c.post('/async/post_batch/', json.dumps({'token': self.token, 'notes': notes}),
+                          content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(['ok', 'error'], [r['status'] for r in response.json()['results']])
+        self.assertEqual(1, len(UserStat.objects.filter(user=self.user)))
+
+    def test_login_and_metrics(self):
+        c = Client()
+        self.assertEqual(c.post('/async/plugin_login/', json.dumps({'username': 'testuser', 'password': '1'}),
+                                content_type="application/json").status_code, 401)
+        response = c.post('/async/plugin_login/', json.dumps({'username': 'testuser', 'password': '12345'}),
+                          content_type="application/json")
+        self.assertEqual(self.token, response.json()['token'])
+
+        CharCountingMetric(name='1', char='1').save()
+        self.user.profile.add_metric('1')
+        self.assertEqual(['1'], c.get('/async/plugin_get_all_metrics/').json()[CHAR_COUNTER])
+        response = c.post('/async/plugin_get_user_metrics/', json.dumps({'token': self.token}),
+                          content_type="application/json")
+        self.assertEqual(['1'], response.json()[CHAR_COUNTER])
+
+    @override_settings(PLUGIN_RATE_LIMIT_BACKEND='cache')
+    def test_blocking_calls_off_event_loop(self):
+        on_loop = []
+
+        def blocking(*args):
+            try:
+                asyncio.get_running_loop()
+                on_loop.append(True)
+            except RuntimeError:
+                on_loop.append(False)
+            return 0
+
+        flow_control.reset()
+        with mock.patch('users.flowcontrol.FlowControl.load', side_effect=blocking), \
+                mock.patch('users.ratelimit.CacheBuckets.take', side_effect=blocking):
+            response = Client().post('/async/post_batch/', json.dumps({'token': self.token, 'notes': []}),
+                                     content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('X-Flush-Interval', response)
+        self.assertEqual([False, False], on_loop)
+
+    def test_in_flight_limit(self):
+        with mock.patch.object(async_views, '_in_flight', ASYNC_MAX_IN_FLIGHT_REQUESTS):
+            response = Client().get('/async/plugin_get_all_metrics/')
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response)
+
+
+class EncodedBodyTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.note = {'time_from': '2021-05-23 14:24:20+00:00', 'time_to': '2021-05-23 14:25:20+00:00', 'lines': 4}
+
+    def test_gzip(self):
+        c = Client()
+        body = gzip.compress(json.dumps(dict(self.note, token=self.user.useruniquetoken.token)).encode())
+        self.assertEqual(c.post('/post/', body, content_type="application/json",
+                                HTTP_CONTENT_ENCODING='gzip').status_code, 200)
+        body = gzip.compress(json.dumps({'token': self.user.useruniquetoken.token, 'notes': [self.note] * 3}).encode())
+        self.assertEqual(c.post('/post_batch/', body, content_type="application/json",
+                                HTTP_CONTENT_ENCODING='gzip').status_code, 200)
+        self.assertEqual(16, aggregate_metric_all_time(self.user, 'lines'))
+
+    def test_incorrect_encoding(self):
+        c = Client()
+        body = json.dumps(dict(self.note, token=self.user.useruniquetoken.token)).encode()
+        self.assertEqual(c.post('/post/', body, content_type="application/json",
+                                HTTP_CONTENT_ENCODING='gzip').status_code, 404)
+        self.assertEqual(c.post('/post/', body, content_type="application/json",
+                                HTTP_CONTENT_ENCODING='br').status_code, 404)
+        self.assertEqual(0, len(UserStat.objects.all()))
+
+    def test_metric_ids(self):
+        metric = CharCountingMetric.objects.create(name='a', char='a')
+        self.user.profile.add_metric('a')
+        response = Client().post('/plugin_get_user_metrics/', json.dumps({'token': self.user.useruniquetoken.token}),
+                                 content_type="application/json")
+        self.assertEqual({'a': metric.id}, response.json()[METRIC_IDS])
+
+        notes = [{**self.note, metric.id: 2}, {**self.note, metric.id + 1: 2}]
+        decode_metric_ids(notes)
+        self.assertEqual(2, notes[0]['a'])
+        self.assertEqual(['ok', 'error'], [r['status'] for r in validate_batch(notes, self.user.id)[0]])
+
+    @unittest.skipIf(msgpack is None, 'msgpack is not installed')
+    def test_msgpack(self):
+        metric = CharCountingMetric.objects.create(name='a', char='a')
+        body = msgpack.packb({'token': self.user.useruniquetoken.token, 'notes': [{**self.note, metric.id: 2}]})
+        response = Client().post('/post_batch/', body, content_type=MSGPACK_CONTENT_TYPE)
+        self.assertEqual(['ok'], [r['status'] for r in response.json()['results']])
+        self.assertEqual(2, aggregate_metric_all_time(self.user, 'a'))
+
+
+class RateLimitTest(TestCase):
+    def setUp(self):
+        local_buckets.clear()
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.note = {'token': self.user.useruniquetoken.token, 'time_from': '2021-05-23 14:24:20+00:00',
+                     'time_to': '2021-05-23 14:25:20+00:00', 'lines': 4}
+
+    def tearDown(self):
+        local_buckets.clear()
+        cache.clear()
+
+    def test_refill(self):
+        state, wait = refill(None, 0, 2, 2)
+        self.assertEqual(0, wait)
+        state, wait = refill(state, 0, 2, 2)
+        self.assertEqual(0, wait)
+        state, wait = refill(state, 0, 2, 2)
+        self.assertEqual(0.5, wait)
+        state, wait = refill(state, 0.5, 2, 2)
+        self.assertEqual(0, wait)
+
+    def test_local_buckets_bounded(self):
+        buckets = LocalBuckets(max_size=2)
+        for key in ['a', 'b', 'c']:
+            buckets.take(key, 0, 1, 1)
+        self.assertNotEqual(0, buckets.take('c', 0, 1, 1))
+        self.assertEqual(0, buckets.take('a', 0, 1, 1))
+
+    def test_ingestion_limited_per_token(self):
+        c = Client()
+        user = User.objects.create_user(username='testuser2', password='12345')
+        with mock.patch.dict(RATE_LIMITS, ingest=(0.001, 2)):
+            for status in [200, 200, 429]:
+                response = c.post('/post/', json.dumps(self.note), content_type="application/json")
+                self.assertEqual(status, response.status_code)
+            self.assertIn('Retry-After', response)
+            self.assertEqual(200, c.post('/post/', json.dumps(dict(self.note, token=user.useruniquetoken.token)),
+                                         content_type="application/json").status_code)
+        self.assertEqual(2, len(UserStat.objects.filter(user=self.user)))
+
+    @override_settings(PLUGIN_RATE_LIMIT_BACKEND='cache')
+    def test_login_limited_per_ip_in_cache(self):
+        c = Client()
+        credentials = json.dumps({'username': 'testuser', 'password': '12345'})
+        with mock.patch.dict(RATE_LIMITS, login=(0.001, 1)):
+            self.assertEqual(200, c.post('/plugin_login/', credentials, content_type="application/json",
+                                         REMOTE_ADDR='10.0.0.1').status_code)
+            self.assertEqual(429, c.post('/plugin_login/', credentials, content_type="application/json",
+                                         REMOTE_ADDR='10.0.0.1').status_code)
+            self.assertEqual(200, c.post('/plugin_login/', credentials, content_type="application/json",
+                                         REMOTE_ADDR='10.0.0.2').status_code)
+
+    @override_settings(PLUGIN_RATE_LIMIT_BACKEND='cache')
+    def test_cache_buckets_use_wall_clock(self):
+        # bucket emptied by another host ten seconds ago
+        cache.set('ratelimit:login:10.0.0.1', (0, time.time() - 10))
+        with mock.patch.dict(RATE_LIMITS, login=(0.5, 30)):
+            self.assertIsNone(check_rate_limit('login', '10.0.0.1'))
+        tokens, updated = cache.get('ratelimit:login:10.0.0.1')
+        self.assertAlmostEqual(4, tokens, delta=0.1)
+        self.assertAlmostEqual(time.time(), updated, delta=5)
+
+    @override_settings(PLUGIN_WORKER_THREADS=4)
+    def test_load_shedding(self):
+        self.assertEqual(2, ingestion_limiter.limit)
+        self.assertTrue(ingestion_limiter.acquire())
+        try:
+            response = Client().post('/post/', json.dumps(self.note), content_type="application/json")
+            self.assertEqual(200, response.status_code)
+            self.assertTrue(ingestion_limiter.acquire())
+            try:
+                # two of four threads stay free for the dashboard
+                response = Client().post('/post/', json.dumps(self.note), content_type="application/json")
+            finally:
+                ingestion_limiter.release()
+        finally:
+            ingestion_limiter.release()
+        self.assertEqual(503, response.status_code)
+        self.assertIn('Retry-After', response)
+        self.assertEqual(1, len(UserStat.objects.all()))
+        self.assertEqual(0, ingestion_limiter.active)
+
+
+class FlowControlTest(TestCase):
+    def setUp(self):
+        flow_control.reset()
+        self.user = User.objects.create_user(username='testuser', password='12345')
+
+    def tearDown(self):
+        flow_control.reset()
+
+    def test_idle(self):
+        self.assertEqual({'flush_interval': FLUSH_INTERVAL_SECONDS, 'max_batch_size': BATCH_MAX_NOTES},
+                         flow_control.control())
+
+    def test_latency(self):
+        flow_control.record(FLUSH_CONTROL_TARGET_LATENCY * 4)
+        flow_control.record(FLUSH_CONTROL_TARGET_LATENCY * 4)
+        self.assertEqual({'flush_interval': FLUSH_INTERVAL_SECONDS * 4, 'max_batch_size': BATCH_MAX_NOTES // 4},
+                         flow_control.control())
+        flow_control.reset()
+        flow_control.record(FLUSH_CONTROL_TARGET_LATENCY * 1000)
+        self.assertEqual({'flush_interval': FLUSH_INTERVAL_MAX_SECONDS, 'max_batch_size': FLUSH_CONTROL_MIN_BATCH_SIZE},
+                         flow_control.control())
+
+    def test_spool_depth(self):
+        with self.settings(PLUGIN_INGESTION_MODE='spool',
+                           PLUGIN_SPOOL_PATH=os.path.join(tempfile.mkdtemp(), 'spool.sqlite3')):
+            note = UserStat(user=self.user, time_from=timezone.now(), time_to=timezone.now(), metrics={'lines': 1})
+            get_spool().append([note] * 3)
+            with mock.patch('users.flowcontrol.FLUSH_CONTROL_TARGET_SPOOL_DEPTH', 1):
+                self.assertEqual(FLUSH_INTERVAL_SECONDS * 3, flow_control.control()['flush_interval'])
+
+    def test_responses(self):
+        c = Client()
+        token = self.user.useruniquetoken.token
+        note = {'time_from': '2021-05-23 14:24:20+00:00', 'time_to': '2021-05-23 14:25:20+00:00', 'lines': 4}
+        response = c.post('/post/', json.dumps(dict(note, token=token)), content_type="application/json")
+        self.assertEqual(str(FLUSH_INTERVAL_SECONDS), response['X-Flush-Interval'])
+        self.assertEqual(str(BATCH_MAX_NOTES), response['X-Max-Batch-Size'])
+        self.assertIsNotNone(flow_control.latency)
+
+        response = c.post('/post_batch/', json.dumps({'token': token, 'notes': [note]}), content_type="application/json")
+        self.assertEqual(FLUSH_INTERVAL_SECONDS, response.json()['flush_control']['flush_interval'])
+        response = c.post('/plugin_get_user_metrics/', json.dumps({'token': token}), content_type="application/json")
+        self.assertEqual(BATCH_MAX_NOTES, response.json()[FLUSH_CONTROL]['max_batch_size'])
+
+
+class PluginBootstrapTest(TestCase):
+    def setUp(self):
+        token_cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.token = self.user.useruniquetoken.token
+        CharCountingMetric.objects.create(name='char', char='a')
+        WordCountingMetric.objects.create(name='word', word='abc')
+        SpecificLengthCopyCounterMetric.objects.create(name='copy', substring_length=3)
+        Metric.objects.create(name=COMMIT_COUNTER, string_representation='Commits')
+        for name in ['char', 'word', 'copy', COMMIT_COUNTER]:
+            self.user.profile.add_metric(name)
+
+    def post(self, data, **headers):
+        return Client().post('/plugin_bootstrap/', json.dumps(data), content_type="application/json", **headers)
+
+    def test_config(self):
+        response = self.post({'token': self.token})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(self.token, response.json()['token'])
+        metrics = response.json()['metrics']
+        self.assertEqual(['a'], metrics[CHAR_COUNTER])
+        self.assertEqual(['abc'], metrics[WORD_COUNTER])
+        self.assertEqual([3], metrics[SPECIFIC_LENGTH_COPY_COUNTER])
+        self.assertEqual([], metrics[SUBSTRING_COUNTER])
+        self.assertEqual(COMMIT_COUNTER, metrics[COMMIT_COUNTER])
+        self.assertEqual({'char', 'word', 'copy', COMMIT_COUNTER}, set(metrics[METRIC_IDS]))
+
+        response = Client().post('/plugin_get_user_metrics/', json.dumps({'token': self.token}),
+                                 content_type="application/json")
+        service_keys = (FLUSH_CONTROL, CONFIG_VERSION)
+        self.assertEqual(metrics, {k: v for k, v in response.json().items() if k not in service_keys})
+
+    def test_login(self):
+        self.assertEqual(401, self.post({'username': 'testuser', 'password': '1'}).status_code)
+        self.assertEqual(404, self.post({'username': 'testuser'}).status_code)
+        response = self.post({'username': 'testuser', 'password': '12345'})
+        self.assertEqual(self.token, response.json()['token'])
+        self.assertEqual(response['ETag'], self.post({'token': self.token})['ETag'])
+
+    def test_single_query(self):
+        get_user_id(self.token)
+        with self.settings(CACHES=LOCAL_CACHES):
+            # config version and metrics config
+            with self.assertNumQueries(2):
+                self.post({'token': self.token})
+            with self.assertNumQueries(0):
+                self.post({'token': self.token})
+
+    def test_changed_by_other_process(self):
+        etag = self.post({'token': self.token})['ETag']
+        # another process changes the tracked metrics, the cached configuration is removed from the shared cache
+        with mock.patch('users.signals.config_changed'):
+            self.user.profile.remove_metric('char')
+        Profile.objects.filter(user=self.user).update(config_version=F('config_version') + 1)
+        self.assertEqual(304, self.post({'token': self.token}, HTTP_IF_NONE_MATCH=etag).status_code)
+        forget_metrics_config([self.user.id])
+        response = self.post({'token': self.token}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([], response.json()['metrics'][CHAR_COUNTER])
+        self.assertEqual(Profile.objects.get(user=self.user).config_version, response.json()['config_version'])
+
+    def test_not_modified(self):
+        etag = self.post({'token': self.token})['ETag']
+        # with the default database cache only the cached configuration is read
+        with self.assertNumQueries(1):
+            response = self.post({'token': self.token}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+
+        self.user.profile.remove_metric('char')
+        response = self.post({'token': self.token}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([], response.json()['metrics'][CHAR_COUNTER])
+
+        etag = response['ETag']
+        metric = WordCountingMetric.objects.get(name='word')
+        metric.word = 'abcd'
+        metric.save()
+        response = self.post({'token': self.token}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(['abcd'], response.json()['metrics'][WORD_COUNTER])
+
+
+class ConfigVersionTest(TransactionTestCase):
+    def setUp(self):
+        token_cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.token = self.user.useruniquetoken.token
+        CharCountingMetric.objects.create(name='char', char='a')
+
+    def poll(self, version):
+        return Client().post('/async/plugin_config_changes/', json.dumps({'token': self.token, 'version': version}),
+                             content_type="application/json")
+
+    def test_version_bumped(self):
+        self.assertEqual(0, config_version(self.user.id))
+        self.user.profile.add_metric('char')
+        self.assertEqual(1, config_version(self.user.id))
+        self.assertEqual(1, Profile.objects.get(user=self.user).config_version)
+        Metric.objects.get(name='char').metrics.clear()
+        self.assertEqual(2, config_version(self.user.id))
+        team = Team.objects.create(name='team')
+        team.tracked_metrics.add(Metric.objects.get(name='char'))
+        self.assertEqual(2, config_version(self.user.id))
+
+    def test_poll_changed(self):
+        self.user.profile.add_metric('char')
+        response = self.poll(0)
+        self.assertEqual(True, response.json()['changed'])
+        self.assertEqual(1, response.json()['config_version'])
+        self.assertEqual(['a'], response.json()['metrics'][CHAR_COUNTER])
+
+    def test_poll_timeout(self):
+        with mock.patch.object(async_views, 'CONFIG_POLL_TIMEOUT_SECONDS', 0.05), \
+                mock.patch.object(async_views, 'CONFIG_POLL_INTERVAL_SECONDS', 0.01):
+            response = self.poll(0)
+        self.assertEqual({'changed': False, 'config_version': 0}, response.json())
+        self.assertEqual(404, self.poll('0').status_code)
+
+    def test_polls_share_queries(self):
+        users = [User.objects.create_user(username=f'plugin{i}', password='12345') for i in range(20)]
+        polls = []
+
+        def counted_versions(user_ids):
+            polls.append(set(user_ids))
+            return config_versions(user_ids)
+
+        async def poll_all():
+            client = AsyncClient()
+            responses = [client.post('/async/plugin_config_changes/',
+                                     json.dumps({'token': user.useruniquetoken.token, 'version': 0}),
+                                     content_type="application/json") for user in users]
+            return await asyncio.gather(change_first(), *responses)
+
+        async def change_first():
+            await asyncio.sleep(0.05)
+            await sync_to_async(config_changed, thread_sensitive=False)([users[0].id])
+
+        with mock.patch.object(async_views, 'config_versions', counted_versions), \
+                mock.patch.object(async_views, 'CONFIG_POLL_TIMEOUT_SECONDS', 0.2), \
+                mock.patch.object(async_views, 'CONFIG_POLL_INTERVAL_SECONDS', 0.02):
+            responses = asyncio.run(poll_all())[1:]
+        self.assertEqual([True] + [False] * 19, [response.json()['changed'] for response in responses])
+        # one query per interval for all waiting plugins
+        self.assertLessEqual(len(polls), 0.2 / 0.02 + 1)
+        self.assertGreater(max(len(user_ids) for user_ids in polls), len(users) // 2)
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class MetricTypeTest(TestCase):
+    def test_kind_and_display_name(self):
+        char = CharCountingMetric.objects.create(name='CharCounter(a)', char='a')
+        copy = SpecificLengthCopyCounterMetric.objects.create(name='SpecificLengthCopyCounter(3)', substring_length=3)
+        plain = Metric.objects.create(name=COMMIT_COUNTER, string_representation='Commits')
+        self.assertEqual(('charcountingmetric', 'Number of "a" characters'), (char.kind, char.display_name))
+        self.assertEqual('Number of copied words with length 3', copy.display_name)
+        self.assertEqual(('', 'Commits'), (plain.kind, plain.display_name))
+
+        metric = Metric.objects.get(name='CharCounter(a)')
+        with self.assertNumQueries(0):
+            self.assertEqual('Number of "a" characters', str(metric))
+        self.assertEqual(char, metric.concrete())
+        self.assertIsInstance(metric.concrete(), CharCountingMetric)
+        self.assertEqual(plain, Metric.objects.get(name=COMMIT_COUNTER).concrete())
+
+        metric.save()
+        char = CharCountingMetric.objects.get(pk=char.pk)
+        self.assertEqual('charcountingmetric', char.kind)
+        char.char = 'b'
+        char.save()
+        self.assertEqual('Number of "b" characters', str(Metric.objects.get(pk=char.pk)))
+
+    def test_listing(self):
+        user = User.objects.create_user(username='testuser', password='12345')
+        for i in range(5):
+            WordCountingMetric.objects.create(name=f'word{i}', word=f'word{i}')
+            user.profile.add_metric(f'word{i}')
+        profile = Profile.objects.get(user=user)
+        metric_catalog.names()
+        with self.assertNumQueries(1):
+            metrics = profile.get_metrics()
+        self.assertEqual('Number of "word3" word', metrics['word3'])
+        self.assertEqual(6, len(metrics))
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class MetricCatalogTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        metric_catalog.invalidate()
+
+    def expire_check(self):
+        return mock.patch('users.catalog.time.monotonic', return_value=time.monotonic() + METRIC_CATALOG_CHECK_SECONDS)
+
+    def test_loaded_once(self):
+        WordCountingMetric.objects.create(name='word', word='word')
+        self.assertEqual({'word': 'Number of "word" word'}, metric_catalog.names())
+        loads = metric_catalog.loads
+        with self.assertNumQueries(0):
+            self.assertEqual({'word': 'Number of "word" word'}, metric_catalog.display_names(['word']))
+        self.assertEqual(loads, metric_catalog.loads)
+
+    def test_stamp_read_once_per_interval(self):
+        catalog = MetricCatalog()
+        with mock.patch('users.catalog.cache') as shared:
+            shared.get.return_value = 'version'
+            for _ in range(3):
+                catalog.display_names(['word'])
+            self.assertEqual(1, shared.get.call_count)
+            with self.expire_check():
+                catalog.names()
+            self.assertEqual(2, shared.get.call_count)
+
+    def test_reloaded_on_change(self):
+        metric = Metric.objects.create(name=COMMIT_COUNTER, string_representation='Commits')
+        self.assertEqual({COMMIT_COUNTER: 'Commits'}, metric_catalog.names())
+        CharCountingMetric.objects.create(name='CharCounter(a)', char='a')
+        self.assertEqual('Number of "a" characters', metric_catalog.names()['CharCounter(a)'])
+        metric.delete()
+        self.assertEqual(['CharCounter(a)'], list(metric_catalog.names()))
+
+    def test_shared_version(self):
+        Metric.objects.create(name=COMMIT_COUNTER, string_representation='Commits')
+        other = MetricCatalog()
+        other.names()
+        Metric.objects.filter(name=COMMIT_COUNTER).update(display_name='Commits made')
+        self.assertEqual('Commits', other.names()[COMMIT_COUNTER])
+        metric_catalog.invalidate()
+        self.assertEqual('Commits', other.names()[COMMIT_COUNTER])
+        with self.expire_check():
+            self.assertEqual('Commits made', other.names()[COMMIT_COUNTER])
+        self.assertEqual(2, other.loads)
+
+    def test_reloaded_on_miss(self):
+        other = MetricCatalog()
+        self.assertEqual({}, other.names())
+        # the new stamp is not seen by the other process yet
+        WordCountingMetric.objects.create(name='word', word='word')
+        self.assertEqual({'word': 'Number of "word" word'}, other.display_names(['word']))
+        self.assertEqual({}, other.display_names(['other']))
+        self.assertEqual(3, other.loads)
+        # names still missing are not reloaded again under the same stamp
+        with self.assertNumQueries(0):
+            self.assertEqual({'word': 'Number of "word" word'}, other.display_names(['word', 'other']))
+        self.assertEqual(3, other.loads)
+
+
+class UserFeedTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.small = Team.objects.create(name='small')
+        self.small.users.add(self.user)
+        self.large = Team.objects.create(name='large')
+        self.large.admins.add(self.user)
+        self.large.users.add(*[User.objects.create(username=f'member{i}')
+                               for i in range(FANOUT_ON_WRITE_MAX_MEMBERS)])
+
+    def test_hybrid_fan_out(self):
+        notify_team(self.small, 'small event')
+        notify_team(self.large, 'large event')
+        self.assertEqual(1, FeedMessage.objects.filter(msg_content='small event').count())
+        self.assertFalse(FeedMessage.objects.filter(msg_content='large event').exists())
+        self.assertEqual(['large event'], [event.msg_content for event in self.large.events.all()])
+
+    def test_merged_feed(self):
+        start = timezone.now()
+        other = Team.objects.create(name='other')
+        other.admins.add(User.objects.get(username='member0'))
+        for i in range(10):
+            created_at = start + timedelta(minutes=i)
+            if i % 2:
+                TeamEvent.objects.create(team=self.large, sender='large', msg_content=str(i), created_at=created_at)
+            else:
+                FeedMessage.objects.create(sender='small', receiver=self.user, msg_content=str(i),
+                                           created_at=created_at)
+            TeamEvent.objects.create(team=other, sender='other', msg_content='other', created_at=created_at)
+
+        feed = UserFeed(self.user)
+        messages, previous, after = feed.page(size=4)
+        self.assertEqual((['9', '8', '7', '6'], None), ([message.msg_content for message in messages], previous))
+        messages, previous, last = feed.page(after=after, size=4)
+        self.assertEqual(['5', '4', '3', '2'], [message.msg_content for message in messages])
+        messages, previous, after = feed.page(after=last, size=4)
+        self.assertEqual((['1', '0'], None), ([message.msg_content for message in messages], after))
+        messages, previous, after = feed.page(before=previous, size=4)
+        self.assertEqual(['5', '4', '3', '2'], [message.msg_content for message in messages])
+        self.assertEqual(last, after)
+        messages, previous, after = feed.page(before=previous, size=4)
+        self.assertEqual((['9', '8', '7', '6'], None), ([message.msg_content for message in messages], previous))
+
+    def test_same_time_messages(self):
+        created_at = timezone.now()
+        for i in range(3):
+            FeedMessage.objects.create(sender='small', receiver=self.user, msg_content='message', created_at=created_at)
+            TeamEvent.objects.create(team=self.large, sender='large', msg_content='event', created_at=created_at)
+
+        feed = UserFeed(self.user)
+        seen, after = [], None
+        for page in range(3):
+            messages, _, after = feed.page(after=after, size=2)
+            seen += [(message.msg_content, message.id) for message in messages]
+        self.assertIsNone(after)
+        self.assertEqual(['event'] * 3 + ['message'] * 3, [content for content, _ in seen])
+        self.assertEqual(6, len(set(seen)))
+
+    def test_constant_page_cost(self):
+        start = timezone.now()
+        FeedMessage.objects.bulk_create([FeedMessage(sender='small', receiver=self.user, msg_content=str(i),
+                                                     created_at=start + timedelta(seconds=i)) for i in range(100)])
+        feed = UserFeed(self.user)
+        after = feed.page(size=10)[2]
+        for i in range(5):
+            # team ids, personal messages and events of the two teams
+            with self.assertNumQueries(4):
+                messages, _, after = UserFeed(self.user).page(after=after, size=10)
+        self.assertEqual('40', messages[-1].msg_content)
+        with self.assertRaises(ValueError):
+            feed.page(after='broken')
+
+
+class TokenCacheTest(TestCase):
+    def setUp(self):
+        token_cache.clear()
+
+    def test_lru_and_ttl(self):
+        cache = TokenCache(max_size=2, ttl=60)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(1, cache.get('a'))
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(3, cache.get('c'))
+        self.assertEqual({'hits': 2, 'misses': 1, 'size': 2}, cache.stats())
+
+        cache = TokenCache(max_size=2, ttl=-1)
+        cache.put('a', 1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(0, cache.stats()['size'])
+
+    def test_token_lookup_is_cached(self):
+        u = User.objects.create_user(username='testuser', password='12345')
+        token = u.useruniquetoken.token
+        self.assertEqual(u.id, get_user_id(token))
+        hits = token_cache.stats()['hits']
+        with self.assertNumQueries(0):
+            self.assertEqual(u.id, get_user_id(token))
+        self.assertEqual(hits + 1, token_cache.stats()['hits'])
+
+    def test_cache_invalidated_on_token_change(self):
+        u = User.objects.create_user(username='testuser', password='12345')
+        c = Client()
+        old_token = u.useruniquetoken.token
+        note = {'time_from': '2021-05-23 14:24:20+00:00', 'time_to': '2021-05-23 14:24:20+00:00'}
+        self.assertEqual(c.post('/post/', json.dumps(dict(note, token=old_token)),
+                                content_type="application/json").status_code, 200)
+
+        u.useruniquetoken.token = 'new token'
+        u.useruniquetoken.save()
+        self.assertEqual(c.post('/post/', json.dumps(dict(note, token=old_token)),
+                                content_type="application/json").status_code, 404)
+        self.assertEqual(c.post('/post/', json.dumps(dict(note, token='new token')),
+                                content_type="application/json").status_code, 200)
+
+        u.useruniquetoken.delete()
+        self.assertEqual(c.post('/post/', json.dumps(dict(note, token='new token')),
+                                content_type="application/json").status_code, 404)
 
 
 class PluginLoginTest(TestCase):
@@ -0,0 +1,130 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.http import Http404
+
+from .config import *
+from .models import UserUniqueToken
+
+
+class TokenCache:
+    """
+    Bounded LRU cache mapping plugin tokens to user ids, entries expire after the given time
+
+    Cache is local to the process, tokens changed by other processes are seen after entries expire.
+
+    Attributes:
+    ----------
+    max_size :
+        Maximal number of cached tokens
+    ttl :
+        Time to live of the entry in seconds
+    hits :
+        Number of lookups served from the cache
+    misses :
+        Number of lookups which missed the cache
+    """
+
+    def __init__(self, max_size=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL.total_seconds()):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._user_tokens = {}
+        self._lock = threading.Lock()
+
+    def _remove(self, token):
+        user_id, _ = self._entries.pop(token)
+        tokens = self._user_tokens[user_id]
+        tokens.discard(token)
+        if not tokens:
+            del self._user_tokens[user_id]
+
+    def get(self, token):
+        """
+        Returns id of the token owner if the token is cached.
+
+                Parameters:
+                        token: Plugin token
+
+                Returns:
+                        User id or None
+        """
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    self._remove(token)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, token, user_id):
+        """
+        Caches the token owner, evicting the least recently used token if the cache is full.
+
+                Parameters:
+                        token: Plugin token
+                        user_id: Id of the token owner
+        """
+        with self._lock:
+            if token in self._entries:
+                self._remove(token)
+            self._entries[token] = (user_id, time.monotonic() + self.ttl)
+            self._user_tokens.setdefault(user_id, set()).add(token)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate_user(self, user_id):
+        """
+        Removes all cached tokens of the user.
+
+                Parameters:
+                        user_id: Id of the tokens owner
+        """
+        with self._lock:
+            for token in list(self._user_tokens.get(user_id, ())):
+                self._remove(token)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._user_tokens.clear()
+
+    def stats(self):
+        """
+        Returns cache counters.
+
+                Returns:
+                        Dictionary with numbers of hits, misses and cached tokens
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+
+token_cache = TokenCache()
+
+
+def get_user_id(token):
+    """
+    Returns id of the token owner, looking the token up in the database only on cache misses.
+
+            Parameters:
+                    token: Plugin token
+
+            Returns:
+                    User id, Http404 is raised if the token does not exist
+    """
+    if not isinstance(token, str):
+        raise Http404('Invalid token')
+    user_id = token_cache.get(token)
+    if user_id is None:
+        user_id = UserUniqueToken.objects.filter(token=token).values_list('user_id', flat=True).first()
+        if user_id is None:
+            raise Http404('Invalid token')
+        token_cache.put(token, user_id)
+    return user_id
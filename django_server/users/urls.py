@@ -1,9 +1,10 @@
 from django.urls import path
 from django.contrib.auth import views as auth_views
-from . import views
+from . import async_views, views
 
 urlpatterns = [
     path('post/', views.receive_data, name='post'),
+    path('post_batch/', views.receive_batch, name='post_batch'),
     path('profile/', views.profile, name='profile'),
     path('plugin_login/', views.plugin_login, name='plugin_login'),
     path('register/', views.register, name='register'),
@@ -11,4 +12,12 @@ urlpatterns = [
     path('logout/', auth_views.LogoutView.as_view(template_name='users/logout.html'), name='logout'),
     path('plugin_get_all_metrics/', views.all_metrics, name='plugin_get_all_metrics'),
     path('plugin_get_user_metrics/', views.user_metrics, name='plugin_get_user_metrics'),
+    path('plugin_bootstrap/', views.plugin_bootstrap, name='plugin_bootstrap'),
+    path('async/post/', async_views.receive_data, name='async_post'),
+    path('async/post_batch/', async_views.receive_batch, name='async_post_batch'),
+    path('async/plugin_login/', async_views.plugin_login, name='async_plugin_login'),
+    path('async/plugin_get_all_metrics/', async_views.all_metrics, name='async_plugin_get_all_metrics'),
+    path('async/plugin_get_user_metrics/', async_views.user_metrics, name='async_plugin_get_user_metrics'),
+    path('async/plugin_bootstrap/', async_views.plugin_bootstrap, name='async_plugin_bootstrap'),
+    path('async/plugin_config_changes/', async_views.config_changes, name='async_plugin_config_changes'),
 ]
@@ -1,17 +1,21 @@
+import hashlib
 import json
-import pytz
 
-utc=pytz.UTC
-
-import dateutil.parser
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponseNotFound, HttpResponse, JsonResponse
+from django.http import HttpResponseNotFound, HttpResponseNotModified, HttpResponse, JsonResponse
 from django.shortcuts import render, redirect, get_object_or_404
+from django.utils.http import parse_etags
 from django.views.decorators.csrf import csrf_exempt
 
 from .forms import *
+from .ingestion import NoteValidationError, build_note, decode_body, decode_metric_ids, parse_batch, validate_batch
 from .models import *
+from .plugin_config import metrics_config
+from .flowcontrol import add_control_headers, flow_control, flush_controlled
+from .ratelimit import check_rate_limit, client_ip, shed_load
+from .spool import SpoolFullError, store_notes
+from .tokens import get_user_id
 from .config import *
 
 
@@ -40,73 +44,79 @@ def register(request):
                                                    })
 
 
-def cut_interval(qs, now, delta):
-    return qs.filter(time_to__lte=now - delta)
-
-
-def aggregate_interval(stats, user):
-    min_date = utc.localize(datetime.now())
-    max_date = utc.localize(datetime(1971, 1, 1))
-    metrics_aggregated = {}
-    for q in stats:
-        min_date = min(min_date, q.time_from)
-        max_date = max(max_date, q.time_to)
-        for metric_name in q.metrics:
-            #print(metric_name)
-            if metric_name not in metrics_aggregated:
-                metrics_aggregated[metric_name] = 0
-            metrics_aggregated[metric_name] += int(q.metrics[metric_name])
-    us = UserStat(user=user, metrics=metrics_aggregated, time_from=min_date, time_to=max_date)
-    us.save()
-    return us
-
+@csrf_exempt
+@flush_controlled
+@shed_load
+def receive_data(request):
+    if request.method == 'GET':
+        return HttpResponseNotFound()
 
-def aggregate_notes(user, threshold=100000):
-    user_stats = UserStat.objects.filter(user=user)
-    if len(user_stats) <= threshold:
-        return
+    try:
+        data = decode_body(request)
+    except NoteValidationError as e:
+        return HttpResponseNotFound(str(e))
+    if not isinstance(data, dict) or 'token' not in data or 'time_from' not in data or 'time_to' not in data:
+        return HttpResponseNotFound("'token', 'time_from' or 'time_to' are not in received data")
+    if not isinstance(data['token'], str):
+        return HttpResponseNotFound("'token' must be a string")
+    limited = check_rate_limit('ingest', data['token'])
+    if limited:
+        return limited
 
-    now = datetime.now()
-    intervals = []
+    user_id = get_user_id(data['token'])
+    decode_metric_ids([data])
+    try:
+        stat = build_note(data, user_id)
+    except NoteValidationError as e:
+        return HttpResponseNotFound(str(e))
 
-    for delta in [timedelta(days=365), timedelta(days=30), timedelta(days=7), timedelta(days=1)]:
-        interval = cut_interval(user_stats, now, delta)
-        user_stats = user_stats.exclude(pk__in=interval.values_list('id', flat=True))
-        intervals.append(interval)
+    try:
+        spooled = store_notes([stat])
+    except SpoolFullError as e:
+        return spool_full_response(e)
 
-    new_us = []
-    for interval in intervals:
-        new_us.append(aggregate_interval(interval, user).id)
-    new_us_qs = UserStat.objects.filter(pk__in=new_us)
-    user_stats |= new_us_qs
-    for us in UserStat.objects.all().exclude(pk__in=user_stats):
-        UserStat.objects.filter(id=us.id).delete()
+    return notes_stored_response(spooled)
 
 
 @csrf_exempt
-def receive_data(request):
+@flush_controlled
+@shed_load
+def receive_batch(request):
     if request.method == 'GET':
         return HttpResponseNotFound()
 
-    data = json.loads(request.body.decode())
-    if 'token' not in data or 'time_from' not in data or 'time_to' not in data:
-        return HttpResponseNotFound("'token', 'time_from' or 'time_to' are not in received data")
+    try:
+        token, notes, batch_id = parse_batch(request)
+    except NoteValidationError as e:
+        return HttpResponseNotFound(str(e))
+    limited = check_rate_limit('ingest', token)
+    if limited:
+        return limited
+
+    user_id = get_user_id(token)
+    decode_metric_ids(notes)
+    statuses, stats = validate_batch(notes, user_id, batch_id)
+    try:
+        spooled = store_notes(stats)
+    except SpoolFullError as e:
+        return spool_full_response(e)
 
-    stat = UserStat()
-    user = get_object_or_404(UserUniqueToken, token=data['token']).user
-    stat.user = user
-    stat.time_from = dateutil.parser.parse(data['time_from'])
-    stat.time_to = dateutil.parser.parse(data['time_to'])
+    return batch_stored_response(statuses, spooled)
 
-    del data['time_to']
-    del data['time_from']
-    del data['token']
 
-    stat.metrics = data
-    stat.save()
+def notes_stored_response(spooled):
+    return HttpResponse("Accepted", status=202) if spooled else HttpResponse("Ok")
 
-    aggregate_notes(user)
-    return HttpResponse("Ok")
+
+def batch_stored_response(statuses, spooled, control=None):
+    return JsonResponse({'results': statuses, 'flush_control': control or flow_control.control()},
+                        status=202 if spooled else 200)
+
+
+def spool_full_response(error):
+    response = HttpResponse(str(error), status=429)
+    response['Retry-After'] = SPOOL_RETRY_AFTER_SECONDS
+    return response
 
 
 @csrf_exempt
@@ -117,11 +127,21 @@ def plugin_login(request):
     data = json.loads(request.body.decode())
     if 'username' not in data or 'password' not in data:
         return HttpResponseNotFound("'username' or 'password' are not in received data")
-    user = get_object_or_404(User, username=data['username'])
-    if not user.check_password(data['password']):
+    limited = check_rate_limit('login', client_ip(request))
+    if limited:
+        return limited
+    token = plugin_token(data['username'], data['password'])
+    if token is None:
         return HttpResponse('Invalid password', status=401)
 
-    return JsonResponse({"token": user.useruniquetoken.token})
+    return JsonResponse({"token": token})
+
+
+def plugin_token(username, password):
+    user = get_object_or_404(User, username=username)
+    if not user.check_password(password):
+        return None
+    return user.useruniquetoken.token
 
 
 @login_required
@@ -146,12 +166,19 @@ def profile(request):
     return render(request, 'users/profile.html', context)
 
 
-@csrf_exempt
-def all_metrics(request):
-    return JsonResponse({
+def all_metrics_dict():
+    return {
         CHAR_COUNTER: [m.char for m in CharCountingMetric.objects.all()],
         WORD_COUNTER: [m.substring for m in SubstringCountingMetric.objects.all()]
-    })
+    }
+
+
+@csrf_exempt
+def all_metrics(request):
+    limited = check_rate_limit('metrics', client_ip(request))
+    if limited:
+        return limited
+    return JsonResponse(all_metrics_dict())
 
 
 @csrf_exempt
@@ -162,59 +189,67 @@ def user_metrics(request):
     data = json.loads(request.body.decode())
     if 'token' not in data:
         return HttpResponseNotFound("'token' is absent in received data")
+    limited = check_rate_limit('metrics', data['token'])
+    if limited:
+        return limited
 
-    user = get_object_or_404(UserUniqueToken, token=data['token']).user
-    metrics = list(user.profile.get_metrics().keys())
-    param_metric = [
-        m.name for m in
-        CharCountingMetric.objects.filter(name__in=metrics)
-    ] + [
-        m.name for m in
-        SubstringCountingMetric.objects.filter(name__in=metrics)
-    ] + [
-        m.name for m in
-        WordCountingMetric.objects.filter(name__in=metrics)
-    ] + [
-        m.name for m in
-        SpecificBranchCommitCounterMetric.objects.filter(name__in=metrics)
-    ] + [
-        m.name for m in
-        SpecificLengthPasteCounterMetric.objects.filter(name__in=metrics)
-    ] + [
-        m.name for m in
-        SpecificLengthCopyCounterMetric.objects.filter(name__in=metrics)
-    ]
-
-    non_param_metric = [
-        m.name for m in
-        Metric.objects.exclude(name__in=param_metric).filter(name__in=metrics)
-    ]
-    return_dict = {}
-    for string_representation in non_param_metric:
-        return_dict[string_representation] = string_representation
-    return_dict[WORD_COUNTER] = [
-        m.word for m in
-        WordCountingMetric.objects.filter(name__in=metrics)
-    ]
-    return_dict[SPECIFIC_LENGTH_COPY_COUNTER] = [
-        m.substring_length for m in
-        SpecificLengthCopyCounterMetric.objects.filter(name__in=metrics)
-    ]
-    return_dict[SPECIFIC_LENGTH_PASTE_COUNTER] = [
-        m.substring_length for m in
-        SpecificLengthPasteCounterMetric.objects.filter(name__in=metrics)
-    ]
-    return_dict[CHAR_COUNTER] = [
-        m.char for m in
-        CharCountingMetric.objects.filter(name__in=metrics)
-    ]
-    return_dict[SUBSTRING_COUNTER] = [
-        m.substring for m in
-        SubstringCountingMetric.objects.filter(name__in=metrics)
-    ]
-    return_dict[SPECIFIC_BRANCH_COMMIT_COUNTER] = [
-        m.branch_name for m in
-        SpecificBranchCommitCounterMetric.objects.filter(name__in=metrics)
-    ]
-    print(return_dict)
-    return JsonResponse(return_dict)
+    user_id = get_user_id(data['token'])
+    _, config, version = metrics_config(user_id)
+    return JsonResponse(dict(config, **{
+        FLUSH_CONTROL: flow_control.control(),
+        CONFIG_VERSION: version,
+    }))
+
+
+@csrf_exempt
+def plugin_bootstrap(request):
+    if request.method == 'GET':
+        return HttpResponseNotFound()
+
+    try:
+        data = decode_body(request)
+    except NoteValidationError as e:
+        return HttpResponseNotFound(str(e))
+    if not isinstance(data, dict):
+        return HttpResponseNotFound("'token' or 'username' and 'password' are not in received data")
+
+    return bootstrap_response(request, data)
+
+
+def bootstrap_response(request, data):
+    """
+    Returns the plugin token and configuration of the tracked metrics. Plugin is identified either by 'token' or by
+    'username' and 'password'. If 'If-None-Match' header has ETag of the response, it is not sent again.
+
+            Parameters:
+                    request: Received request
+                    data: Decoded request body
+
+            Returns:
+                    Response object
+    """
+    if 'token' in data:
+        token = data['token']
+        limited = check_rate_limit('metrics', token)
+        if limited:
+            return limited
+    elif 'username' in data and 'password' in data:
+        limited = check_rate_limit('login', client_ip(request))
+        if limited:
+            return limited
+        token = plugin_token(data['username'], data['password'])
+        if token is None:
+            return HttpResponse('Invalid password', status=401)
+    else:
+        return HttpResponseNotFound("'token' or 'username' and 'password' are not in received data")
+
+    user_id = get_user_id(token)
+    config_etag, config, version = metrics_config(user_id)
+    # token and version are parts of the response, so their changes change ETag as well
+    etag = '"%s"' % hashlib.md5(f'{config_etag}{token}{version}'.encode()).hexdigest()
+    if etag in parse_etags(request.headers.get('If-None-Match', '')):
+        response = HttpResponseNotModified()
+    else:
+        response = JsonResponse({'token': token, 'metrics': config, 'config_version': version})
+    response['ETag'] = etag
+    return add_control_headers(response)